@@ -0,0 +1,134 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Measures how much a FileStorage grows as topics' feeds change.
+
+Each topic is given a new revision of an Atom feed a number of times,
+committing each round, and the size of Data.fs is reported along with
+the time spent reading every feed back from a cold cache.
+
+Example usage:
+    python benchmarks/body_storage.py 100 10
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import transaction
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+
+from pushhub.models.topic import Topic, Topics
+
+WORDS = ('feed hub topic entry publish subscriber callback lease content '
+         'update notify atom link title author summary delivery worker '
+         'queue storage revision history request response').split()
+
+ENTRY = """<entry>
+  <id>tag:example.com,2013:%(n)d</id>
+  <title>%(title)s</title>
+  <link href="http://publisher.example.com/entries/%(n)d"/>
+  <updated>2013-01-%(day)02dT12:00:00Z</updated>
+  <author><name>Author %(author)d</name></author>
+  <content type="html">%(content)s</content>
+</entry>"""
+
+
+def make_feed(revision, entries=20):
+    parts = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<feed xmlns="http://www.w3.org/2005/Atom">',
+             '<title>Example feed</title>']
+    for n in xrange(revision, revision + entries):
+        words = [random.choice(WORDS) for i in xrange(150)]
+        parts.append(ENTRY % {
+            'n': n,
+            'title': ' '.join(words[:6]),
+            'day': n % 28 + 1,
+            'author': n % 5,
+            'content': ' '.join(words),
+        })
+    parts.append('</feed>')
+    return '\n'.join(parts)
+
+
+def run(topics, revisions):
+    path = tempfile.mkdtemp()
+    filename = os.path.join(path, 'Data.fs')
+    try:
+        db = DB(FileStorage(filename))
+        conn = db.open()
+        container = conn.root()['topics'] = Topics()
+        for n in xrange(topics):
+            topic = Topic('http://publisher%d.example.com/feed' % n)
+            container.add(topic.url, topic)
+        transaction.commit()
+        start = time.time()
+        for revision in xrange(revisions):
+            for topic in container.values():
+                topic.content = make_feed(revision)
+            transaction.commit()
+        write_time = time.time() - start
+        conn.close()
+        db.close()
+        size = os.path.getsize(filename)
+
+        db = DB(FileStorage(filename))
+        conn = db.open()
+        start = time.time()
+        length = 0
+        for topic in conn.root()['topics'].values():
+            length += len(topic.content)
+        read_time = time.time() - start
+        conn.close()
+        db.close()
+    finally:
+        shutil.rmtree(path)
+    return size, length, write_time, read_time
+
+
+def main(argv):
+    topics = int(argv[0]) if argv else 100
+    revisions = int(argv[1]) if len(argv) > 1 else 10
+    random.seed(0)
+    size, length, write_time, read_time = run(topics, revisions)
+    print "%d topics, %d revisions of %d byte feeds" % (
+        topics, revisions, length / topics)
+    print "Data.fs size: %.1f MB" % (size / (1024.0 * 1024))
+    print "Writing revisions: %.2fs, reading feeds cold: %.2fs" % (
+        write_time, read_time)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,99 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Measures FeedComparator on synthetic feeds of growing size.
+
+Each past feed is diffed against a new version in which a tenth of the
+entries were replaced and another tenth were updated, so every
+classification has work to do.
+
+Example usage:
+    python benchmarks/feed_comparator.py 10 1000 50000
+"""
+
+import sys
+import time
+
+from feedparser import FeedParserDict
+
+from pushhub.utils import FeedComparator
+
+
+def make_entry(i, year=2012, link=None):
+    return FeedParserDict(
+        id=u'http://publisher.example.com/%d' % i,
+        title=u'Entry %d' % i,
+        link=link or u'http://publisher.example.com/%d.html' % i,
+        updated_parsed=(year, 1, 1, 0, 0, 0, 0, 1, 0),
+    )
+
+
+def make_feeds(size):
+    past = [make_entry(i) for i in xrange(size)]
+    step = 10
+    new = []
+    for i in xrange(size):
+        if i % step == 0:
+            new.append(make_entry(size + i))
+        elif i % step == 1:
+            new.append(make_entry(i, year=2013))
+        else:
+            new.append(make_entry(i))
+    header = FeedParserDict(title=u'Feed', author=u'Author')
+    return (
+        FeedParserDict(feed=header, entries=new),
+        FeedParserDict(feed=header, entries=past),
+    )
+
+
+def run(size):
+    new_feed, past_feed = make_feeds(size)
+    start = time.time()
+    compare = FeedComparator(new_feed, past_feed)
+    new = compare.new_entries()
+    updated = compare.updated_entries()
+    removed = compare.removed_entries()
+    elapsed = time.time() - start
+    return elapsed, len(new), len(updated), len(removed)
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv] or [10, 1000, 50000]
+    print "%10s %12s %8s %8s %8s" % (
+        "entries", "ms", "new", "updated", "removed")
+    for size in sizes:
+        elapsed, new, updated, removed = run(size)
+        print "%10d %12.2f %8d %8d %8d" % (
+            size, elapsed * 1000, new, updated, removed)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,126 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Measures the memory and time spent extracting feed metadata and
+serializing the entries sent to subscribers.
+
+The hub runs on Python 2, which has no tracemalloc, so each step runs
+in a forked child and reports how far it pushed the child's peak
+resident set size (ru_maxrss) above where it started.
+
+Example usage:
+    python benchmarks/feed_serialization.py 1000 5000
+"""
+
+import os
+import resource
+import sys
+import time
+
+from feedparser import parse
+
+from pushhub.models.topic import Topic
+from pushhub.utils import FeedComparator
+
+ENTRY = u"""
+  <entry>
+    <title>Entry %(i)d</title>
+    <link href="http://publisher.example.com/%(i)d.html" />
+    <id>http://publisher.example.com/%(i)d</id>
+    <updated>2012-09-14T02:15:01Z</updated>
+    <content type="xhtml">
+      <div xmlns="http://www.w3.org/1999/xhtml">%(body)s</div>
+    </content>
+  </entry>
+"""
+
+FEED = u"""<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>%(title)s</title>
+  <link href="http://example.org/"/>
+  <link rel="self" href="http://publisher.example.com/feed.xml" />
+  <author><name>John Doe</name></author>
+  <updated>2012-09-14T02:15:01Z</updated>
+  %(entries)s
+</feed>
+"""
+
+
+def make_feed(size, title):
+    body = u'<p>%s</p>' % (u'Lorem ipsum dolor sit amet. ' * 40)
+    entries = u''.join(ENTRY % {'i': i, 'body': body} for i in xrange(size))
+    return (FEED % {'title': title, 'entries': entries}).encode('utf-8')
+
+
+def extract_metadata(new, past):
+    FeedComparator(new, past).changed_metadata()
+
+
+def serialize(new, past):
+    metadata = FeedComparator(new, past).changed_metadata()
+    metadata['entries'] = new.entries
+    Topic('http://publisher.example.com/feed.xml').generate_feed(metadata)
+
+
+def measure(step, new, past):
+    """Runs ``step`` in a forked child, returning (KB, seconds)."""
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        step(new, past)
+        elapsed = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_end, '%d %f' % (after - before, elapsed))
+        os._exit(0)
+    os.close(write_end)
+    result = os.read(read_end, 64)
+    os.waitpid(pid, 0)
+    kilobytes, elapsed = result.split()
+    return int(kilobytes), float(elapsed)
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv] or [1000, 5000]
+    print "%8s %-18s %12s %10s" % ("entries", "step", "peak KB", "ms")
+    for size in sizes:
+        past = parse(make_feed(size, u'Example Feed'))
+        new = parse(make_feed(size, u'Updated Feed'))
+        for step in (extract_metadata, serialize):
+            kilobytes, elapsed = measure(step, new, past)
+            print "%8d %-18s %12d %10.1f" % (
+                size, step.__name__, kilobytes, elapsed * 1000)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,106 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Measures how many bytes publish pings add to Data.fs, with ping times
+written by every ping and with them buffered by a PingBuffer.
+
+A minute of pings at each given rate is spread over a few topics, every
+ping in its own transaction as a publish request would be. Buffered pings
+are flushed every FLUSH_INTERVAL seconds of simulated time.
+
+Example usage:
+    python benchmarks/ping_writes.py 1 10 100
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import transaction
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+
+from pushhub.models import appmaker
+from pushhub.pings import PingBuffer
+
+TOPICS = ['http://publisher%d.example.com/feed' % i for i in range(10)]
+SECONDS = 60
+FLUSH_INTERVAL = 5
+
+
+def run(rate, buffered):
+    path = tempfile.mkdtemp()
+    filename = os.path.join(path, 'Data.fs')
+    try:
+        db = DB(FileStorage(filename))
+        conn = db.open()
+        hub = appmaker(conn.root())
+        for url in TOPICS:
+            hub.publish(url)
+        transaction.commit()
+        size = os.path.getsize(filename)
+
+        pings = PingBuffer(db, interval=3600) if buffered else None
+        count = rate * SECONDS
+        flush_every = rate * FLUSH_INTERVAL
+        start = time.time()
+        for i in xrange(count):
+            hub.publish(TOPICS[i % len(TOPICS)], pings=pings)
+            transaction.commit()
+            if pings is not None and (i + 1) % flush_every == 0:
+                pings.flush()
+        if pings is not None:
+            pings.stop()
+        elapsed = time.time() - start
+        written = os.path.getsize(filename) - size
+        conn.close()
+        db.close()
+    finally:
+        shutil.rmtree(path)
+    return count, written, elapsed
+
+
+def main(argv):
+    rates = [int(arg) for arg in argv] or [1, 10, 100]
+    print "%10s %10s %16s %16s %12s" % (
+        "pings/s", "pings", "bytes (direct)", "bytes (buffer)", "saved")
+    for rate in rates:
+        count, direct, _ = run(rate, False)
+        count, buffered, _ = run(rate, True)
+        print "%10d %10d %16d %16d %11.1f%%" % (
+            rate, count, direct, buffered,
+            100.0 * (direct - buffered) / direct if direct else 0)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,111 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Measures the latency of a single publish ping as the number of topics
+known to the hub grows.
+
+Outbound HTTP is replaced with an in-memory response, so the numbers show
+the work the hub does per ping rather than network time. The number of
+topic fetches per ping is reported alongside the latency; it should stay
+at 1 no matter how many topics the hub holds.
+
+Example usage:
+    python benchmarks/publish_latency.py 10 100 1000 5000
+"""
+
+import sys
+import time
+
+from mock import patch
+from paste.util.multidict import MultiDict
+from pyramid import testing
+from pyramid.request import Request
+
+from pushhub.models.hub import Hub
+from pushhub.models.topic import Topic, Topics
+from pushhub.tests.mocks import MockResponse, good_atom
+from pushhub.views import publish
+
+HEADERS = [("Content-Type", "application/x-www-form-urlencoded")]
+PINGED_URL = 'http://publisher.example.com/feed'
+
+
+class CountingResponse(MockResponse):
+    """Counts the calls made to the mocked ``client.get``"""
+    calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self
+
+
+def build_hub(topic_count):
+    hub = Hub()
+    hub.topics = Topics()
+    for i in xrange(topic_count):
+        url = 'http://publisher%d.example.com/feed' % i
+        hub.topics.add(url, Topic(url))
+    hub.publish(PINGED_URL)
+    return hub
+
+
+def ping(hub, registry):
+    data = MultiDict({'hub.mode': 'publish'})
+    data.add('hub.url', PINGED_URL)
+    request = Request.blank('/publish', headers=HEADERS, POST=data)
+    request.root = hub
+    request.registry = registry
+    return publish(None, request)
+
+
+def run(registry, topic_count, pings=20):
+    hub = build_hub(topic_count)
+    response = CountingResponse(content=good_atom, status_code=200)
+    with patch('pushhub.client.get', new=response):
+        start = time.time()
+        for i in xrange(pings):
+            ping(hub, registry)
+        elapsed = time.time() - start
+    return elapsed / pings, float(response.calls) / pings
+
+
+def main(argv):
+    counts = [int(arg) for arg in argv] or [10, 100, 1000, 5000]
+    config = testing.setUp()
+    print "%10s %15s %15s" % ("topics", "ms / publish", "fetches / ping")
+    for count in counts:
+        latency, fetches = run(config.registry, count)
+        print "%10d %15.2f %15.1f" % (count, latency * 1000, fetches)
+    testing.tearDown()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,105 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Measures how quickly notifications for one topic's subscribers are queued
+on a running Redis server.
+
+Jobs carrying the whole body are queued one round trip at a time, the
+way Topic.notify_subscribers used to do it. Then the body is stored once
+and jobs carrying its key are queued in pipelined batches. The Redis
+memory each approach uses is reported too. The jobs go on a scratch queue
+that is emptied afterwards.
+
+Example usage:
+    python benchmarks/subscriber_fanout.py redis://localhost:6379/15 5000
+"""
+
+import sys
+import time
+
+from pushhub import delivery
+
+QUEUE_NAME = 'pushhub-benchmark'
+BODY = '<feed>%s</feed>' % ('x' * 256 * 1024)
+HEADERS = {'Content-Type': 'application/atom+xml'}
+
+
+def used_memory():
+    return delivery.get_connection().info('memory')['used_memory']
+
+
+def one_by_one(count):
+    queue = delivery.get_queue()
+    before = used_memory()
+    start = time.time()
+    for i in xrange(count):
+        url = 'http://subscriber%d.example.com/' % i
+        queue.enqueue('ucla.jobs.hub.post', url, BODY, HEADERS)
+    return time.time() - start, used_memory() - before
+
+
+def pipelined(count):
+    before = used_memory()
+    start = time.time()
+    key = delivery.store_payload(BODY)
+    delivery.enqueue_many('pushhub.delivery.deliver', (
+        ('http://subscriber%d.example.com/' % i, key, HEADERS)
+        for i in xrange(count)
+    ))
+    elapsed = time.time() - start
+    used = used_memory() - before
+    delivery.get_connection().delete(key)
+    return elapsed, used
+
+
+def main(argv):
+    url = argv[0] if argv else 'redis://localhost:6379/15'
+    counts = [int(arg) for arg in argv[1:]] or [100, 1000, 5000]
+    delivery.configure(url=url, queue_name=QUEUE_NAME)
+    queue = delivery.get_queue()
+    print "%12s %15s %12s %15s %12s" % (
+        "subscribers", "jobs/s single", "KB single",
+        "jobs/s batched", "KB batched")
+    try:
+        for count in counts:
+            single, single_used = one_by_one(count)
+            queue.empty()
+            batched, batched_used = pipelined(count)
+            queue.empty()
+            print "%12d %15.0f %12d %15.0f %12d" % (
+                count, count / single, single_used / 1024,
+                count / batched, batched_used / 1024)
+    finally:
+        queue.delete(delete_jobs=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,149 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Measures subscribing and fanning out notifications as the number of
+subscriptions held in a FileStorage grows.
+
+Subscriptions are spread over a fixed number of topics and committed in
+batches, as the verifier pool does, each with a lease as subscribers
+usually ask for. Fan-out is timed from a fresh
+connection with a cold cache, so it includes loading the subscriptions
+from disk. Queueing is replaced with a counter, so the numbers show the
+work the hub does rather than Redis round trips. The size of Data.fs is
+reported too.
+
+Example usage:
+    python benchmarks/subscriptions.py 1000 10000 100000
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import transaction
+from mock import patch
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+
+from pushhub.models.hub import Hub
+from pushhub.models.listener import Listeners
+from pushhub.models.subscriber import Subscribers
+from pushhub.models.topic import Topics
+
+TOPICS = 100
+BATCH_SIZE = 1000
+LEASE_SECONDS = 10 * 86400
+
+
+class CountingQueue(object):
+    """Counts the notifications passed to the mocked ``enqueue_many``"""
+    calls = 0
+
+    def __call__(self, func, calls, **kwargs):
+        count = 0
+        for call in calls:
+            count += 1
+        self.calls += count
+        return count
+
+
+def call_now(func, *args, **kwargs):
+    return func(*args, **kwargs)
+
+
+def subscribe_all(root, count):
+    hub = root['hub'] = Hub()
+    hub.topics = Topics()
+    hub.subscribers = Subscribers()
+    hub.listeners = Listeners()
+    for i in xrange(count):
+        hub.subscribe('http://subscriber%d.example.com/callback' % i,
+                      'http://publisher%d.example.com/feed' % (i % TOPICS),
+                      verify_callbacks=False,
+                      lease_seconds=hub.jitter_lease(LEASE_SECONDS))
+        if (i + 1) % BATCH_SIZE == 0:
+            transaction.commit()
+    transaction.commit()
+
+
+def fan_out(hub):
+    for topic in hub.topics.values():
+        topic.changed = True
+        topic.content_type = 'application/atom+xml'
+        topic.notify_subscribers(hub.get_url_table())
+    transaction.abort()
+
+
+def run(count):
+    path = tempfile.mkdtemp()
+    filename = os.path.join(path, 'Data.fs')
+    try:
+        db = DB(FileStorage(filename))
+        conn = db.open()
+        start = time.time()
+        subscribe_all(conn.root(), count)
+        subscribing = time.time() - start
+        conn.close()
+        db.pack()
+        size = os.path.getsize(filename)
+
+        queue = CountingQueue()
+        conn = db.open()
+        conn.cacheMinimize()
+        # Queue straight away rather than once a transaction commits
+        with patch('pushhub.delivery.after_commit', new=call_now):
+            with patch('pushhub.delivery.store_payload'):
+                with patch('pushhub.delivery.enqueue_many', new=queue):
+                    start = time.time()
+                    fan_out(conn.root()['hub'])
+                    fanning_out = time.time() - start
+        conn.close()
+        db.close()
+        assert queue.calls == count
+    finally:
+        shutil.rmtree(path)
+    return subscribing, fanning_out, size
+
+
+def main(argv):
+    counts = [int(arg) for arg in argv] or [1000, 10000, 100000]
+    print "%10s %15s %15s %12s" % (
+        "subs", "subscribe / s", "fan-out ms", "Data.fs KB")
+    for count in counts:
+        subscribing, fanning_out, size = run(count)
+        print "%10d %15.0f %15.1f %12d" % (
+            count, count / subscribing, fanning_out * 1000, size / 1024)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,156 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Counts the ZODB write conflicts between concurrent requests for a few
+busy topics.
+
+Worker threads each use their own connection to a FileStorage and make
+a mix of publish pings, subscribes and unsubscribes for the same topics, sleeping inside each transaction as a request waiting on the
+network would. A request that hits ConflictError is retried, as
+pyramid_tm does. The conflicts per 1,000 requests are reported.
+
+Example usage:
+    python benchmarks/topic_conflicts.py 8 2000
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import transaction
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+
+from pushhub.models.hub import Hub
+from pushhub.models.listener import Listeners
+from pushhub.models.subscriber import Subscribers
+from pushhub.models.topic import Topics
+from pushhub.utils import Counters
+
+TOPICS = ['http://publisher%d.example.com/feed' % i for i in range(3)]
+ATTEMPTS = 3
+LATENCY = 0.002
+
+
+def publish(hub, n):
+    hub.publish(random.choice(TOPICS))
+
+
+def subscribe(hub, n):
+    hub.subscribe('http://subscriber%d.example.com/callback' % n,
+                  random.choice(TOPICS), verify_callbacks=False)
+
+
+def unsubscribe(hub, n):
+    hub.unsubscribe('http://subscriber%d.example.com/callback' % (n / 2),
+                    random.choice(TOPICS), verify_callbacks=False)
+
+
+REQUESTS = [publish, publish, subscribe, unsubscribe]
+
+
+class Worker(threading.Thread):
+
+    def __init__(self, db, numbers, counts):
+        super(Worker, self).__init__()
+        self.db = db
+        self.numbers = numbers
+        self.counts = counts
+
+    def run(self):
+        tm = transaction.TransactionManager()
+        conn = self.db.open(transaction_manager=tm)
+        for n in self.numbers:
+            request = random.choice(REQUESTS)
+            for attempt in xrange(ATTEMPTS):
+                tm.begin()
+                try:
+                    request(conn.root()['hub'], n)
+                    time.sleep(LATENCY)
+                    tm.commit()
+                    break
+                except ConflictError:
+                    tm.abort()
+                    self.counts.incr('conflicts')
+            else:
+                self.counts.incr('failed')
+        conn.close()
+
+
+def run(threads, requests):
+    path = tempfile.mkdtemp()
+    try:
+        db = DB(FileStorage(os.path.join(path, 'Data.fs')))
+        conn = db.open()
+        hub = conn.root()['hub'] = Hub()
+        hub.topics = Topics()
+        hub.subscribers = Subscribers()
+        hub.listeners = Listeners()
+        for url in TOPICS:
+            hub.publish(url)
+        transaction.commit()
+        conn.close()
+
+        counts = Counters('conflicts', 'failed')
+        workers = [
+            Worker(db, xrange(i, requests, threads), counts)
+            for i in xrange(threads)
+        ]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - start
+        db.close()
+    finally:
+        shutil.rmtree(path)
+    return counts.snapshot(), elapsed
+
+
+def main(argv):
+    threads = int(argv[0]) if argv else 8
+    requests = int(argv[1]) if len(argv) > 1 else 2000
+    counts, elapsed = run(threads, requests)
+    print "%d requests on %d threads in %.2fs" % (requests, threads, elapsed)
+    print "Conflicts per 1,000 requests: %.1f" % (
+        counts['conflicts'] * 1000.0 / requests)
+    print "Requests failed after %d attempts: %d" % (
+        ATTEMPTS, counts['failed'])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
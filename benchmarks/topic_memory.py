@@ -0,0 +1,145 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Measures how much a worker's ZODB cache holds after touching every topic.
+
+Topics are given feeds through Topic.update, as fetching them does, and
+written to a FileStorage. A fresh connection then iterates them reading
+only their metadata, as counting subscribers or listing topics does. The
+estimated size of the objects left in the connection cache and the size
+of the largest Topic record are reported.
+
+Example usage:
+    python benchmarks/topic_memory.py 1000 500
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+import transaction
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+
+from pushhub.models.topic import Topic, Topics
+
+ENTRY = """<entry>
+  <id>tag:publisher.example.com,2013:%(n)d</id>
+  <title>Entry %(n)d</title>
+  <link href="http://publisher.example.com/entries/%(n)d"/>
+  <updated>2013-01-%(day)02dT12:00:00Z</updated>
+  <content type="html">%(content)s</content>
+</entry>"""
+
+
+class Response(object):
+    status_code = 200
+    headers = {}
+
+    def __init__(self, content):
+        self.content = content
+
+
+def make_feed(entries):
+    parts = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<feed xmlns="http://www.w3.org/2005/Atom">',
+             '<title>Example feed</title>',
+             '<id>http://publisher.example.com/</id>',
+             '<updated>2013-01-28T12:00:00Z</updated>']
+    for n in xrange(entries):
+        parts.append(ENTRY % {
+            'n': n,
+            'day': n % 28 + 1,
+            'content': 'Entry %d of the example feed. ' % n * 5,
+        })
+    parts.append('</feed>')
+    return '\n'.join(parts)
+
+
+def parse_once(parse):
+    """Parses each feed once; every topic is given the same one."""
+    parsed = {}
+
+    def wrapper(self, content):
+        if content not in parsed:
+            parsed[content] = parse(self, content)
+        return parsed[content]
+    return wrapper
+
+
+def run(topics, entries):
+    path = tempfile.mkdtemp()
+    try:
+        db = DB(FileStorage(os.path.join(path, 'Data.fs')),
+                cache_size_bytes=0)
+        conn = db.open()
+        container = conn.root()['topics'] = Topics()
+        feed = make_feed(entries)
+        for n in xrange(topics):
+            topic = Topic('http://publisher%d.example.com/feed' % n)
+            topic.update(Response(feed))
+            container.add(topic.url, topic)
+            if n % 100 == 99:
+                transaction.commit()
+        transaction.commit()
+        conn.close()
+        db.close()
+
+        storage = FileStorage(os.path.join(path, 'Data.fs'))
+        db = DB(storage)
+        conn = db.open()
+        record = 0
+        for topic in conn.root()['topics'].values():
+            topic.subscriber_count
+            data, serial = storage.load(topic._p_oid)
+            record = max(record, len(data))
+        cached = conn._cache.total_estimated_size
+        conn.close()
+        db.close()
+    finally:
+        shutil.rmtree(path)
+    return cached, record
+
+
+def main(argv):
+    topics = int(argv[0]) if argv else 1000
+    entries = int(argv[1]) if len(argv) > 1 else 500
+    Topic.parse = parse_once(Topic.parse)
+    cached, record = run(topics, entries)
+    print "%d topics with %d entry feeds" % (topics, entries)
+    print "Cache size after reading metadata: %.1f MB" % (
+        cached / (1024.0 * 1024))
+    print "Topic record: %.1f KB" % (record / 1024.0)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
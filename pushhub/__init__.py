@@ -51,6 +51,13 @@ def main(global_config, **settings):
     """
     config = Configurator(root_factory=root_factory, settings=settings)
 
+    config.include('.client')
+    config.include('.delivery')
+    config.include('.models.body')
+    config.include('.pings')
+    config.include('.pipeline')
+    config.include('.verifier')
+
     config.add_static_view('static', 'static', cache_max_age=3600)
 
     config.add_route('publish', '/publish')
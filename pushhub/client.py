@@ -0,0 +1,141 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Outbound HTTP for the hub.
+
+Topic fetches, subscription verification and listener notifications all
+go through one shared requests Session, so connections to a host are
+kept alive and reused instead of being opened for every request.
+"""
+
+from cookielib import DefaultCookiePolicy
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import logging
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_session = None
+_options = {
+    'pool_connections': 10,
+    'pool_maxsize': 10,
+    'timeout': 30.0,
+}
+
+
+def configure(pool_connections=10, pool_maxsize=10, timeout=30.0):
+    """
+    Sets the connection pool options and replaces the shared session.
+
+    Arguments:
+        * pool_connections: How many hosts keep a connection pool
+        * pool_maxsize: How many connections are kept open per host
+        * timeout: Seconds to wait for a response, or None to wait forever
+    """
+    global _session
+    with _lock:
+        _options.update(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            timeout=timeout,
+        )
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def get_session():
+    """Returns the shared session, creating it on first use."""
+    global _session
+    with _lock:
+        if _session is None:
+            session = requests.Session()
+            # Requests to publishers and subscribers are independent of
+            # each other; don't carry cookies from one to the next.
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            for prefix in ('http://', 'https://'):
+                session.mount(prefix, HTTPAdapter(
+                    pool_connections=_options['pool_connections'],
+                    pool_maxsize=_options['pool_maxsize'],
+                ))
+            _session = session
+        return _session
+
+
+def get(url, **kwargs):
+    """Sends a GET request over the shared session."""
+    kwargs.setdefault('timeout', _options['timeout'])
+    return get_session().get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    """Sends a POST request over the shared session."""
+    kwargs.setdefault('timeout', _options['timeout'])
+    return get_session().post(url, **kwargs)
+
+
+def connection_stats():
+    """
+    Reports how well connections are being reused.
+
+    Counts cover the host pools currently held by the session; pools
+    evicted to make room for other hosts take their counts with them.
+    """
+    pools = connections = sent = 0
+    for adapter in get_session().adapters.values():
+        manager = adapter.poolmanager
+        for key in manager.pools.keys():
+            pool = manager.pools.get(key)
+            if pool is None:
+                continue
+            pools += 1
+            connections += pool.num_connections
+            sent += pool.num_requests
+    return {
+        'pools': pools,
+        'connections': connections,
+        'requests': sent,
+        'reused': max(sent - connections, 0),
+    }
+
+
+def includeme(config):
+    """Configures the shared session from the ``pushhub.http_*`` settings."""
+    settings = config.registry.settings
+    configure(
+        pool_connections=int(settings.get('pushhub.http_pool_connections',
+                                          10)),
+        pool_maxsize=int(settings.get('pushhub.http_pool_maxsize', 10)),
+        timeout=float(settings.get('pushhub.http_timeout', 30)),
+    )
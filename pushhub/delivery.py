@@ -0,0 +1,313 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+The queue that carries notifications to subscribers.
+
+Every process shares one Redis connection pool, configured from the
+``pushhub.redis_*`` settings. Notifications for many subscribers are
+sent to Redis in pipelined batches instead of one round trip per job.
+
+A feed body is stored in Redis once, compressed with gzip, under a key
+derived from its hash, and the jobs for each subscriber only carry that
+key. Workers load the body on first use and keep recent ones in memory.
+
+Subscribers that list gzip in the Accept-Encoding header of their
+responses (RFC 7694) are sent the stored bytes as is, with
+``Content-Encoding: gzip``; others are sent the decompressed body.
+
+Jobs that must be delivered in order, like listener notifications, go
+on a queue of their own next to the notification queue. Only one
+delivery worker at a time takes jobs from it, so they can't be reordered
+by several workers sending them at once.
+
+Bodies and jobs produced while handling a request are only sent once its
+transaction commits, so a request retried after a conflict doesn't
+queue its notifications twice.
+"""
+
+from collections import OrderedDict
+from hashlib import sha1
+import threading
+
+from redis import Redis
+from rq import Queue, get_current_connection
+import transaction
+
+from . import client
+from .utils import gzip_decompress
+
+import logging
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_connection = None
+_options = {
+    'url': 'redis://localhost:6379/0',
+    'queue_name': 'default',
+    'batch_size': 500,
+    'payload_ttl': 86400,
+    'payload_cache_size': 16,
+}
+_payloads = OrderedDict()
+# Callback URLs that accept gzip request bodies, most recent last
+_gzip_callbacks = OrderedDict()
+
+PAYLOAD_PREFIX = 'pushhub:payload:'
+ORDERED_SUFFIX = ':ordered'
+GZIP_CALLBACKS_SIZE = 10000
+
+
+def configure(url='redis://localhost:6379/0', queue_name='default',
+              batch_size=500, payload_ttl=86400, payload_cache_size=16):
+    """
+    Sets the queue options and drops the shared connection pool.
+
+    Arguments:
+        * url: The Redis server to queue jobs on
+        * queue_name: The rq queue that workers listen to
+        * batch_size: How many jobs are sent to Redis per round trip
+        * payload_ttl: Seconds a stored feed body is kept in Redis
+        * payload_cache_size: How many feed bodies a worker keeps in memory
+    """
+    global _connection
+    with _lock:
+        _options.update(
+            url=url,
+            queue_name=queue_name,
+            batch_size=batch_size,
+            payload_ttl=payload_ttl,
+            payload_cache_size=payload_cache_size,
+        )
+        if _connection is not None:
+            _connection.connection_pool.disconnect()
+        _connection = None
+        _payloads.clear()
+        _gzip_callbacks.clear()
+
+
+def get_connection():
+    """Returns the shared Redis connection, creating it on first use."""
+    global _connection
+    with _lock:
+        if _connection is None:
+            _connection = Redis.from_url(_options['url'])
+        return _connection
+
+
+def get_queue(ordered=False):
+    """
+    Returns the notification queue on the shared connection, or with
+    ``ordered`` the queue for jobs that must be delivered in order.
+    """
+    name = _options['queue_name']
+    if ordered:
+        name += ORDERED_SUFFIX
+    return Queue(name, connection=get_connection())
+
+
+def after_commit(func, *args, **kwargs):
+    """
+    Calls func with the given arguments once the current transaction has
+    committed, and not at all if it is aborted.
+    """
+    def hook(success, *args, **kwargs):
+        if success:
+            func(*args, **kwargs)
+    transaction.get().addAfterCommitHook(hook, args, kwargs)
+
+
+def enqueue_many(func, calls, batch_size=None, meta=None):
+    """
+    Queues one job per set of arguments, pipelining them in batches.
+
+    Arguments:
+        * func: The job function, or its dotted name
+        * calls: An iterable of argument tuples, one per job
+        * batch_size: Jobs per pipeline, defaulting to the configured size
+        * meta: Metadata stored with each job, e.g. ``{'ordered': True}``
+                to queue them for in order delivery
+
+    Returns the number of jobs queued.
+    """
+    if batch_size is None:
+        batch_size = _options['batch_size']
+
+    queue = get_queue(ordered=bool(meta and meta.get('ordered')))
+    connection = queue.connection
+    count = 0
+    pipe = connection.pipeline()
+    for args in calls:
+        job = queue.job_class.create(
+            func,
+            args=args,
+            connection=connection,
+            origin=queue.name,
+            meta=meta,
+        )
+        queue.enqueue_job(job, pipeline=pipe)
+        count += 1
+        if count % batch_size == 0:
+            pipe.execute()
+    if count % batch_size:
+        pipe.execute()
+    pipe.reset()
+
+    logger.debug('Queued %d %s jobs' % (count, func))
+    return count
+
+
+def payload_key(body):
+    """Returns the Redis key a feed body is stored under."""
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    return PAYLOAD_PREFIX + sha1(body).hexdigest()
+
+
+def store_payload(body, ttl=None):
+    """
+    Stores a feed body for delivery jobs to share and returns its key.
+
+    Storing the same body again only renews its expiry.
+
+    Arguments:
+        * body: The feed content sent to subscribers, compressed with gzip
+        * ttl: Seconds to keep the body, defaulting to the configured TTL
+    """
+    if ttl is None:
+        ttl = _options['payload_ttl']
+    key = payload_key(body)
+    get_connection().setex(key, ttl, body)
+    return key
+
+
+def load_payload(key, connection=None, encoding='identity'):
+    """
+    Returns a stored feed body, keeping recently used ones in memory.
+
+    Arguments:
+        * key: The key the body is stored under
+        * connection: The Redis connection to load it from
+        * encoding: 'gzip' for the body as stored, or 'identity' for it
+                    decompressed
+
+    Raises a ValueError if the body has expired from Redis.
+    """
+    with _lock:
+        encodings = _payloads.pop(key, None)
+        if encodings is not None:
+            _payloads[key] = encodings
+
+    if encodings is None:
+        if connection is None:
+            connection = get_connection()
+        body = connection.get(key)
+        if body is None:
+            raise ValueError('Payload %s has expired' % key)
+        encodings = {'gzip': body}
+        with _lock:
+            _payloads[key] = encodings
+            while len(_payloads) > _options['payload_cache_size']:
+                _payloads.popitem(last=False)
+
+    if encoding not in encodings:
+        # Decompressed once per worker, for every delivery that needs it
+        encodings[encoding] = gzip_decompress(encodings['gzip'])
+    return encodings[encoding]
+
+
+def accepts_gzip(callback_url):
+    """Whether a callback has said it accepts gzip request bodies."""
+    with _lock:
+        return callback_url in _gzip_callbacks
+
+
+def note_encodings(callback_url, response):
+    """
+    Remembers whether a callback accepts gzip request bodies from the
+    Accept-Encoding header of its response.
+    """
+    accepted = response.headers.get('Accept-Encoding', '')
+    codings = [c.split(';')[0].strip().lower() for c in accepted.split(',')]
+    with _lock:
+        if 'gzip' in codings:
+            _gzip_callbacks.pop(callback_url, None)
+            _gzip_callbacks[callback_url] = True
+            while len(_gzip_callbacks) > GZIP_CALLBACKS_SIZE:
+                _gzip_callbacks.popitem(last=False)
+        else:
+            _gzip_callbacks.pop(callback_url, None)
+
+
+def deliver(callback_url, key, headers, method='POST'):
+    """
+    Job that sends a stored feed body to a subscriber or listener.
+
+    The body is sent compressed if the callback has said it accepts
+    gzip, and again uncompressed if it then refuses it.
+
+    Arguments:
+        * callback_url: The subscriber's or listener's callback URL
+        * key: The key of the stored feed body
+        * headers: Headers to send with the body
+        * method: The HTTP method to send the body with
+    """
+    # Inside an rq worker, use the connection the job was taken from.
+    connection = get_current_connection()
+    if method == 'GET':
+        send = client.get
+    else:
+        send = client.post
+
+    response = None
+    if accepts_gzip(callback_url):
+        body = load_payload(key, connection=connection, encoding='gzip')
+        gzip_headers = dict(headers)
+        gzip_headers['Content-Encoding'] = 'gzip'
+        response = send(callback_url, data=body, headers=gzip_headers)
+        if response.status_code == 415:
+            response = None
+    if response is None:
+        body = load_payload(key, connection=connection)
+        response = send(callback_url, data=body, headers=headers)
+    note_encodings(callback_url, response)
+    response.raise_for_status()
+    return response.status_code
+
+
+def includeme(config):
+    """Configures the queue from the ``pushhub.redis_*`` settings."""
+    settings = config.registry.settings
+    configure(
+        url=settings.get('pushhub.redis_url', 'redis://localhost:6379/0'),
+        queue_name=settings.get('pushhub.redis_queue', 'default'),
+        batch_size=int(settings.get('pushhub.redis_batch_size', 500)),
+        payload_ttl=int(settings.get('pushhub.redis_payload_ttl', 86400)),
+    )
@@ -0,0 +1,191 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Concurrent fetching of topic content.
+
+Only the HTTP requests run on worker threads. Responses are handed back
+to the calling thread, which applies them to the persistent Topic
+objects, so ZODB objects are never shared between threads.
+"""
+
+from collections import deque
+from Queue import Queue
+from urlparse import urlparse
+import threading
+import time
+
+from requests.exceptions import RequestException
+
+from . import client
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class FetchEngine(object):
+    def __init__(self, concurrency=10, per_host=2):
+        """
+        Runs HTTP GET requests concurrently.
+
+        Arguments:
+            * concurrency: The most requests in flight at once
+            * per_host: The most requests in flight to any single host
+        """
+        self.concurrency = max(1, concurrency)
+        self.per_host = max(1, per_host)
+
+    def run(self, jobs):
+        """
+        Fetches each job and yields the results as they complete.
+
+        Jobs are (key, url, headers) tuples; results are
+        (key, response, error) tuples where exactly one of response
+        and error is set. Hosts with waiting jobs are served round-robin
+        so one large publisher can't starve the others.
+        """
+        waiting = {}
+        ready = deque()
+        for job in jobs:
+            host = urlparse(job[1]).netloc
+            if host not in waiting:
+                waiting[host] = deque()
+                ready.append(host)
+            waiting[host].append(job)
+
+        if not waiting:
+            return
+
+        active = dict.fromkeys(waiting, 0)
+        tasks = Queue()
+        results = Queue()
+        threads = []
+        for i in xrange(self.concurrency):
+            thread = threading.Thread(
+                target=self._work,
+                args=(tasks, results),
+                name='pushhub-fetcher-%d' % i,
+            )
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        in_flight = 0
+        try:
+            while ready or in_flight:
+                # A host is in ``ready`` only while it has waiting jobs
+                # and fewer than ``per_host`` requests in flight.
+                while ready and in_flight < self.concurrency:
+                    host = ready.popleft()
+                    tasks.put((host, waiting[host].popleft()))
+                    active[host] += 1
+                    in_flight += 1
+                    if waiting[host] and active[host] < self.per_host:
+                        ready.append(host)
+
+                host, key, response, error = results.get()
+                in_flight -= 1
+                active[host] -= 1
+                if waiting[host] and active[host] == self.per_host - 1:
+                    ready.append(host)
+
+                yield key, response, error
+        finally:
+            for thread in threads:
+                tasks.put(None)
+
+    def _work(self, tasks, results):
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            host, (key, url, headers) = task
+            try:
+                response = client.get(url, headers=headers)
+            except Exception as e:
+                results.put((host, key, None, e))
+            else:
+                results.put((host, key, response, None))
+
+    def fetch_topics(self, topics, hub_url, checkpoint=None, batch_size=100,
+                     applied=None):
+        """
+        Fetches the given topics and applies the responses to them.
+
+        Arguments:
+            * topics: The Topic objects to fetch
+            * hub_url: The hub address reported to publishers
+            * checkpoint: Called after every ``batch_size`` applied
+                          topics, e.g. to commit the transaction
+            * batch_size: How many topics are applied between checkpoints
+            * applied: Called with each topic once its response has been
+                       applied, before the checkpoint that follows it
+
+        Returns a dict with the number of topics fetched, the elapsed
+        seconds and the throughput in topics per second.
+        """
+        start = time.time()
+        jobs = [
+            (topic, topic.url, topic.request_headers(hub_url))
+            for topic in topics
+        ]
+
+        count = 0
+        for topic, response, error in self.run(jobs):
+            if error is None:
+                try:
+                    topic.update(response)
+                except ValueError:
+                    logger.warning('Invalid content for topic %s'
+                                   % topic.url)
+            elif isinstance(error, RequestException):
+                topic.fetch_failed()
+            else:
+                raise error
+            if applied is not None:
+                applied(topic)
+
+            count += 1
+            if checkpoint is not None and count % batch_size == 0:
+                checkpoint()
+
+        elapsed = time.time() - start
+        rate = count / elapsed if elapsed else 0.0
+        logger.info('Fetched %d topics in %.2fs (%.1f topics/sec)'
+                    % (count, elapsed, rate))
+        return {'topics': count, 'seconds': elapsed, 'rate': rate}
+
+
+def engine_from_settings(settings):
+    """Creates a FetchEngine using the ``pushhub.fetch_*`` settings."""
+    return FetchEngine(
+        concurrency=int(settings.get('pushhub.fetch_concurrency', 10)),
+        per_host=int(settings.get('pushhub.fetch_per_host', 2)),
+    )
@@ -0,0 +1,156 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Storage of feed bodies apart from the topics they belong to.
+
+A topic only holds a reference to its FeedBody, so loading a topic, e.g.
+to read its metadata while iterating over all of them, doesn't load its
+content, or the index of the fetched feed kept with it. The body is
+loaded from the database the first time either is read.
+
+Bodies are stored compressed with the codec set by ``pushhub.body_codec``
+(gzip by default) and decompressed the first time their data is read.
+The decompressed data is kept until the body is removed from the cache.
+Gzip bodies are queued for delivery as they are stored, without being
+decompressed or compressed again.
+"""
+
+import threading
+
+from persistent import Persistent
+
+from ..utils import gzip_compress
+from ..utils import gzip_decompress
+
+
+def identity_encode(data, level):
+    return data
+
+
+def identity_decode(data):
+    return data
+
+
+# codec name -> (encode(data, level), decode(data))
+CODECS = {
+    'gzip': (gzip_compress, gzip_decompress),
+    'identity': (identity_encode, identity_decode),
+}
+
+_lock = threading.Lock()
+_options = {
+    'codec': 'gzip',
+    'level': 6,
+}
+
+
+def configure(codec='gzip', level=6):
+    """
+    Sets how new feed bodies are stored.
+
+    Arguments:
+        * codec: The name of the codec in CODECS to compress bodies with
+        * level: The compression level, from 1 (fastest) to 9 (smallest)
+    """
+    if codec not in CODECS:
+        raise ValueError('Unknown feed body codec %r' % codec)
+    with _lock:
+        _options.update(codec=codec, level=level)
+
+
+class FeedBody(Persistent):
+    """The raw content of one revision of a feed."""
+
+    # Bodies stored before they were compressed keep their data as is,
+    # under 'data' in their state.
+    codec = 'identity'
+    encoded = None
+    size = None
+    # FeedIndex of the fetched feed this revision came from, which the
+    # next fetch is diffed against
+    index = None
+
+    _v_data = None
+
+    def __init__(self, data, codec=None, level=None, index=None):
+        """
+        Arguments:
+            * data: The feed content
+            * codec: The codec to store it with, defaulting to the
+                     configured one
+            * level: The compression level, defaulting to the configured
+                     one
+            * index: The FeedIndex of the fetched feed
+        """
+        if codec is None:
+            codec = _options['codec']
+        if level is None:
+            level = _options['level']
+        encode = CODECS[codec][0]
+        self.codec = codec
+        self.encoded = encode(data, level)
+        self.size = len(data)
+        self.index = index
+        self._v_data = data
+
+    @property
+    def data(self):
+        """The feed content, decompressed on first use."""
+        data = self._v_data
+        if data is None:
+            if self.encoded is None:
+                return self.__dict__.get('data')
+            decode = CODECS[self.codec][1]
+            data = self._v_data = decode(self.encoded)
+        return data
+
+    def gzipped(self):
+        """
+        Returns the content compressed with gzip, reusing the stored bytes
+        if the body is kept in gzip.
+        """
+        if self.codec == 'gzip' and self.encoded is not None:
+            return self.encoded
+        return gzip_compress(self.data, _options['level'])
+
+    def __len__(self):
+        if self.size is None:
+            return len(self.data)
+        return self.size
+
+
+def includeme(config):
+    """Configures feed body storage from the ``pushhub.body_*`` settings."""
+    settings = config.registry.settings
+    configure(
+        codec=settings.get('pushhub.body_codec', 'gzip'),
+        level=int(settings.get('pushhub.body_compress_level', 6)),
+    )
@@ -0,0 +1,190 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Containers for the hub's topics, subscribers and listeners.
+"""
+
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Container(Persistent):
+    """
+    A mapping of names to persistent objects, stored in an OOBTree.
+
+    It offers the parts of repoze.folder's Folder API the hub uses, with
+    the same attribute layout, so Folder subclasses stored by earlier
+    versions load as Containers. Unlike Folder it sends no events and
+    doesn't set __parent__ and __name__ on the objects it holds, so adding
+    one only writes the BTree. keys, values and items are lazy.
+    """
+    __name__ = __parent__ = None
+    title = None
+
+    # Containers stored without a Length count their items instead
+    _num_objects = None
+
+    def __init__(self):
+        self.data = OOBTree()
+        self._num_objects = Length()
+
+    def __len__(self):
+        if self._num_objects is None:
+            return len(self.data)
+        return self._num_objects()
+
+    def __nonzero__(self):
+        # Like a Folder, an empty container is still true
+        return True
+
+    def __contains__(self, name):
+        return self.data.has_key(name)
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def get(self, name, default=None):
+        return self.data.get(name, default)
+
+    def keys(self):
+        return self.data.keys()
+
+    def values(self):
+        return self.data.values()
+
+    def items(self):
+        return self.data.items()
+
+    def add(self, name, other):
+        """Adds an object, raising KeyError if the name is taken."""
+        if self.data.has_key(name):
+            raise KeyError('An object named %s already exists' % name)
+        if self._num_objects is None:
+            self._num_objects = Length(len(self.data))
+        self.data[name] = other
+        self._num_objects.change(1)
+
+    def remove(self, name):
+        """Removes and returns an object, raising KeyError if missing."""
+        other = self.data[name]
+        if self._num_objects is None:
+            self._num_objects = Length(len(self.data))
+        del self.data[name]
+        self._num_objects.change(-1)
+        return other
+
+    __setitem__ = add
+    __delitem__ = remove
+
+    def __repr__(self):
+        klass = self.__class__
+        return '<%s.%s object %r at %#x>' % (
+            klass.__module__, klass.__name__, self.__name__, id(self))
+
+
+def forget_parent(obj):
+    """Drops the __parent__ and __name__ a Folder set on an object."""
+    changed = False
+    # A ghost's __dict__ is empty until its state is loaded
+    obj._p_activate()
+    for name in ('__parent__', '__name__'):
+        if name in obj.__dict__:
+            delattr(obj, name)
+            changed = True
+    return changed
+
+
+def migrate_folders(hub, checkpoint=None, batch_size=1000):
+    """
+    Converts what is left of the Folders stored by earlier versions.
+
+    The __parent__ and __name__ Folders set on topics, subscribers and
+    listeners are dropped, the folders of subscriptions held by topics
+    and subscribers are replaced with sets of interned URL ids, and the
+    content and feed index of topics are moved into separate feed bodies.
+
+    Arguments:
+        * hub: The hub to migrate
+        * checkpoint: Called after every ``batch_size`` migrated objects,
+                      e.g. to commit the transaction
+        * batch_size: How many objects are migrated between checkpoints
+
+    Returns a dict with the number of subscription folders converted
+    and objects cleaned.
+    """
+    counts = {'containers': 0, 'objects': 0}
+
+    def migrated(kind):
+        counts[kind] += 1
+        total = counts['containers'] + counts['objects']
+        if checkpoint is not None and total % batch_size == 0:
+            checkpoint()
+
+    for container in (hub.topics, hub.subscribers, hub.listeners):
+        if container is None:
+            continue
+        container._p_activate()
+        if '_order' in container.__dict__:
+            del container._order
+        for obj in container.values():
+            if forget_parent(obj):
+                migrated('objects')
+
+    if hub.topics is not None:
+        for topic in hub.topics.values():
+            if topic.id is None:
+                hub.upgrade_topic(topic)
+                migrated('containers')
+            if ('content' in topic.__dict__ or
+                    'feed_index' in topic.__dict__):
+                topic.set_content(topic.content, topic.feed_index)
+                migrated('objects')
+
+    if hub.subscribers is not None:
+        for subscriber in hub.subscribers.values():
+            if subscriber.id is None:
+                hub.upgrade_subscriber(subscriber)
+                migrated('containers')
+
+    if hub.leases is not None:
+        # Converts leases stored by URL
+        hub.get_leases()
+
+    logger.info('Converted %(containers)d containers, cleaned %(objects)d '
+                'objects' % counts)
+    return counts
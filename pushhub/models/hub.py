@@ -36,15 +36,25 @@ subscribers and topics.
 """
 import random
 import requests
+import time
 
 from string import ascii_letters, digits
 
+from BTrees.IIBTree import IITreeSet
+from BTrees.IOBTree import IOBTree
+from BTrees.LLBTree import LLBTree
+from BTrees.OOBTree import OOTreeSet
+from requests.exceptions import RequestException
 from zope.interface import Interface, implements
 from repoze.folder import Folder
 
+from .. import client
+from .. import delivery
+from ..fetcher import FetchEngine
 from .listener import Listener, Listeners
 from .topic import Topics, Topic
 from .subscriber import Subscribers, Subscriber
+from .urls import URLTable
 
 import logging
 
@@ -61,36 +71,100 @@ class Hub(Folder):
     __name__ = __parent__ = None
     title = "Hub"
 
+    # URLs of topics changed since subscribers were last notified. Hubs
+    # stored before this existed build it on first use.
+    changed_topics = None
+    # Topics are numbered in the order they are added to the hub, and the
+    # log maps each number to the topic URL. Hubs stored before this
+    # existed build it on first use.
+    topic_log = None
+    last_topic_sequence = 0
+    # Subscription leases: the lease key packing the subscriber and topic
+    # ids -> expiry time, and the same leases as (expiry, lease key) pairs
+    # ordered so the expired ones can be found without looking at the
+    # others. Hubs stored before leases existed create these on first
+    # use, and leases stored by URL are converted on first use.
+    leases = None
+    lease_index = None
+    # Leases are shortened by up to this fraction, at random, so that
+    # subscriptions made together don't all expire together.
+    lease_jitter = 0.1
+    # Topic and callback URLs interned as integers, which subscriptions
+    # are stored as. Hubs stored before this existed create it on first
+    # use, and upgrade their topics and subscribers as they are used.
+    url_table = None
+
     def __init__(self):
         super(Hub, self).__init__()
         self.topics = None
         self.subscribers = None
         self.listeners = Listeners()
+        self.changed_topics = OOTreeSet()
+        self.topic_log = IOBTree()
+        self.leases = LLBTree()
+        self.lease_index = OOTreeSet()
+        self.url_table = URLTable()
 
-    def publish(self, topic_url):
+    def publish(self, topic_url, pings=None):
         """
         Publish a topic to the hub.
+
+        If a PingBuffer is given, the time of the ping is buffered there
+        and written to the topic later, together with other pings,
+        rather than by this transaction.
         """
         topic = self.get_or_create_topic(topic_url)
-        topic.ping()
+        if pings is None:
+            topic.ping()
+        else:
+            pings.record(topic_url)
         logger.info('Published topic with URL %s' % topic_url)
 
     def notify_subscribers(self):
         """
-        Sends updates to each topic's subscribers to let them know
-        of new content.
+        Sends updates to the subscribers of each changed topic to let
+        them know of new content.
         """
         if self.topics is None:
             return
 
-        for url, topic in self.topics.items():
-            logger.debug('Notify subscriber for topic: %s' % url)
-            topic.notify_subscribers()
+        changed_topics = self.get_changed_topics()
+        for url in list(changed_topics):
+            topic = self.topics.get(url, None)
+            if topic is not None:
+                logger.debug('Notify subscriber for topic: %s' % url)
+                self.upgrade_topic(topic)
+                topic.notify_subscribers(self.get_url_table())
+            changed_topics.remove(url)
+
+    def get_changed_topics(self):
+        """
+        Returns the set of changed topic URLs, building it from the
+        topics' ``changed`` flags if this hub predates it.
+        """
+        if self.changed_topics is None:
+            self.changed_topics = OOTreeSet()
+            if self.topics is not None:
+                for url, topic in self.topics.items():
+                    if topic.changed:
+                        self.changed_topics.insert(url)
+        return self.changed_topics
+
+    def mark_changed(self, topics):
+        """Records which of the given topics changed on their last fetch."""
+        changed_topics = self.get_changed_topics()
+        for topic in topics:
+            if topic.changed:
+                changed_topics.insert(topic.url)
 
-    def subscribe(self, callback_url, topic_url, verify_callbacks=True):
+    def subscribe(self, callback_url, topic_url, verify_callbacks=True,
+                  lease_seconds=None):
         """
         Subscribe a subscriber to a topic
 
+        If lease_seconds is given, the subscription expires after that
+        long unless it is renewed.
+
         Returns:
             True if subscription verification is successful, False otherwise.
         """
@@ -98,59 +172,218 @@ class Hub(Folder):
         subscriber = self.get_or_create_subscriber(callback_url)
 
         if verify_callbacks:
-            verified = self.verify_subscription(subscriber, topic, "subscribe")
+            verified = self.verify_subscription(subscriber, topic,
+                                                "subscribe", lease_seconds)
         else:
             verified = True
 
         if verified:
-            try:
-                subscriber.topics.add(topic_url, topic)
+            # if the subscription already exists,
+            # this might mean an intent to renew lease
+            if subscriber.topics.insert(topic.id):
                 topic.add_subscriber(subscriber)
                 logger.info('Added subscriber with callback %s to topic %s' % (callback_url, topic_url))
-            except KeyError:
-                # subscription already exists
-                # this might mean an intent to renew lease
-                pass
+            self.set_lease(callback_url, topic_url, lease_seconds)
         return verified
 
-    def unsubscribe(self, callback_url, topic_url):
+    def unsubscribe(self, callback_url, topic_url, verify_callbacks=True):
         """
         Unsubscribe a subscriber to a topic
 
+        Returns:
+            True if unsubscription verification is successful, False
+            otherwise.
         """
         topic = self.get_or_create_topic(topic_url)
         subscriber = self.get_or_create_subscriber(callback_url)
 
-        verified = self.verify_subscription(subscriber, topic, "unsubscribe")
+        if verify_callbacks:
+            verified = self.verify_subscription(subscriber, topic,
+                                                "unsubscribe")
+        else:
+            verified = True
         if verified:
             try:
-                subscriber.topics.remove(topic_url, topic)
+                subscriber.topics.remove(topic.id)
                 topic.remove_subscriber(subscriber)
             except KeyError:
                 # unsubcribed from this topic already
                 pass
+            self.set_lease(callback_url, topic_url, None)
         return verified
 
-    def verify_subscription(self, subscriber, topic, mode):
+    def jitter_lease(self, lease_seconds):
+        """
+        Shortens a requested lease by a random fraction of up to
+        lease_jitter, so renewals of leases granted together spread out.
+        """
+        jitter = random.uniform(0, self.lease_jitter)
+        return max(1, int(lease_seconds * (1 - jitter)))
+
+    @staticmethod
+    def lease_key(subscriber_id, topic_id):
+        """Packs the ids of a subscriber and a topic into one integer."""
+        return (subscriber_id << 32) | topic_id
+
+    @staticmethod
+    def lease_ids(key):
+        """Returns the (subscriber id, topic id) packed into a lease key."""
+        return key >> 32, key & 0xffffffff
+
+    def get_leases(self):
+        """
+        Returns the lease and expiry index BTrees, creating them if this
+        hub predates leases.
+        """
+        if self.leases is None:
+            self.leases = LLBTree()
+            self.lease_index = OOTreeSet()
+        elif not isinstance(self.leases, LLBTree):
+            self.upgrade_leases()
+        return self.leases, self.lease_index
+
+    def upgrade_leases(self):
+        """
+        Replaces leases stored by callback and topic URL with leases
+        keyed by the ids of the subscriber and topic.
+        """
+        urls = self.get_url_table()
+        old_leases = self.leases
+        self.leases = LLBTree()
+        self.lease_index = OOTreeSet()
+        for (callback_url, topic_url), expires in old_leases.items():
+            key = self.lease_key(urls.intern(callback_url),
+                                 urls.intern(topic_url))
+            self.leases[key] = expires
+            self.lease_index.insert((expires, key))
+        return len(self.leases)
+
+    def get_lease(self, callback_url, topic_url):
+        """
+        Returns when a subscription expires, or None if it has no lease.
+        """
+        if self.leases is None:
+            return None
+        leases, lease_index = self.get_leases()
+        urls = self.get_url_table()
+        subscriber_id = urls.id_for(callback_url)
+        topic_id = urls.id_for(topic_url)
+        if subscriber_id is None or topic_id is None:
+            return None
+        return leases.get(self.lease_key(subscriber_id, topic_id))
+
+    def set_lease(self, callback_url, topic_url, lease_seconds, now=None):
+        """
+        Sets when a subscription expires, replacing any earlier lease.
+        A lease_seconds of None removes the lease, so the subscription
+        doesn't expire.
+        """
+        leases, lease_index = self.get_leases()
+        urls = self.get_url_table()
+        key = self.lease_key(urls.intern(callback_url),
+                             urls.intern(topic_url))
+        expires = leases.get(key)
+        if expires is not None:
+            lease_index.remove((expires, key))
+            del leases[key]
+        if lease_seconds is None:
+            return None
+        if now is None:
+            now = time.time()
+        expires = int(now + lease_seconds)
+        leases[key] = expires
+        lease_index.insert((expires, key))
+        return expires
+
+    def reap_expired_leases(self, now=None, limit=None):
+        """
+        Removes subscriptions whose lease has expired.
+
+        Only the expired leases are looked at. At most limit
+        subscriptions are removed if it is given, so a large backlog can
+        be reaped over several transactions.
+
+        Returns the number of subscriptions removed.
+        """
+        if self.leases is None:
+            return 0
+        leases, lease_index = self.get_leases()
+        if now is None:
+            now = time.time()
+
+        expired = []
+        for entry in lease_index:
+            if entry[0] > now:
+                break
+            expired.append(entry)
+            if limit is not None and len(expired) >= limit:
+                break
+
+        urls = self.get_url_table()
+        for expires, key in expired:
+            lease_index.remove((expires, key))
+            del leases[key]
+            subscriber_id, topic_id = self.lease_ids(key)
+            callback_url = urls.url_for(subscriber_id)
+            topic_url = urls.url_for(topic_id)
+            topic = self.topics.get(topic_url, None)
+            subscriber = self.subscribers.get(callback_url, None)
+            if topic is None or subscriber is None:
+                continue
+            self.upgrade_topic(topic)
+            self.upgrade_subscriber(subscriber)
+            try:
+                subscriber.topics.remove(topic.id)
+                topic.remove_subscriber(subscriber)
+            except KeyError:
+                pass
+            logger.info('Lease expired for subscriber %s to topic %s'
+                        % (callback_url, topic_url))
+        return len(expired)
+
+    def verify_subscription(self, subscriber, topic, mode,
+                            lease_seconds=None):
         """Verify that this is a real request by a subscriber.
 
         Args:
             subscriber: (Subscriber) The subscriber making the request
             topic: (Topic) The topic being subscribed to
             mode: (string) Either 'subscribe' or 'unsubscribe'
-            challenge: (string) A random string the subscriber must return
-                in the request body
+            lease_seconds: (int) The lease granted, if any
+
+        Returns:
+            True if intent is verified, False otherwise
+        """
+        return self.verify_intent(subscriber.callback_url, topic.url, mode,
+                                  lease_seconds)
+
+    @classmethod
+    def verify_intent(cls, callback_url, topic_url, mode,
+                      lease_seconds=None):
+        """Verify a subscription request using only its URLs.
+
+        This needs no hub state, so it can run outside of a ZODB
+        connection, e.g. on a verifier thread.
+
+        Args:
+            callback_url: (string) The subscriber's callback URL
+            topic_url: (string) The URL of the topic
+            mode: (string) Either 'subscribe' or 'unsubscribe'
+            lease_seconds: (int) The lease granted, sent to the subscriber
+                so it knows when to renew
 
         Returns:
             True if intent is verified, False otherwise
         """
-        challenge = self.get_challenge_string()
+        challenge = cls.get_challenge_string()
         qs = {
             "hub.mode": mode,
-            "hub.topic": topic.url,
+            "hub.topic": topic_url,
             "hub.challenge": challenge
         }
-        r = requests.get(subscriber.callback_url, params=qs)
+        if lease_seconds is not None:
+            qs["hub.lease_seconds"] = lease_seconds
+        r = client.get(callback_url, params=qs)
         if not r.status_code == requests.codes.ok:
             return False
 
@@ -171,8 +404,34 @@ class Hub(Folder):
         if not topic:
             topic = Topic(topic_url)
             self.topics.add(topic_url, topic)
+            self.log_topic(topic)
 
-        return topic
+        return self.upgrade_topic(topic)
+
+    def get_topic_log(self):
+        """
+        Returns the log of topic sequence numbers to URLs, numbering
+        the existing topics if this hub predates it.
+        """
+        if self.topic_log is None:
+            self.topic_log = IOBTree()
+            if self.topics is not None:
+                for topic in self.topics.values():
+                    self.log_topic(topic)
+        return self.topic_log
+
+    def log_topic(self, topic):
+        """
+        Gives a topic the next sequence number, unless it already has
+        one, and returns its number.
+        """
+        # Creating the log of a hub that predates it numbers the topic
+        topic_log = self.get_topic_log()
+        if topic.sequence is None:
+            self.last_topic_sequence += 1
+            topic.sequence = self.last_topic_sequence
+            topic_log[topic.sequence] = topic.url
+        return topic.sequence
 
     def get_or_create_subscriber(self, callback_url):
         """
@@ -187,6 +446,43 @@ class Hub(Folder):
             subscriber = Subscriber(callback_url)
             self.subscribers.add(callback_url, subscriber)
 
+        return self.upgrade_subscriber(subscriber)
+
+    def get_url_table(self):
+        """
+        Returns the table of interned URLs, creating it if this hub
+        predates it.
+        """
+        if self.url_table is None:
+            self.url_table = URLTable()
+        return self.url_table
+
+    def upgrade_topic(self, topic):
+        """
+        Interns the URL of a topic, and replaces the folder of subscribers
+        kept by topics stored before URLs were interned with a set of
+        their ids.
+        """
+        if topic.id is None:
+            urls = self.get_url_table()
+            topic.id = urls.intern(topic.url)
+            if not isinstance(topic.subscribers, IITreeSet):
+                topic.subscribers = IITreeSet(
+                    [urls.intern(url) for url in topic.subscribers.keys()])
+        return topic
+
+    def upgrade_subscriber(self, subscriber):
+        """
+        Interns the callback URL of a subscriber, and replaces the folder
+        of topics kept by subscribers stored before URLs were interned
+        with a set of their ids.
+        """
+        if subscriber.id is None:
+            urls = self.get_url_table()
+            subscriber.id = urls.intern(subscriber.callback_url)
+            if not isinstance(subscriber.topics, IITreeSet):
+                subscriber.topics = IITreeSet(
+                    [urls.intern(url) for url in subscriber.topics.keys()])
         return subscriber
 
     def get_or_create_listener(self, callback_url):
@@ -196,59 +492,171 @@ class Hub(Folder):
             listener = Listener(callback_url)
             self.listeners.add(callback_url, listener)
 
+        return self.upgrade_listener(listener)
+
+    def upgrade_listener(self, listener):
+        """
+        Replaces the folder of topics kept by listeners stored before
+        topics were numbered with the highest number among them.
+
+        Existing topics are numbered in the order of their URLs, not the
+        order they were added, so topics numbered below that which the
+        listener wasn't told about are kept to be sent when it next
+        registers.
+        """
+        if listener.high_water is None:
+            high_water = 0
+            if listener.topics is not None:
+                for topic in listener.topics.values():
+                    high_water = max(high_water, self.log_topic(topic))
+                unsent = IITreeSet()
+                topic_log = self.get_topic_log()
+                for sequence, topic_url in topic_log.items(max=high_water):
+                    if topic_url not in listener.topics:
+                        unsent.insert(sequence)
+                if unsent:
+                    listener.unsent = unsent
+                del listener.topics
+            listener.high_water = high_water
         return listener
 
-    def get_challenge_string(self):
+    @staticmethod
+    def get_challenge_string():
         """Generates a random challenge string"""
         choices = ascii_letters + digits
         return ''.join(random.choice(choices) for i in xrange(128))
 
-    def fetch_all_content(self, hub_url, only_failed=False):
+    def fetch_all_content(self, hub_url, only_failed=False, engine=None,
+                          checkpoint=None, batch_size=100):
         """
-        Fetches the content at all topic URLs.
+        Fetches the content at all topic URLs concurrently.
+
+        Arguments:
+            * hub_url: The hub address reported to publishers
+            * only_failed: Only fetch topics whose last fetch failed
+            * engine: The FetchEngine to use; a default one if None
+            * checkpoint: Called after every ``batch_size`` fetched
+                          topics, e.g. to commit the transaction
+
+        Returns the sweep statistics reported by the engine.
         """
-        topic_entries = self.topics.items()
+        topics = self.topics.values()
         if only_failed:
-            topic_entries = [t for t in self.topics.items() if t[1].failed]
+            topics = [t for t in topics if t.failed]
 
-        for topic_id, topic in topic_entries:
-            try:
-                topic.fetch(hub_url)
-            except ValueError:
-                continue
+        if engine is None:
+            engine = FetchEngine()
+
+        # Topics are marked changed as they are applied, so each
+        # checkpoint commits the marks along with the content.
+        return engine.fetch_topics(
+            topics, hub_url, checkpoint=checkpoint, batch_size=batch_size,
+            applied=lambda topic: self.mark_changed([topic]))
 
     def fetch_content(self, topic_urls, hub_url):
         """
         Takes a list of topic urls and attempts to fetch their content.
         """
+        self.apply_responses(self.fetch_responses(topic_urls, hub_url))
+
+    def fetch_responses(self, topic_urls, hub_url):
+        """
+        Fetches the content at the given topic URLs without changing the
+        topics, so that a transaction retried after a conflict can apply
+        the same responses again instead of fetching them again.
 
+        Returns a list of (topic URL, response, error) tuples, where
+        exactly one of response and error is set.
+        """
+        fetches = []
         for topic_url in topic_urls:
             topic = self.topics.get(topic_url, None)
 
             if not topic:
                 continue
 
+            headers = topic.request_headers(hub_url)
             try:
-                topic.fetch(hub_url)
+                response = client.get(topic_url, headers=headers)
+            except RequestException as e:
+                fetches.append((topic_url, None, e))
+            else:
+                fetches.append((topic_url, response, None))
+        return fetches
+
+    def apply_responses(self, fetches):
+        """
+        Updates topics from the results of fetch_responses.
+        """
+        for topic_url, response, error in fetches:
+            topic = self.topics.get(topic_url, None)
+
+            if not topic:
+                continue
+
+            if error is not None:
+                topic.fetch_failed()
+                continue
+
+            try:
+                topic.update(response)
             except ValueError:
                 continue
 
+            self.mark_changed([topic])
+
     def register_listener(self, callback_url):
         listener = self.get_or_create_listener(callback_url)
         if not self.topics:
             return
-        for topic in self.topics.values():
-            if topic.url in listener.topics.keys():
-                continue
-            listener.topics.add(topic.url, topic)
+        calls = []
+        topic_log = self.get_topic_log()
+        if listener.unsent is not None:
+            # Topics the listener wasn't told about, numbered below the
+            # ones it was
+            for sequence in listener.unsent:
+                topic = self.topics[topic_log[sequence]]
+                headers, key = topic.store_request_data()
+                calls.append(listener.notification(headers, key))
+            listener.unsent = None
+        # Only topics added since the listener was last told about one
+        for sequence, topic_url in topic_log.items(listener.high_water + 1):
+            topic = self.topics[topic_url]
+            listener.high_water = sequence
             logger.info('Added listener %s to topic %s' % (callback_url,
-                                                           topic.url))
-            listener.notify(topic)
+                                                           topic_url))
+            headers, key = topic.store_request_data()
+            calls.append(listener.notification(headers, key))
+        self.queue_listener_notifications(calls)
         logger.info('Registered listener with URL %s' % callback_url)
 
     def notify_listeners(self, topics):
+        """
+        Queues a notification of each topic for every listener.
+
+        Each topic's content is stored once for all of its notifications,
+        and the notifications are queued together in one batch.
+        """
+        listeners = list(self.listeners.values())
+        if not listeners:
+            return
+        calls = []
         for topic in topics:
-            for url, listener in self.listeners.items():
-                if topic.url not in listener.topics.keys():
-                    listener.topics.add(topic.url, topic)
-                listener.notify(topic)
+            sequence = self.log_topic(topic)
+            headers, key = topic.store_request_data()
+            for listener in listeners:
+                self.upgrade_listener(listener)
+                listener.mark_sent(sequence)
+                calls.append(listener.notification(headers, key))
+        self.queue_listener_notifications(calls)
+
+    def queue_listener_notifications(self, calls):
+        """
+        Queues listener notifications to be sent by the delivery worker,
+        which sends each listener's notifications in the order queued.
+        They are queued once the transaction commits.
+        """
+        delivery.after_commit(delivery.enqueue_many,
+                              'pushhub.delivery.deliver', calls,
+                              meta={'ordered': True})
+        logger.debug('%d items to be placed on listener queue' % len(calls))
@@ -33,21 +33,20 @@ Listeners are subscribers that wish to be notified any time
 a new topic is added to the hub.
 """
 
+from BTrees.IIBTree import IITreeSet
 from persistent import Persistent
-from repoze.folder import Folder
-import requests
 
 from zope.interface import Interface, implements
 
-from .topic import Topics
+from .container import Container
 from ..utils import is_valid_url
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-class Listeners(Folder):
-    """Folder to hold listeners"""
+class Listeners(Container):
+    """Container to hold listeners"""
     title = "Listeners"
 
 
@@ -59,16 +58,44 @@ class IListener(Interface):
 class Listener(Persistent):
     implements(IListener)
 
+    # The sequence number of the newest topic the listener has been told
+    # about. Listeners stored before this existed have a folder of topics
+    # instead, which the hub replaces.
+    high_water = None
+    topics = None
+    # Numbers of topics below high_water that the listener wasn't told
+    # about, sent when it next registers: topics numbered out of order
+    # for listeners stored before topics were numbered, and topics not
+    # yet published when a later one was
+    unsent = None
+
     def __init__(self, callback_url):
         if not is_valid_url(callback_url):
             raise ValueError(
                 'Malformed URL: %s'
             )
         self.callback_url = callback_url
-        self.topics = Topics()
-
-    def notify(self, topic):
-        headers, data = topic.get_request_data()
-        logger.debug('Notify listener: %s' % self.callback_url)
-        response = requests.get(self.callback_url, data=data, headers=headers)
-        return response
+        self.high_water = 0
+
+    def mark_sent(self, sequence):
+        """
+        Records that the listener was told about the topic numbered
+        ``sequence``, keeping any numbers it skips over as unsent.
+        """
+        if sequence > self.high_water:
+            if sequence > self.high_water + 1:
+                if self.unsent is None:
+                    self.unsent = IITreeSet()
+                self.unsent.update(xrange(self.high_water + 1, sequence))
+            self.high_water = sequence
+        elif self.unsent is not None and sequence in self.unsent:
+            self.unsent.remove(sequence)
+            if not self.unsent:
+                self.unsent = None
+
+    def notification(self, headers, key):
+        """
+        Returns the arguments of the delivery job that notifies this
+        listener of a topic's stored content.
+        """
+        return (self.callback_url, key, headers, 'GET')
@@ -31,21 +31,21 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 Classes that describe subscribers to the Hub's topics.
 
-Subscribers have a list of topics they are subscribed to, and callback URL
-that will be hit when any of those topics are updated.
+Subscribers have a set of ids of the topics they are subscribed to, and
+a callback URL that will be hit when any of those topics are updated.
 """
 from datetime import datetime
 
+from BTrees.IIBTree import IITreeSet
 from persistent import Persistent
-from repoze.folder import Folder
 from zope.interface import Interface, implements
 
 from pushhub.utils import is_valid_url
-from .topic import Topics
+from .container import Container
 
 
-class Subscribers(Folder):
-    """Folder to hold our subscribers"""
+class Subscribers(Container):
+    """Container to hold our subscribers"""
     title = "Subscribers"
 
 
@@ -57,6 +57,10 @@ class ISubscriber(Interface):
 class Subscriber(Persistent):
     implements(ISubscriber)
 
+    # Id the hub interned the callback URL as. Subscribers stored before
+    # URLs were interned have none until the hub upgrades them.
+    id = None
+
     def __repr__(self):
         return "<Subscriber '%s'>" % self.callback_url
 
@@ -64,5 +68,5 @@ class Subscriber(Persistent):
         if not is_valid_url(callback_url):
             raise ValueError
         self.callback_url = callback_url
-        self.topics = Topics()
+        self.topics = IITreeSet()
         self.created_date = datetime.now()
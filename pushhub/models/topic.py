@@ -32,33 +32,83 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 A topic is a link published to the hub.
 
 It has a last-updated timestamp, as well as the last-seen content for
-generating diffs, so the hub knows what to send out to subscribers.
+generating diffs, so the hub knows what to send out to subscribers. The
+content is kept in a FeedBody of its own, loaded only when it is read.
 """
 
 from datetime import datetime
+from hashlib import sha1
 from urlparse import urlparse
 
+from BTrees.IIBTree import IITreeSet
+from BTrees.Length import Length
 from feedparser import parse
 from persistent import Persistent
-import requests
-from requests.exceptions import ConnectionError
-from repoze.folder import Folder
+from requests.exceptions import RequestException
 from zope.interface import Interface, implements
 from time import mktime
-from redis import Redis
-from rq import Queue
 
+from .. import client
+from .. import delivery
+from .body import FeedBody
+from .container import Container
+from ..utils import Counters
 from ..utils import FeedComparator
+from ..utils import FeedIndex
 from ..utils import Atom1FeedKwargs
+from ..utils import gzip_compress
 
 import logging
 logger = logging.getLogger(__name__)
 
+# How often a fetched body matched the previous one, skipping the parse
+digest_stats = Counters('hits', 'misses')
 
-class Topics(Folder):
+
+class Topics(Container):
     title = u"Topics"
 
 
+class TopicStatus(Persistent):
+    """
+    The state of a topic written by every publish ping and fetch.
+
+    It is kept apart from the topic, so those writes don't conflict with
+    changes to the topic itself, and every field only moves forward, so
+    concurrent writes to it are resolved by keeping the later value of
+    each instead of raising ConflictError.
+    """
+
+    def __init__(self):
+        self.last_pinged = None
+        # How many times the content changed, and how many of those
+        # changes subscribers have been notified of
+        self.changes = 0
+        self.notified = 0
+
+    @property
+    def changed(self):
+        """Whether there are changes subscribers haven't been told of."""
+        return self.changes > self.notified
+
+    def mark_changed(self):
+        # Every change is counted, even if subscribers haven't been told
+        # of the last one yet, so a change made while they are being
+        # notified isn't lost.
+        self.changes += 1
+
+    def mark_notified(self):
+        self.notified = self.changes
+
+    def _p_resolveConflict(self, old, committed, new):
+        resolved = dict(new)
+        resolved['last_pinged'] = max(committed['last_pinged'],
+                                      new['last_pinged'])
+        for name in ('changes', 'notified'):
+            resolved[name] = max(committed[name], new[name])
+        return resolved
+
+
 class ITopic(Interface):
     """Marker interface for topics."""
     pass
@@ -67,6 +117,27 @@ class ITopic(Interface):
 class Topic(Persistent):
     implements(ITopic)
 
+    # Cache validators from the last successful fetch. Class defaults
+    # keep topics stored before they existed working.
+    etag = None
+    last_modified = None
+    # Digest of the last raw body that was accepted
+    content_digest = None
+    # Order in which the topic was added to the hub, set by the hub
+    sequence = None
+    # Id the hub interned the topic URL as. Topics stored before URLs
+    # were interned have none until the hub upgrades them.
+    id = None
+    # The ping and change state, and the number of subscribers, are kept
+    # in their own objects so concurrent publishes and subscribes don't
+    # conflict. Topics stored before this have them in their own state
+    # until they are first written.
+    status = None
+    subscriber_counter = None
+    # The FeedBody holding the content. Topics stored before bodies were
+    # kept apart have their content in their own state until it changes.
+    body = None
+
     def __repr__(self):
         return "<Topic %s>" % self.url
 
@@ -86,50 +157,100 @@ class Topic(Persistent):
         self.timestamp = None
         self.content_type = ''
         self.content = None
-        self.changed = False
-        self.subscribers = Folder()
-        self.subscriber_count = 0
-        self.last_pinged = None
+        self.status = TopicStatus()
+        self.subscribers = IITreeSet()
+        self.subscriber_counter = Length()
         self.failed = False
         self.ping()
 
     def fetch(self, hub_url):
         """Fetches the content from the publisher's provided URL"""
+        headers = self.request_headers(hub_url)
 
+        try:
+            response = client.get(self.url, headers=headers)
+        except RequestException:
+            self.fetch_failed()
+            return
+
+        self.update(response)
+
+    def request_headers(self, hub_url):
+        """Headers to send when fetching this topic's content"""
         user_agent = "PuSH Hub (+%s; %s)" % (hub_url, self.subscriber_count)
 
         headers = {'User-Agent': user_agent}
 
-        try:
-            response = requests.get(self.url, headers=headers)
+        # Only ask for a conditional response if we still have the
+        # content the validators belong to.
+        if self.has_content:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+
+        return headers
+
+    def fetch_failed(self):
+        """Flags the topic after its URL could not be reached."""
+        logger.warning('Could not connect to topic URL %s' % self.url)
+        self.failed = True
+
+    def update(self, response):
+        """Updates the topic from a response fetched from its URL.
+
+        Raises ValueError if the response isn't a valid feed.
+        """
+        # Only written when it changes, so an unchanged feed doesn't
+        # write the topic at all
+        if self.failed:
             self.failed = False
-        except ConnectionError:
-            logger.warning('Could not connect to topic URL %s' % self.url)
-            self.failed = True
+
+        if response.status_code == 304:
+            logger.debug('Topic %s not modified' % self.url)
             return
 
+        digest = sha1(response.content or '').hexdigest()
+        if self.has_content and digest == self.content_digest:
+            digest_stats.incr('hits')
+            logger.debug('Topic %s unchanged' % self.url)
+            return
+        digest_stats.incr('misses')
+
         parsed = self.parse(response.content)
 
         if not parsed or parsed.bozo:
             # Should probably set a flag or log something here, too.
             raise ValueError
 
-        if not self.content:
+        feed_index = FeedIndex(parsed)
+
+        if not self.has_content:
             newest_entries = parsed
             self.changed = True
         else:
-            parsed_old = self.parse(self.content)
+            # Diff against the index of the last document, only parsing
+            # the old content for topics stored before indexes existed.
+            past = self.feed_index
+            if past is None:
+                past = self.parse(self.content)
             # assemble_newest_entries will set changed flag if this isn't
             # the first fetch
-            newest_entries = self.assemble_newest_entries(parsed, parsed_old)
+            newest_entries = self.assemble_newest_entries(parsed, past)
 
         if not self.content_type:
             self.content_type = parsed.version
 
-        if self.changed and self.content:
-            self.content = self.generate_feed(newest_entries)
+        if self.changed and self.has_content:
+            content = self.generate_feed(newest_entries)
         else:
-            self.content = response.content
+            content = response.content
+        self.set_content(content, feed_index)
+
+        response_headers = response.headers or {}
+        self.etag = response_headers.get('ETag')
+        self.last_modified = response_headers.get('Last-Modified')
+        self.content_digest = digest
 
         self.timestamp = datetime.now()
         logger.info('Fetched content for topic %s', self.url)
@@ -142,24 +263,117 @@ class Topic(Persistent):
 
         return parsed
 
+    def _get_content(self):
+        if self.body is None:
+            return self.__dict__.get('content')
+        return self.body.data
+
+    def set_content(self, content, feed_index=None):
+        """
+        Stores a new revision of the content, along with the FeedIndex of
+        the fetched feed it came from.
+        """
+        # Each revision gets a new body, so earlier revisions aren't
+        # rewritten and can be packed away. Content and indexes of topics
+        # stored before bodies were kept apart are dropped from their
+        # state, which a ghost only has once it is loaded.
+        self._p_activate()
+        self.__dict__.pop('content', None)
+        self.__dict__.pop('feed_index', None)
+        if content:
+            self.body = FeedBody(content, index=feed_index)
+        else:
+            self.body = None
+
+    content = property(_get_content, set_content)
+
+    @property
+    def feed_index(self):
+        """
+        The FeedIndex of the last fetched feed, which new fetches are
+        diffed against. It is kept with the body, so reading it loads the
+        body.
+        """
+        index = None
+        if self.body is not None:
+            index = self.body.index
+        if index is None:
+            index = self.__dict__.get('feed_index')
+        return index
+
+    @property
+    def has_content(self):
+        """Whether the topic has content, without loading it."""
+        if self.body is None:
+            return bool(self.__dict__.get('content'))
+        return True
+
     def ping(self):
         """Registers the last time a publisher pinged the hub for this topic.
         """
-        self.last_pinged = datetime.now()
+        self.get_status().last_pinged = datetime.now()
+
+    def get_status(self):
+        """
+        Returns the topic's status, moving the ping and change state
+        into one if this topic predates it.
+        """
+        if self.status is None:
+            status = TopicStatus()
+            status.last_pinged = self.__dict__.pop('last_pinged', None)
+            if self.__dict__.pop('changed', False):
+                status.changes = 1
+            self.status = status
+        return self.status
+
+    @property
+    def last_pinged(self):
+        return self.get_status().last_pinged
+
+    def _get_changed(self):
+        return self.get_status().changed
+
+    def _set_changed(self, changed):
+        # Setting an attribute writes the topic too, so code that
+        # otherwise leaves the topic alone uses the status directly.
+        if changed:
+            self.get_status().mark_changed()
+        else:
+            self.get_status().mark_notified()
+
+    changed = property(_get_changed, _set_changed)
+
+    def get_subscriber_counter(self):
+        """
+        Returns the Length counting the subscribers, moving the count
+        into one if this topic predates it.
+        """
+        if self.subscriber_counter is None:
+            count = self.__dict__.pop('subscriber_count', 0)
+            self.subscriber_counter = Length(count)
+        return self.subscriber_counter
+
+    @property
+    def subscriber_count(self):
+        return self.get_subscriber_counter()()
 
     def add_subscriber(self, subscriber):
         """Increment subscriber count so reporting on content fetch is easier.
+
+        Raises KeyError if the subscriber was already added.
         """
-        self.subscriber_count += 1
-        self.subscribers.add(subscriber.callback_url, subscriber)
+        if not self.subscribers.insert(subscriber.id):
+            raise KeyError(subscriber.callback_url)
+        self.get_subscriber_counter().change(1)
 
     def remove_subscriber(self, subscriber):
         """Sanely remove subscribers from the count
         """
-        self.subscribers.remove(subscriber.callback_url)
-        if self.subscriber_count <= 0:
+        self.subscribers.remove(subscriber.id)
+        counter = self.get_subscriber_counter()
+        if counter() <= 0:
             raise ValueError
-        self.subscriber_count -= 1
+        counter.change(-1)
 
     def assemble_newest_entries(self, parsed, parsed_old):
         if not parsed or not parsed_old:
@@ -181,6 +395,10 @@ class Topic(Persistent):
 
         return metadata
 
+    # Entry fields generate_feed passes to add_item explicitly
+    generated_entry_fields = ('title', 'link', 'summary', 'id', 'author',
+                              'tags')
+
     def generate_feed(self, parsed_feed):
         self_links = [link['href'] for link
                      in parsed_feed['feed']['links']
@@ -204,24 +422,27 @@ class Topic(Persistent):
             except KeyError:
                 continue
 
+            # The remaining fields are passed through untouched; the
+            # parsed entry itself is never modified.
+            extra = dict(
+                (key, value) for key, value in entry.items()
+                if key not in self.generated_entry_fields
+            )
             new_feed.add_item(
-                entry.pop('title'),
-                entry.pop('link'),
-                entry.pop('summary', ''),
+                entry['title'],
+                entry['link'],
+                entry.get('summary', ''),
                 pubdate=updated,
-                unique_id=entry.pop('id', ''),
-                author_name=entry.pop('author', ''),
-                category=entry.pop('tags', []),
-                **entry
+                unique_id=entry.get('id', ''),
+                author_name=entry.get('author', ''),
+                category=entry.get('tags', []),
+                **extra
             )
         string = new_feed.writeString(parsed_feed['encoding'])
         return string
 
-    def get_request_data(self):
-        """
-        Return headers and body content useful for sending to a
-        subscriber or listener
-        """
+    def get_content_headers(self):
+        """Return the headers describing the content to a subscriber"""
         c_type = None
         if 'atom' in self.content_type:
             c_type = 'application/atom+xml'
@@ -233,50 +454,71 @@ class Topic(Persistent):
                 'Invalid content type. Only Atom or RSS are supported'
             )
 
-        headers = {'Content-Type': c_type}
+        return {'Content-Type': c_type}
+
+    def get_request_data(self):
+        """
+        Return headers and body content useful for sending to a
+        subscriber or listener
+        """
+        headers = self.get_content_headers()
         body = self.content
 
         return (headers, body)
 
-    def notify_subscribers(self):
+    def gzipped_content(self):
+        """
+        Return the content compressed with gzip. Bodies stored in gzip
+        are returned as stored, without decompressing them.
+        """
+        if self.body is None:
+            return gzip_compress(self.content or '')
+        return self.body.gzipped()
+
+    def store_request_data(self):
+        """
+        Stores the content for queued deliveries to share once the
+        transaction commits, returning the headers to send and the key
+        the content is stored under.
+        """
+        headers = self.get_content_headers()
+        payload = self.gzipped_content()
+        delivery.after_commit(delivery.store_payload, payload)
+        return (headers, delivery.payload_key(payload))
+
+    def notify_subscribers(self, urls):
         """
         Notify subscribers to this topic that the feed has been updated.
 
-        This will put the following data into a queue:
+        Arguments:
+            * urls: The hub's URLTable, to look up the callback URLs of
+                    the subscriber ids
+
+        Once the transaction commits, the updated feed is stored once,
+        then the following data is put into a queue for each subscriber:
             Subscriber callback URL
+            The key of the stored feed
             The feed content type
-            The updated feed entries
 
         The queue can process the requests as long as it has this information.
         """
 
-        if not self.subscribers:
+        if not len(self.subscribers):
             return
 
         if not self.changed:
             return
 
-        c_type = None
-        if 'atom' in self.content_type:
-            c_type = 'application/atom+xml'
-        elif 'rss' in self.content_type:
-            c_type = 'application/rss+xml'
-
-        if c_type is None:
-            raise ValueError(
-                'Invalid content type. Only Atom or RSS are supported'
-            )
-
-        q = Queue(connection=Redis())
-
-        headers = {'Content-Type': c_type}
-        body = self.content
+        headers, key = self.store_request_data()
 
-        for url, subscriber in self.subscribers.items():
-            q.enqueue('ucla.jobs.hub.post', url, body, headers)
-            logger.debug('Item placed on subscriber queue %s' % (url))
+        calls = [(url, key, headers)
+                 for url in urls.urls_for(self.subscribers)]
+        delivery.after_commit(delivery.enqueue_many,
+                              'pushhub.delivery.deliver', calls)
+        logger.debug('%d items to be placed on subscriber queue for %s' % (
+            len(calls), self.url))
 
         # We've notified all of our subscribers,
         # so we can set the flag to not notify them again
         # until another change
-        self.changed = False
+        self.get_status().mark_notified()
@@ -0,0 +1,96 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Interning of topic and callback URLs as integers.
+
+Each URL is stored once, in the hub's URLTable, and the subscriptions
+between topics and subscribers are kept as sets of these integer ids.
+"""
+import random
+
+from BTrees.IOBTree import IOBTree
+from BTrees.OIBTree import OIBTree
+from persistent import Persistent
+
+
+class URLTable(Persistent):
+    """
+    A two-way mapping of URLs to the integer ids they are interned as.
+
+    Ids are handed out sequentially from a random starting point kept
+    per connection, so URLs interned concurrently rarely write to the
+    same BTree buckets and conflict.
+    """
+    # The largest id an IITreeSet can hold
+    max_id = 2 ** 31 - 1
+
+    _v_next_id = None
+
+    def __init__(self):
+        self.ids = OIBTree()
+        self.urls = IOBTree()
+
+    def __len__(self):
+        return len(self.urls)
+
+    def __contains__(self, url):
+        return self.ids.has_key(url)
+
+    def intern(self, url):
+        """Returns the id of a URL, giving it one if it has none."""
+        url_id = self.ids.get(url)
+        if url_id is None:
+            url_id = self._new_id()
+            self.ids[url] = url_id
+            self.urls[url_id] = url
+        return url_id
+
+    def id_for(self, url, default=None):
+        """Returns the id of a URL, or default if it was never interned."""
+        return self.ids.get(url, default)
+
+    def url_for(self, url_id):
+        """Returns the URL with the given id, raising KeyError if none."""
+        return self.urls[url_id]
+
+    def urls_for(self, url_ids):
+        """Returns the URLs with the given ids, in the same order."""
+        urls = self.urls
+        return (urls[url_id] for url_id in url_ids)
+
+    def _new_id(self):
+        while True:
+            url_id = self._v_next_id
+            if url_id is None or url_id > self.max_id:
+                url_id = random.randint(0, self.max_id)
+            self._v_next_id = url_id + 1
+            if not self.urls.has_key(url_id):
+                return url_id
@@ -0,0 +1,201 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Buffering of publish ping times.
+
+Publishers may ping the hub several times a second for the same topic.
+Rather than each ping writing its time to the topic in its own
+transaction, the latest ping time of each topic is kept in memory here
+and written to the topics in a single transaction every few seconds.
+The buffer is flushed when the process exits.
+"""
+
+import atexit
+from datetime import datetime
+import threading
+
+import transaction
+from ZODB.POSException import ConflictError
+from zope.interface import Interface, implements
+
+from .models import appmaker
+from .utils import get_primary_database
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class IPingBuffer(Interface):
+    """Marker interface for the publish ping buffer"""
+    pass
+
+
+def apply_pings(hub, pings):
+    """
+    Records a mapping of topic URLs to ping times on a hub's topics,
+    keeping the later time if a topic has a newer one already.
+
+    Returns the number of topics changed.
+    """
+    if hub.topics is None:
+        return 0
+    count = 0
+    for topic_url, pinged in pings.items():
+        topic = hub.topics.get(topic_url, None)
+        if topic is None:
+            continue
+        status = topic.get_status()
+        if status.last_pinged is None or pinged > status.last_pinged:
+            status.last_pinged = pinged
+            count += 1
+    return count
+
+
+class PingBuffer(object):
+    implements(IPingBuffer)
+
+    def __init__(self, db, interval=5.0, attempts=3):
+        """
+        Collects publish ping times and writes them out periodically.
+
+        Arguments:
+            * db: The ZODB database holding the hub
+            * interval: Seconds between writes of the buffered pings
+            * attempts: How many times a write is tried on ConflictError
+        """
+        self.db = db
+        self.interval = interval
+        self.attempts = attempts
+        self.pings = {}
+        self.thread = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def start(self):
+        """Starts the flushing thread if it is not running yet."""
+        with self._lock:
+            if self.thread is not None:
+                return
+            self._stopping.clear()
+            self.thread = threading.Thread(
+                target=self._run,
+                name='pushhub-pings',
+            )
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """Stops the flushing thread, writing any buffered pings first."""
+        with self._lock:
+            thread = self.thread
+            self.thread = None
+        if thread is not None:
+            self._stopping.set()
+            thread.join()
+
+    def record(self, topic_url, pinged=None):
+        """
+        Buffers the time a topic was pinged, now unless pinged is given.
+        Only the latest time of each topic is kept.
+        """
+        if pinged is None:
+            pinged = datetime.now()
+        self.start()
+        with self._lock:
+            self._merge({topic_url: pinged})
+
+    def _merge(self, pings):
+        for topic_url, pinged in pings.items():
+            last = self.pings.get(topic_url)
+            if last is None or pinged > last:
+                self.pings[topic_url] = pinged
+
+    def flush(self):
+        """
+        Writes the buffered pings to the topics in one transaction,
+        retrying on write conflicts. Pings that could not be written
+        are kept for the next flush.
+
+        Returns the number of topics changed.
+        """
+        with self._lock:
+            pings, self.pings = self.pings, {}
+        if not pings:
+            return 0
+
+        for attempt in xrange(self.attempts):
+            conn = self.db.open()
+            try:
+                hub = appmaker(conn.root())
+                count = apply_pings(hub, pings)
+                transaction.commit()
+                logger.debug('Recorded pings of %d topics' % count)
+                return count
+            except ConflictError:
+                transaction.abort()
+                logger.info('Conflict recording pings of %d topics, '
+                            'attempt %d' % (len(pings), attempt + 1))
+            except Exception:
+                transaction.abort()
+                logger.exception('Failed recording pings of %d topics'
+                                 % len(pings))
+                break
+            finally:
+                conn.close()
+
+        with self._lock:
+            self._merge(pings)
+        return 0
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self.flush()
+        self.flush()
+
+
+def includeme(config):
+    """
+    Registers a PingBuffer for the primary ZODB database, if
+    pyramid_zodbconn has configured one.
+    """
+    db = get_primary_database(config)
+    if db is None:
+        return
+
+    settings = config.registry.settings
+    pings = PingBuffer(
+        db,
+        interval=float(settings.get('pushhub.ping_flush_interval', 5)),
+        attempts=int(settings.get('tm.attempts', 3)),
+    )
+    config.registry.registerUtility(pings, IPingBuffer)
+    # Write the pings still buffered when the process exits
+    atexit.register(pings.stop)
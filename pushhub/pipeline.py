@@ -0,0 +1,328 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Background processing of publish pings.
+
+A publish request only records the ping; the fetch, parse, diff and
+notification work for the pinged topics runs here, on a small pool of
+worker threads that each use their own ZODB connection and transaction.
+
+Repeated pings for a topic are coalesced, within the process and, with
+Redis locks, across processes, so a burst of pings costs one or two
+fetches rather than one each.
+"""
+
+from hashlib import sha1
+from Queue import Queue, Full
+import threading
+import time
+
+from redis.exceptions import RedisError
+import transaction
+from ZODB.POSException import ConflictError
+from zope.interface import Interface, implements
+
+from . import delivery
+from .models import appmaker
+from .utils import get_primary_database
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class IFetchPipeline(Interface):
+    """Marker interface for the publish processing pipeline"""
+    pass
+
+
+def process_topics(hub, topic_urls, hub_url, fetches=None):
+    """
+    Fetches the given topics and notifies listeners and subscribers
+    of the results.
+
+    If the results of hub.fetch_responses are given, e.g. from an earlier
+    attempt at the same transaction, they are applied instead of fetching
+    the topics again.
+    """
+    topics = [
+        hub.topics.get(url)
+        for url in topic_urls
+        if url in hub.topics
+    ]
+    if fetches is None:
+        fetches = hub.fetch_responses(topic_urls, hub_url)
+    hub.apply_responses(fetches)
+    hub.notify_listeners(topics)
+    hub.notify_subscribers()
+
+
+class FetchPipeline(object):
+    implements(IFetchPipeline)
+
+    def __init__(self, db, workers=4, attempts=3, max_pending=1000,
+                 debounce=0.5, connection=None, lock_timeout=60):
+        """
+        Processes published topics outside of the request that
+        reported them.
+
+        Each topic is fetched by one flight at a time. A ping for a topic
+        that is waiting to be fetched merges into that fetch, and a ping
+        for a topic being fetched has it fetched once more afterwards,
+        however many such pings arrive.
+
+        Arguments:
+            * db: The ZODB database holding the hub
+            * workers: How many batches are processed concurrently
+            * attempts: How many times a batch is tried on ConflictError
+            * max_pending: How many batches may wait before new ones are
+                           dropped (the next ping for a topic retries it)
+            * debounce: Seconds a batch waits before it is fetched, so
+                        that more pings for its topics can merge into it
+            * connection: A Redis connection used to lock topics while
+                          they are fetched, so that other processes
+                          merge their pings into the fetch too
+            * lock_timeout: Seconds after which a topic lock held by a
+                            process that went away expires
+        """
+        self.db = db
+        self.workers = workers
+        self.attempts = attempts
+        self.debounce = debounce
+        self.connection = connection
+        self.lock_timeout = lock_timeout
+        self.queue = Queue(max_pending)
+        self.threads = []
+        self._lock = threading.Lock()
+        # Topic URLs waiting to be fetched, being fetched, and being
+        # fetched but pinged again since (mapped to their hub URL)
+        self.pending = set()
+        self.running = set()
+        self.again = {}
+        self._flights = threading.Lock()
+
+    def start(self):
+        """Starts the worker threads if they are not running yet."""
+        with self._lock:
+            if self.threads:
+                return
+            for i in xrange(self.workers):
+                thread = threading.Thread(
+                    target=self._work,
+                    name='pushhub-fetch-%d' % i,
+                )
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self):
+        """Stops the worker threads once the pending batches are done."""
+        with self._lock:
+            for thread in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+
+    def join(self):
+        """Blocks until every submitted batch has been processed."""
+        self.queue.join()
+
+    def submit(self, topic_urls, hub_url):
+        """
+        Queues a batch of topic URLs for processing. Topics that are
+        already waiting or being fetched are merged into those fetches.
+
+        Returns False if the pipeline is saturated and the batch was
+        dropped.
+        """
+        self.start()
+        return self._enqueue(topic_urls, hub_url)
+
+    def _enqueue(self, topic_urls, hub_url):
+        with self._flights:
+            urls = []
+            for url in topic_urls:
+                if url in self.pending or url in urls:
+                    continue
+                if url in self.running:
+                    self.again[url] = hub_url
+                    continue
+                urls.append(url)
+            if not urls:
+                return True
+            try:
+                self.queue.put_nowait(
+                    (urls, hub_url, time.time() + self.debounce))
+            except Full:
+                logger.warning('Fetch pipeline full, dropped topics %s'
+                               % (urls,))
+                return False
+            self.pending.update(urls)
+        return True
+
+    def _work(self):
+        while True:
+            batch = self.queue.get()
+            try:
+                if batch is None:
+                    return
+                topic_urls, hub_url, due = batch
+                wait = due - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                self._fly(topic_urls, hub_url)
+            finally:
+                self.queue.task_done()
+
+    def _fly(self, topic_urls, hub_url):
+        with self._flights:
+            self.pending.difference_update(topic_urls)
+            self.running.update(topic_urls)
+        locks = {}
+        try:
+            locks = self._claim(topic_urls, hub_url)
+            claimed = [url for url in topic_urls if url in locks]
+            if claimed:
+                self.process(claimed, hub_url)
+        finally:
+            again = self._release(locks)
+            with self._flights:
+                self.running.difference_update(topic_urls)
+                for url in topic_urls:
+                    if url in self.again:
+                        again[url] = self.again.pop(url)
+        for url, again_hub_url in again.items():
+            self._enqueue([url], again_hub_url)
+
+    def lock_key(self, topic_url, kind='lock'):
+        """Returns a Redis key holding part of a topic's fetch state."""
+        if isinstance(topic_url, unicode):
+            topic_url = topic_url.encode('utf-8')
+        return 'pushhub:fetch:%s:%s' % (kind, sha1(topic_url).hexdigest())
+
+    def _claim(self, topic_urls, hub_url):
+        """
+        Takes the Redis lock of each topic. A topic another process is
+        fetching is flagged for that process to fetch again instead.
+
+        Returns a dict mapping the claimed topics to their locks, which
+        are None when there is no Redis connection to lock with.
+        """
+        if self.connection is None:
+            return dict.fromkeys(topic_urls)
+        locks = {}
+        for url in topic_urls:
+            lock = self.connection.lock(self.lock_key(url),
+                                        timeout=self.lock_timeout)
+            try:
+                if lock.acquire(blocking=False):
+                    locks[url] = lock
+                else:
+                    self.connection.set(self.lock_key(url, 'again'),
+                                        hub_url, ex=self.lock_timeout)
+            except RedisError as e:
+                logger.warning('Could not lock topic %s: %s' % (url, e))
+                locks[url] = None
+        return locks
+
+    def _release(self, locks):
+        """
+        Releases topic locks. Returns a dict mapping the topics other
+        processes were pinged for meanwhile to their hub URL.
+        """
+        again = {}
+        for url, lock in locks.items():
+            if lock is None:
+                continue
+            try:
+                lock.release()
+                pipe = self.connection.pipeline()
+                pipe.get(self.lock_key(url, 'again'))
+                pipe.delete(self.lock_key(url, 'again'))
+                hub_url, deleted = pipe.execute()
+            except RedisError as e:
+                logger.warning('Could not unlock topic %s: %s' % (url, e))
+                continue
+            if hub_url is not None:
+                again[url] = hub_url
+        return again
+
+    def process(self, topic_urls, hub_url):
+        """
+        Runs one batch in its own connection and transaction, retrying
+        on write conflicts. The topics are only fetched once; retries
+        apply the same responses, and notifications are only queued by
+        the attempt that commits.
+        """
+        fetches = None
+        for attempt in xrange(self.attempts):
+            conn = self.db.open()
+            try:
+                hub = appmaker(conn.root())
+                if fetches is None:
+                    fetches = hub.fetch_responses(topic_urls, hub_url)
+                process_topics(hub, topic_urls, hub_url, fetches)
+                transaction.commit()
+                return
+            except ConflictError:
+                transaction.abort()
+                logger.info('Conflict processing topics %s, attempt %d'
+                            % (topic_urls, attempt + 1))
+            except Exception:
+                transaction.abort()
+                logger.exception('Failed processing topics %s'
+                                 % (topic_urls,))
+                return
+            finally:
+                conn.close()
+        logger.warning('Gave up processing topics %s after %d attempts'
+                       % (topic_urls, self.attempts))
+
+
+def includeme(config):
+    """
+    Registers a FetchPipeline for the primary ZODB database, if
+    pyramid_zodbconn has configured one.
+    """
+    db = get_primary_database(config)
+    if db is None:
+        return
+
+    settings = config.registry.settings
+    pipeline = FetchPipeline(
+        db,
+        workers=int(settings.get('pushhub.fetch_workers', 4)),
+        attempts=int(settings.get('tm.attempts', 3)),
+        max_pending=int(settings.get('pushhub.fetch_max_pending', 1000)),
+        debounce=float(settings.get('pushhub.fetch_debounce', 0.5)),
+        connection=delivery.get_connection(),
+    )
+    config.registry.registerUtility(pipeline, IFetchPipeline)
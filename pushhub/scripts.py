@@ -29,13 +29,21 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 import optparse
+import signal
 import textwrap
 import transaction
 import sys
 
-from pyramid.paster import bootstrap
+from pyramid.config import Configurator
+from pyramid.paster import bootstrap, get_appsettings, setup_logging
 from pyramid.request import Request
 
+from . import delivery
+from .fetcher import engine_from_settings
+from .models.container import migrate_folders
+from .models.topic import digest_stats
+from .worker import worker_from_settings
+
 
 def register_listener():
     description = """
@@ -75,9 +83,15 @@ def register_listener():
 
 def fetch_all_topics():
     description = """
-    Attempts to fetch content for all topics that have been marked as failed
-    previously. If the fetch fails during this run, it will not be retried
-    until the script is called again.
+    Fetches content for every topic known to the hub and notifies the
+    subscribers of any topics that changed. Publish pings only fetch the
+    topics they name, so this script is the scheduled sweep that picks up
+    everything else (run it from cron). If the fetch fails during this run,
+    it will not be retried until the script is called again.
+
+    Topics are fetched concurrently, limited overall by
+    pushhub.fetch_concurrency and per publisher host by
+    pushhub.fetch_per_host, and the results are committed in batches.
 
     Arguments:
         config_uri: the pyramid configuration to use for the hub
@@ -93,6 +107,14 @@ def fetch_all_topics():
         usage=usage,
         description=textwrap.dedent(description)
     )
+    parser.add_option(
+        '--batch-size', type='int', default=100,
+        help="number of fetched topics to apply per commit",
+    )
+    parser.add_option(
+        '--failed', action='store_true', default=False,
+        help="only fetch topics whose last fetch failed",
+    )
 
     options, args = parser.parse_args(sys.argv[1:])
     if not len(args) >= 2:
@@ -105,10 +127,115 @@ def fetch_all_topics():
     env = bootstrap(config_uri, request=request)
 
     hub = env['root']
+    engine = engine_from_settings(env['registry'].settings)
+
+    stats = hub.fetch_all_content(
+        hub_url,
+        only_failed=options.failed,
+        engine=engine,
+        checkpoint=transaction.commit,
+        batch_size=options.batch_size,
+    )
+    hub.notify_subscribers()
+
+    transaction.commit()
+    print "Fetched %(topics)d topics in %(seconds).2fs " \
+          "(%(rate).1f topics/sec)" % stats
+    print "Unchanged bodies skipped: %(hits)d, parsed: %(misses)d" % \
+          digest_stats.snapshot()
+
+    env['closer']()
+
+
+def reap_leases():
+    description = """
+    Removes subscriptions whose lease has expired without being renewed.
+    Only expired leases are looked at, so this is cheap to run often
+    (run it from cron). Subscriptions are removed and committed in
+    batches.
+
+    Arguments:
+        config_uri: the pyramid configuration to use for the hub
+
+    Example usage:
+        bin/reap_leases etc/paster.ini#pushhub
+
+    """
+
+    usage = "%prog config_uri"
+    parser = optparse.OptionParser(
+        usage=usage,
+        description=textwrap.dedent(description)
+    )
+    parser.add_option(
+        '--batch-size', type='int', default=1000,
+        help="number of expired subscriptions to remove per commit",
+    )
+
+    options, args = parser.parse_args(sys.argv[1:])
+    if not len(args) >= 1:
+        print("You must provide a configuration file.")
+        return
+    config_uri = args[0]
+
+    request = Request.blank('/', base_url='http://localhost/hub')
+    env = bootstrap(config_uri, request=request)
+
+    hub = env['root']
+
+    total = 0
+    while True:
+        reaped = hub.reap_expired_leases(limit=options.batch_size)
+        transaction.commit()
+        total += reaped
+        if reaped < options.batch_size:
+            break
+    print "Removed %d expired subscriptions" % total
+
+    env['closer']()
+
+
+def migrate_containers():
+    description = """
+    Converts the folders stored by earlier versions of the hub to the
+    lighter containers and sets of interned URL ids used now. Run it once
+    after upgrading; the hub works before it has run, upgrading objects
+    as it uses them.
+
+    Arguments:
+        config_uri: the pyramid configuration to use for the hub
 
-    hub.fetch_all_content(hub_url)
+    Example usage:
+        bin/migrate_containers etc/paster.ini#pushhub
 
+    """
+
+    usage = "%prog config_uri"
+    parser = optparse.OptionParser(
+        usage=usage,
+        description=textwrap.dedent(description)
+    )
+    parser.add_option(
+        '--batch-size', type='int', default=1000,
+        help="number of objects to migrate per commit",
+    )
+
+    options, args = parser.parse_args(sys.argv[1:])
+    if not len(args) >= 1:
+        print("You must provide a configuration file.")
+        return
+    config_uri = args[0]
+
+    request = Request.blank('/', base_url='http://localhost/hub')
+    env = bootstrap(config_uri, request=request)
+
+    hub = env['root']
+
+    counts = migrate_folders(hub, checkpoint=transaction.commit,
+                             batch_size=options.batch_size)
     transaction.commit()
+    print "Converted %(containers)d containers, cleaned %(objects)d " \
+          "objects" % counts
 
     env['closer']()
 
@@ -192,3 +319,58 @@ def show_topics():
         print "%s\t%s" % (topic.url, topic.timestamp)
 
     env['closer']()
+
+
+def run_delivery_worker():
+    description = """
+    Delivers the notifications queued for subscribers. Many deliveries
+    run at once, limited overall by pushhub.delivery_concurrency and per
+    callback host by pushhub.delivery_per_host. Failed deliveries are
+    retried up to pushhub.delivery_attempts times, waiting longer before
+    each retry. Progress is logged periodically and reported on exit.
+
+    Any number of workers can share the queue. Listener notifications,
+    which must arrive in order, are only sent by one of them at a time;
+    the others take over if it stops.
+
+    Arguments:
+        config_uri: the pyramid configuration to use for the hub
+
+    Example usage:
+        bin/delivery_worker etc/paster.ini#pushhub
+
+    """
+
+    usage = "%prog config_uri"
+    parser = optparse.OptionParser(
+        usage=usage,
+        description=textwrap.dedent(description)
+    )
+    parser.add_option(
+        '--burst', action='store_true', default=False,
+        help="exit once the queue is empty",
+    )
+    parser.add_option(
+        '--report-interval', type='int', default=60,
+        help="seconds between logged progress reports",
+    )
+
+    options, args = parser.parse_args(sys.argv[1:])
+    if not len(args) >= 1:
+        print("You must provide a configuration file.")
+        return
+    config_uri = args[0]
+
+    setup_logging(config_uri.split('#')[0])
+    settings = get_appsettings(config_uri)
+    config = Configurator(settings=settings)
+    config.include('pushhub.client')
+    config.include('pushhub.delivery')
+
+    worker = worker_from_settings(settings, delivery.get_connection())
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: worker.stop())
+
+    report = worker.run(burst=options.burst,
+                        report_interval=options.report_interval)
+    print worker.format_report(report)
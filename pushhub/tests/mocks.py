@@ -30,11 +30,19 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 """
 This module provides mock classes for various interactions (mostly HTTP),
-as well as access to fixture data as Python variables.
+as well as access to fixture data as Python variables, and a base test
+case for code that opens its own connections to a database.
 """
 
 from os.path import abspath, dirname, join
+from unittest import TestCase
+
+from pyramid import testing
 from requests.exceptions import HTTPError
+import transaction
+from ZODB.DB import DB
+
+from ..models import appmaker
 
 path = abspath(dirname(__file__))
 
@@ -82,3 +90,37 @@ class MultiResponse(object):
             return self.mapping[url]
         else:
             return MockResponse(status_code=404)
+
+
+class DatabaseTestCase(TestCase):
+    """Runs each test against a hub stored in a fresh in-memory database.
+    """
+    def setUp(self):
+        self.db = DB(None)
+        conn = self.db.open()
+        self.populate(appmaker(conn.root()))
+        transaction.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.db.close()
+
+    def populate(self, hub):
+        """Sets up the stored hub; does nothing unless overridden."""
+        pass
+
+    def get_hub(self):
+        """Returns the stored hub from a connection closed after the test.
+        """
+        conn = self.db.open()
+        self.addCleanup(conn.close)
+        return conn.root()['app_root']
+
+    def configure(self):
+        """Returns a testing Configurator that has the database set up as
+        pyramid_zodbconn would.
+        """
+        config = testing.setUp()
+        self.addCleanup(testing.tearDown)
+        config.registry._zodb_databases = {'': self.db}
+        return config
@@ -0,0 +1,102 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import threading
+from unittest import TestCase
+
+from mock import patch
+
+from .. import client
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = 'ok'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ClientTests(TestCase):
+
+    def setUp(self):
+        client.configure()
+
+    def tearDown(self):
+        client.configure()
+
+    def test_session_is_shared(self):
+        self.assertTrue(client.get_session() is client.get_session())
+
+    def test_configure_sets_pool_sizes(self):
+        client.configure(pool_connections=3, pool_maxsize=7)
+        adapter = client.get_session().get_adapter('http://example.com/')
+        self.assertEqual(adapter._pool_connections, 3)
+        self.assertEqual(adapter._pool_maxsize, 7)
+
+    def test_default_timeout(self):
+        client.configure(timeout=2.5)
+        session = client.get_session()
+        with patch.object(session, 'get') as mock:
+            client.get('http://example.com/')
+        mock.assert_called_once_with('http://example.com/', timeout=2.5)
+
+    def test_timeout_is_finite_by_default(self):
+        session = client.get_session()
+        with patch.object(session, 'post') as mock:
+            client.post('http://example.com/')
+        mock.assert_called_once_with('http://example.com/', timeout=30.0)
+
+    def test_connections_are_reused(self):
+        server = HTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/' % server.server_port
+            for i in range(3):
+                self.assertEqual(client.get(url).content, 'ok')
+            stats = client.connection_stats()
+        finally:
+            # Drop the kept-alive connection so the server can stop
+            client.configure()
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(stats['pools'], 1)
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['reused'], 2)
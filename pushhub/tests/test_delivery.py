@@ -0,0 +1,232 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from unittest import TestCase
+
+from mock import Mock, patch
+import transaction
+
+from .. import delivery
+from ..utils import gzip_compress
+from ..models.subscriber import Subscriber
+from ..models.topic import Topic
+from ..models.urls import URLTable
+
+
+class DeliveryTests(TestCase):
+
+    def setUp(self):
+        delivery.configure()
+        self.connection = Mock()
+        self.pipe = self.connection.pipeline.return_value
+        self.patcher = patch('pushhub.delivery.get_connection',
+                             return_value=self.connection)
+        self.patcher.start()
+        transaction.begin()
+
+    def tearDown(self):
+        transaction.abort()
+        self.patcher.stop()
+        delivery.configure()
+
+    def test_enqueue_many_batches(self):
+        calls = [('http://sub%d.com/' % i, 'body', {}) for i in range(5)]
+        count = delivery.enqueue_many('ucla.jobs.hub.post', calls,
+                                      batch_size=2)
+        self.assertEqual(count, 5)
+        self.assertEqual(self.connection.pipeline.call_count, 1)
+        self.assertEqual(self.pipe.execute.call_count, 3)
+        self.assertEqual(self.pipe.rpush.call_count, 5)
+
+    def test_enqueue_many_exact_batches(self):
+        calls = [('http://sub%d.com/' % i, 'body', {}) for i in range(4)]
+        delivery.enqueue_many('ucla.jobs.hub.post', calls, batch_size=2)
+        self.assertEqual(self.pipe.execute.call_count, 2)
+
+    def test_enqueue_many_nothing(self):
+        self.assertEqual(delivery.enqueue_many('ucla.jobs.hub.post', []), 0)
+        self.assertEqual(self.pipe.execute.call_count, 0)
+
+    def test_topic_notifies_all_subscribers(self):
+        topic = Topic('http://www.example.com/')
+        topic.content_type = 'atom'
+        topic.content = 'content'
+        topic.changed = True
+        urls = URLTable()
+        for i in range(3):
+            subscriber = Subscriber('http://sub%d.com/' % i)
+            subscriber.id = urls.intern(subscriber.callback_url)
+            topic.add_subscriber(subscriber)
+        topic.notify_subscribers(urls)
+        self.assertEqual(self.pipe.rpush.call_count, 0)
+        transaction.commit()
+        self.assertEqual(self.pipe.rpush.call_count, 3)
+        self.assertEqual(self.pipe.execute.call_count, 1)
+        self.assertEqual(self.connection.setex.call_count, 1)
+        self.assertFalse(topic.changed)
+
+    def test_topic_jobs_carry_payload_key(self):
+        topic = Topic('http://www.example.com/')
+        topic.content_type = 'atom'
+        topic.content = 'content'
+        topic.changed = True
+        urls = URLTable()
+        subscriber = Subscriber('http://sub.com/')
+        subscriber.id = urls.intern(subscriber.callback_url)
+        topic.add_subscriber(subscriber)
+        with patch('pushhub.delivery.enqueue_many') as enqueue:
+            topic.notify_subscribers(urls)
+            transaction.commit()
+        func, calls = enqueue.call_args[0]
+        self.assertEqual(func, 'pushhub.delivery.deliver')
+        self.assertEqual(list(calls), [(
+            'http://sub.com/',
+            delivery.payload_key(topic.body.encoded),
+            {'Content-Type': 'application/atom+xml'},
+        )])
+
+    def test_store_payload(self):
+        key = delivery.store_payload(u'content', ttl=60)
+        self.assertTrue(key.startswith(delivery.PAYLOAD_PREFIX))
+        self.connection.setex.assert_called_once_with(key, 60, u'content')
+        self.assertEqual(key, delivery.store_payload('content', ttl=60))
+
+    def test_topic_payload_is_stored_body(self):
+        topic = Topic('http://www.example.com/')
+        topic.content_type = 'atom'
+        topic.content = 'content'
+        del topic.body._v_data
+        headers, key = topic.store_request_data()
+        # The body wasn't decompressed
+        self.assertEqual(topic.body._v_data, None)
+        transaction.commit()
+        self.connection.setex.assert_called_once_with(
+            key, 86400, topic.body.encoded)
+
+    def test_load_payload_is_cached(self):
+        self.connection.get.return_value = gzip_compress('content')
+        self.assertEqual(delivery.load_payload('key'), 'content')
+        self.assertEqual(delivery.load_payload('key'), 'content')
+        self.assertEqual(delivery.load_payload('key', encoding='gzip'),
+                         gzip_compress('content'))
+        self.assertEqual(self.connection.get.call_count, 1)
+
+    def test_load_payload_cache_is_bounded(self):
+        delivery.configure(payload_cache_size=2)
+        self.connection.get.side_effect = gzip_compress
+        for key in ('a', 'b', 'c', 'a'):
+            delivery.load_payload(key)
+        self.assertEqual(self.connection.get.call_count, 4)
+
+    def test_load_expired_payload(self):
+        self.connection.get.return_value = None
+        self.assertRaises(ValueError, delivery.load_payload, 'key')
+
+    @patch('pushhub.client.post')
+    def test_deliver(self, post):
+        self.connection.get.return_value = gzip_compress('content')
+        post.return_value.status_code = 200
+        post.return_value.headers = {}
+        headers = {'Content-Type': 'application/atom+xml'}
+        delivery.deliver('http://sub.com/', 'key', headers)
+        post.assert_called_once_with('http://sub.com/', data='content',
+                                     headers=headers)
+        self.assertFalse(delivery.accepts_gzip('http://sub.com/'))
+
+    @patch('pushhub.client.post')
+    def test_deliver_gzip(self, post):
+        compressed = gzip_compress('content')
+        self.connection.get.return_value = compressed
+        post.return_value.status_code = 200
+        post.return_value.headers = {'Accept-Encoding': 'deflate, gzip'}
+        headers = {'Content-Type': 'application/atom+xml'}
+        delivery.deliver('http://sub.com/', 'key', headers)
+        self.assertTrue(delivery.accepts_gzip('http://sub.com/'))
+        delivery.deliver('http://sub.com/', 'key', headers)
+        self.assertEqual(post.call_args, (
+            ('http://sub.com/',),
+            {'data': compressed,
+             'headers': {'Content-Type': 'application/atom+xml',
+                         'Content-Encoding': 'gzip'}},
+        ))
+        self.assertEqual(headers, {'Content-Type': 'application/atom+xml'})
+
+    @patch('pushhub.client.post')
+    def test_deliver_gzip_refused(self, post):
+        self.connection.get.return_value = gzip_compress('content')
+        refused = Mock(status_code=415, headers={})
+        accepted = Mock(status_code=200, headers={})
+        post.side_effect = [refused, accepted]
+        delivery.note_encodings('http://sub.com/',
+                                Mock(headers={'Accept-Encoding': 'gzip'}))
+        headers = {'Content-Type': 'application/atom+xml'}
+        self.assertEqual(
+            delivery.deliver('http://sub.com/', 'key', headers), 200)
+        self.assertEqual(post.call_count, 2)
+        post.assert_called_with('http://sub.com/', data='content',
+                                headers=headers)
+        self.assertFalse(delivery.accepts_gzip('http://sub.com/'))
+
+    @patch('pushhub.client.get')
+    def test_deliver_get(self, get):
+        self.connection.get.return_value = gzip_compress('content')
+        get.return_value.status_code = 200
+        get.return_value.headers = {}
+        delivery.deliver('http://listener.com/', 'key', {}, 'GET')
+        get.assert_called_once_with('http://listener.com/', data='content',
+                                    headers={})
+
+    def test_enqueue_many_meta(self):
+        with patch('rq.job.Job.create') as create:
+            delivery.enqueue_many('ucla.jobs.hub.post', [('a',)],
+                                  meta={'ordered': True})
+        self.assertEqual(create.call_args[1]['meta'], {'ordered': True})
+        self.assertEqual(create.call_args[1]['origin'], 'default:ordered')
+
+
+class ConfigureTests(TestCase):
+
+    def tearDown(self):
+        delivery.configure()
+
+    def test_shared_connection(self):
+        delivery.configure(url='redis://redis.example.com:6380/2')
+        connection = delivery.get_connection()
+        self.assertTrue(connection is delivery.get_connection())
+        kwargs = connection.connection_pool.connection_kwargs
+        self.assertEqual(kwargs['host'], 'redis.example.com')
+        self.assertEqual(kwargs['port'], 6380)
+        self.assertEqual(kwargs['db'], 2)
+
+    def test_queue_name(self):
+        delivery.configure(queue_name='notify')
+        self.assertEqual(delivery.get_queue().name, 'notify')
+        self.assertEqual(delivery.get_queue(ordered=True).name,
+                         'notify:ordered')
@@ -0,0 +1,112 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from collections import defaultdict
+import threading
+import time
+from unittest import TestCase
+
+from mock import patch
+from requests.exceptions import ConnectionError
+
+from .mocks import MockResponse
+from ..fetcher import FetchEngine
+
+
+class ConcurrencyRecorder(object):
+    """Mocks ``client.get``, recording how many requests overlap."""
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.active = 0
+        self.active_hosts = defaultdict(int)
+        self.max_active = 0
+        self.max_per_host = 0
+
+    def __call__(self, url, *args, **kwargs):
+        host = url.split('/')[2]
+        with self.lock:
+            self.active += 1
+            self.active_hosts[host] += 1
+            self.max_active = max(self.max_active, self.active)
+            self.max_per_host = max(self.max_per_host,
+                                    self.active_hosts[host])
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+            self.active_hosts[host] -= 1
+        return MockResponse(content=url, status_code=200)
+
+
+class FetchEngineTests(TestCase):
+
+    def jobs(self, hosts, per_host):
+        return [
+            (i, 'http://host%d.com/%d' % (h, i), {})
+            for h in range(hosts)
+            for i in range(per_host)
+        ]
+
+    def test_all_jobs_complete(self):
+        engine = FetchEngine(concurrency=4, per_host=2)
+        jobs = self.jobs(3, 5)
+        with patch('pushhub.client.get', new=ConcurrencyRecorder(0)):
+            results = list(engine.run(jobs))
+        self.assertEqual(len(results), 15)
+        self.assertEqual(sorted(r[1].content for r in results),
+                         sorted(job[1] for job in jobs))
+
+    def test_global_limit(self):
+        engine = FetchEngine(concurrency=3, per_host=10)
+        recorder = ConcurrencyRecorder()
+        with patch('pushhub.client.get', new=recorder):
+            list(engine.run(self.jobs(10, 1)))
+        self.assertTrue(recorder.max_active <= 3)
+        self.assertTrue(recorder.max_active > 1)
+
+    def test_per_host_limit(self):
+        engine = FetchEngine(concurrency=10, per_host=2)
+        recorder = ConcurrencyRecorder()
+        with patch('pushhub.client.get', new=recorder):
+            list(engine.run(self.jobs(2, 6)))
+        self.assertEqual(recorder.max_per_host, 2)
+
+    @patch('pushhub.client.get')
+    def test_errors_are_returned(self, mock):
+        mock.side_effect = ConnectionError
+        engine = FetchEngine()
+        results = list(engine.run([('key', 'http://host.com/', {})]))
+        key, response, error = results[0]
+        self.assertEqual(key, 'key')
+        self.assertTrue(response is None)
+        self.assertTrue(isinstance(error, ConnectionError))
+
+    def test_no_jobs(self):
+        self.assertEqual(list(FetchEngine().run([])), [])
@@ -31,14 +31,24 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 from unittest import TestCase
 from mock import patch
 
+from BTrees.OOBTree import OOBTree
 from feedparser import parse
-from requests.exceptions import ConnectionError
-
+from repoze.folder import Folder
+from requests.exceptions import ConnectionError, ReadTimeout
+import transaction
+from ZODB.DB import DB
+
+from ..models import appmaker
+from ..models import body
+from ..models.body import FeedBody
+from ..models.container import Container, migrate_folders
 from ..models.hub import Hub
 from ..models.listener import Listener, Listeners
-from ..models.topic import Topic, Topics
-from ..models.subscriber import Subscriber
-from ..utils import is_valid_url
+from ..models.topic import Topic, Topics, TopicStatus, digest_stats
+from ..models.subscriber import Subscriber, Subscribers
+from ..models.urls import URLTable
+from ..utils import FeedIndex
+from ..utils import gzip_compress, gzip_decompress, is_valid_url
 
 from .mocks import good_atom, MockResponse, MultiResponse, updated_atom
 
@@ -109,13 +119,23 @@ class TopicTests(TestCase):
     def test_adding_subscriber(self):
         t = Topic('http://www.google.com/')
         s = Subscriber('http://httpbin.org/get')
+        s.id = 1
+        t.add_subscriber(s)
+        self.assertEqual(t.subscriber_count, 1)
+        self.assertEqual(list(t.subscribers), [1])
+
+    def test_adding_subscriber_twice(self):
+        t = Topic('http://www.google.com/')
+        s = Subscriber('http://httpbin.org/get')
+        s.id = 1
         t.add_subscriber(s)
+        self.assertRaises(KeyError, t.add_subscriber, s)
         self.assertEqual(t.subscriber_count, 1)
-        self.assertEqual(t.subscribers.get('http://httpbin.org/get'), s)
 
     def test_removing_subscriber(self):
         t = Topic('http://www.google.com/')
         s = Subscriber('http://httpbin.org/get')
+        s.id = 1
         t.add_subscriber(s)
         t.remove_subscriber(s)
         self.assertEqual(t.subscriber_count, 0)
@@ -123,9 +143,74 @@ class TopicTests(TestCase):
     def test_removing_non_existing_subscribers(self):
         t = Topic('http://www.google.com/')
         s = Subscriber('http://httpbin.org/get')
+        s.id = 1
         self.assertRaises(KeyError, t.remove_subscriber, s)
 
-    @patch('requests.get', new_callable=MockResponse, content="bad content")
+    def test_change_while_notifying_is_kept(self):
+        t = Topic('http://www.google.com/')
+        t.changed = True
+        t.changed = True
+        self.assertTrue(t.changed)
+        t.changed = False
+        self.assertFalse(t.changed)
+
+    def test_status_conflicts_resolved(self):
+        status = TopicStatus()
+        old = status.__getstate__()
+        committed = dict(old, changes=1, last_pinged=2)
+        new = dict(old, notified=0, last_pinged=1)
+        resolved = status._p_resolveConflict(old, committed, new)
+        self.assertEqual(resolved['changes'], 1)
+        self.assertEqual(resolved['notified'], 0)
+        self.assertEqual(resolved['last_pinged'], 2)
+
+    def test_notify_racing_a_change_stays_changed(self):
+        status = TopicStatus()
+        status.changes = 1
+        old = status.__getstate__()
+        # Subscribers were notified of the first change while a second
+        # one was being fetched
+        notified = dict(old, notified=1)
+        fetched = dict(old, changes=2)
+        resolved = status._p_resolveConflict(old, notified, fetched)
+        status.__setstate__(resolved)
+        self.assertTrue(status.changes > status.notified)
+
+    def test_content_kept_in_body(self):
+        t = Topic('http://www.google.com/')
+        self.assertEqual(t.body, None)
+        self.assertFalse(t.has_content)
+        t.content = good_atom
+        first = t.body
+        self.assertEqual(first.data, good_atom)
+        self.assertEqual(t.content, good_atom)
+        self.assertTrue(t.has_content)
+        self.assertFalse('content' in t.__dict__)
+        t.content = updated_atom
+        self.assertFalse(t.body is first)
+        self.assertEqual(first.data, good_atom)
+
+    def test_content_of_old_topics(self):
+        t = Topic('http://www.google.com/')
+        t.__dict__['content'] = good_atom
+        self.assertEqual(t.content, good_atom)
+        self.assertTrue(t.has_content)
+        t.content = updated_atom
+        self.assertEqual(t.body.data, updated_atom)
+        self.assertFalse('content' in t.__dict__)
+
+    def test_old_state_moved_out_of_topic(self):
+        t = Topic('http://www.google.com/')
+        del t.status
+        del t.subscriber_counter
+        t.__dict__.update(changed=True, last_pinged=1, subscriber_count=3)
+        self.assertTrue(t.changed)
+        self.assertEqual(t.last_pinged, 1)
+        self.assertEqual(t.subscriber_count, 3)
+        for name in ('changed', 'last_pinged', 'subscriber_count'):
+            self.assertFalse(name in t.__dict__)
+
+    @patch('pushhub.client.get', new_callable=MockResponse, content="bad content")
     def test_fetching_bad_content(self, mock):
         t = Topic('http://httpbin.org/get')
         self.assertRaises(ValueError, t.fetch, 'http://myhub.com/')
@@ -134,7 +219,7 @@ class TopicTests(TestCase):
         self.assertTrue(t.content is None)
         self.assertEqual(t.content_type, '')
 
-    @patch('requests.get', new_callable=MockResponse, content=good_atom)
+    @patch('pushhub.client.get', new_callable=MockResponse, content=good_atom)
     def test_fetching_good_content(self, mock):
         t = Topic('http://httpbin.org/get')
         t.fetch('http://myhub.com/')
@@ -164,7 +249,94 @@ class TopicTests(TestCase):
         self.assertEqual(parsed['channel']['title'], 'Example Feed')
         self.assertEqual(len(parsed['items']), 5)
 
-    @patch('requests.get')
+    def test_fetching_stores_validators(self):
+        t = Topic('http://httpbin.org/get')
+        headers = {'ETag': '"abc"', 'Last-Modified': 'Fri, 01 Mar 2013'}
+        with patch('pushhub.client.get', new_callable=MockResponse,
+                   content=good_atom, headers=headers):
+            t.fetch('http://myhub.com/')
+        self.assertEqual(t.etag, '"abc"')
+        self.assertEqual(t.last_modified, 'Fri, 01 Mar 2013')
+        headers = t.request_headers('http://myhub.com/')
+        self.assertEqual(headers['If-None-Match'], '"abc"')
+        self.assertEqual(headers['If-Modified-Since'], 'Fri, 01 Mar 2013')
+
+    def test_no_validators_without_content(self):
+        t = Topic('http://httpbin.org/get')
+        t.etag = '"abc"'
+        headers = t.request_headers('http://myhub.com/')
+        self.assertFalse('If-None-Match' in headers)
+
+    @patch('pushhub.models.topic.Topic.parse')
+    def test_not_modified_skips_parsing(self, mock_parse):
+        t = Topic('http://httpbin.org/get')
+        t.content = good_atom
+        t.etag = '"abc"'
+        with patch('pushhub.client.get', new_callable=MockResponse,
+                   status_code=304):
+            t.fetch('http://myhub.com/')
+        self.assertFalse(mock_parse.called)
+        self.assertFalse(t.changed)
+        self.assertEqual(t.content, good_atom)
+        self.assertEqual(t.etag, '"abc"')
+
+    @patch('pushhub.client.get', new_callable=MockResponse, content=good_atom)
+    def test_unchanged_content_skips_parsing(self, mock):
+        digest_stats.reset()
+        t = Topic('http://httpbin.org/get')
+        t.fetch('http://myhub.com/')
+        t.changed = False
+        with patch.object(Topic, 'parse') as mock_parse:
+            t.fetch('http://myhub.com/')
+        self.assertFalse(mock_parse.called)
+        self.assertFalse(t.changed)
+        self.assertEqual(digest_stats.snapshot(), {'hits': 1, 'misses': 1})
+
+    def test_fetching_stores_feed_index(self):
+        t = Topic('http://httpbin.org/get')
+        with patch('pushhub.client.get', new_callable=MockResponse,
+                   content=good_atom):
+            t.fetch('http://myhub.com/')
+        self.assertEqual(t.feed_index.title, 'Example Feed')
+        self.assertTrue(
+            'http://publisher.example.com/happycat26.xml'
+            in t.feed_index.entries)
+        # Kept with the body rather than in the topic's own state
+        self.assertTrue(t.feed_index is t.body.index)
+        self.assertFalse('feed_index' in t.__dict__)
+
+    def test_feed_index_of_old_topics(self):
+        t = Topic('http://httpbin.org/get')
+        t.__dict__['content'] = good_atom
+        t.__dict__['feed_index'] = index = FeedIndex(parse(good_atom))
+        self.assertTrue(t.feed_index is index)
+        with patch('pushhub.client.get', new_callable=MockResponse,
+                   content=updated_atom):
+            t.fetch('http://myhub.com/')
+        self.assertTrue(t.changed)
+        self.assertEqual(t.feed_index.title, 'Updated Feed')
+        self.assertFalse('feed_index' in t.__dict__)
+
+    def test_refetch_only_parses_new_content(self):
+        t = Topic('http://httpbin.org/get')
+        with patch('pushhub.client.get', new_callable=MockResponse,
+                   content=good_atom):
+            t.fetch('http://myhub.com/')
+        parsed = []
+
+        def record_parse(content):
+            parsed.append(content)
+            return parse(content)
+
+        with patch('pushhub.client.get', new_callable=MockResponse,
+                   content=updated_atom):
+            with patch.object(t, 'parse', side_effect=record_parse):
+                t.fetch('http://myhub.com/')
+        self.assertEqual(parsed, [updated_atom])
+        self.assertTrue('Colby Nolan' in t.content)
+        self.assertEqual(t.feed_index.title, 'Updated Feed')
+
+    @patch('pushhub.client.get')
     def test_failed_connection(self, mock):
         """When we fail to connect to a topic, update the flag."""
         mock.side_effect = ConnectionError
@@ -172,6 +344,13 @@ class TopicTests(TestCase):
         t.fetch('http://hub.com')
         self.assertTrue(t.failed)
 
+    @patch('pushhub.client.get')
+    def test_fetch_timeout(self, mock):
+        mock.side_effect = ReadTimeout
+        t = Topic('http://httpbin.org/get')
+        t.fetch('http://hub.com')
+        self.assertTrue(t.failed)
+
 
 class TopicSubscriberTests(TestCase):
 
@@ -270,6 +449,12 @@ class TopicNewEntriesTests(TestCase):
         self.assertTrue('Heathcliff' in output_str)
         self.assertTrue('Updated Feed' in output_str)
 
+    def test_generate_feed_leaves_entries_alone(self):
+        parsed = parse(updated_atom)
+        before = [dict(entry) for entry in parsed.entries]
+        self.topic.generate_feed(parsed)
+        self.assertEqual([dict(entry) for entry in parsed.entries], before)
+
     def test_no_input(self):
         parsed_feed = None
         self.assertRaises(TypeError, self.topic.generate_feed, parsed_feed)
@@ -292,17 +477,17 @@ class HubTests(TestCase):
     challenge = "abcdefg"
 
     def setUp(self):
-        pass
+        transaction.begin()
 
     def tearDown(self):
-        pass
+        transaction.abort()
 
     def test_creation(self):
         hub = Hub()
         self.assertEqual(hub.topics, None)
         self.assertEqual(hub.subscribers, None)
 
-    @patch('requests.get', new_callable=MockResponse, content=good_atom)
+    @patch('pushhub.client.get', new_callable=MockResponse, content=good_atom)
     def test_publish_topic(self, mock):
         hub = Hub()
         hub.publish('http://www.google.com/')
@@ -313,7 +498,7 @@ class HubTests(TestCase):
             'http://www.google.com/'
         )
 
-    @patch('requests.get', new_callable=MockResponse, content=good_atom)
+    @patch('pushhub.client.get', new_callable=MockResponse, content=good_atom)
     def test_publish_existing_topic(self, mock):
         """
         Existing topics should have their 'pinged' time updated.
@@ -330,7 +515,7 @@ class HubTests(TestCase):
     def test_subscribe(self, mock_get_challenge_string):
         hub = Hub()
         mock_get_challenge_string.return_value = self.challenge
-        with patch('requests.get', new_callable=MockResponse,
+        with patch('pushhub.client.get', new_callable=MockResponse,
                    content=self.challenge, status_code=200):
             hub.subscribe('http://httpbin.org/get', 'http://www.google.com/')
         self.assertEqual(len(hub.subscribers), 1)
@@ -340,11 +525,124 @@ class HubTests(TestCase):
             'http://httpbin.org/get'
         )
 
+    @patch('pushhub.client.get')
+    def test_subscribe_without_verification(self, mock):
+        hub = Hub()
+        hub.subscribe('http://httpbin.org/get', 'http://www.google.com/',
+                      verify_callbacks=False)
+        sub = hub.subscribers['http://httpbin.org/get']
+        self.assertEqual(len(sub.topics), 1)
+        hub.unsubscribe('http://httpbin.org/get', 'http://www.google.com/',
+                        verify_callbacks=False)
+        self.assertEqual(len(sub.topics), 0)
+        self.assertFalse(mock.called)
+
+    def subscribe_all(self, hub, leases, now=1000):
+        for callback_url, topic_url, lease_seconds in leases:
+            hub.subscribe(callback_url, topic_url, verify_callbacks=False)
+            hub.set_lease(callback_url, topic_url, lease_seconds, now=now)
+
+    def test_reap_expired_leases(self):
+        hub = Hub()
+        self.subscribe_all(hub, [
+            ('http://a.com/', 'http://www.google.com/', 10),
+            ('http://b.com/', 'http://www.google.com/', 20),
+            ('http://a.com/', 'http://www.site.com/', 30),
+        ])
+        self.assertEqual(hub.reap_expired_leases(now=1005), 0)
+        self.assertEqual(hub.reap_expired_leases(now=1020), 2)
+        topic = hub.topics['http://www.google.com/']
+        self.assertEqual(len(topic.subscribers), 0)
+        self.assertEqual(topic.subscriber_count, 0)
+        self.assertEqual(
+            list(hub.subscribers['http://a.com/'].topics),
+            [hub.topics['http://www.site.com/'].id])
+        self.assertEqual(len(hub.leases), 1)
+        self.assertEqual(len(hub.lease_index), 1)
+
+    def test_reap_expired_leases_limit(self):
+        hub = Hub()
+        self.subscribe_all(hub, [
+            ('http://%s.com/' % name, 'http://www.google.com/', 10)
+            for name in 'abc'
+        ])
+        self.assertEqual(hub.reap_expired_leases(now=2000, limit=2), 2)
+        self.assertEqual(hub.reap_expired_leases(now=2000, limit=2), 1)
+
+    def test_renewed_lease_replaces_old_one(self):
+        hub = Hub()
+        self.subscribe_all(hub, [('http://a.com/', 'http://www.google.com/',
+                                  10)])
+        hub.set_lease('http://a.com/', 'http://www.google.com/', 100,
+                      now=1000)
+        self.assertEqual(hub.reap_expired_leases(now=1050), 0)
+        self.assertEqual(hub.get_lease('http://a.com/',
+                                       'http://www.google.com/'), 1100)
+        self.assertEqual(len(hub.lease_index), 1)
+
+    @patch('pushhub.client.get')
+    def test_unsubscribe_removes_lease(self, mock):
+        hub = Hub()
+        hub.subscribe('http://a.com/', 'http://www.google.com/',
+                      verify_callbacks=False, lease_seconds=10)
+        self.assertEqual(len(hub.leases), 1)
+        hub.unsubscribe('http://a.com/', 'http://www.google.com/',
+                        verify_callbacks=False)
+        self.assertEqual(len(hub.leases), 0)
+        self.assertEqual(len(hub.lease_index), 0)
+
+    def test_leases_created_for_old_hubs(self):
+        hub = Hub()
+        del hub.leases, hub.lease_index
+        self.assertEqual(hub.reap_expired_leases(), 0)
+        hub.subscribe('http://a.com/', 'http://www.google.com/',
+                      verify_callbacks=False, lease_seconds=10)
+        self.assertEqual(len(hub.leases), 1)
+
+    def test_leases_keyed_by_ids(self):
+        hub = Hub()
+        hub.subscribe('http://a.com/', 'http://www.google.com/',
+                      verify_callbacks=False)
+        hub.set_lease('http://a.com/', 'http://www.google.com/', 10,
+                      now=1000)
+        subscriber = hub.subscribers['http://a.com/']
+        topic = hub.topics['http://www.google.com/']
+        key = hub.lease_key(subscriber.id, topic.id)
+        self.assertEqual(list(hub.leases.items()), [(key, 1010)])
+        self.assertEqual(hub.lease_ids(key), (subscriber.id, topic.id))
+        self.assertEqual(hub.get_lease('http://b.com/',
+                                       'http://www.google.com/'), None)
+
+    def test_leases_by_url_upgraded(self):
+        hub = Hub()
+        self.subscribe_all(hub, [
+            ('http://a.com/', 'http://www.google.com/', 10),
+            ('http://b.com/', 'http://www.google.com/', 20),
+        ])
+        # As stored before leases were keyed by ids
+        hub.leases = OOBTree({
+            ('http://a.com/', 'http://www.google.com/'): 1010,
+            ('http://b.com/', 'http://www.google.com/'): 1020,
+        })
+        self.assertEqual(hub.get_lease('http://b.com/',
+                                       'http://www.google.com/'), 1020)
+        self.assertEqual(len(hub.lease_index), 2)
+        self.assertEqual(hub.reap_expired_leases(now=1015), 1)
+        self.assertEqual(
+            list(hub.topics['http://www.google.com/'].subscribers),
+            [hub.subscribers['http://b.com/'].id])
+
+    def test_jitter_lease(self):
+        hub = Hub()
+        leases = [hub.jitter_lease(1000) for i in range(50)]
+        self.assertTrue(all(900 <= lease <= 1000 for lease in leases))
+        self.assertTrue(len(set(leases)) > 1)
+
     @patch.object(Hub, 'get_challenge_string')
     def test_existing_subscription(self, mock_get_challenge_string):
         hub = Hub()
         mock_get_challenge_string.return_value = self.challenge
-        with patch('requests.get', new_callable=MockResponse,
+        with patch('pushhub.client.get', new_callable=MockResponse,
                    content=self.challenge, status_code=200):
             hub.subscribe('http://httpbin.org/get', 'http://www.google.com/')
             hub.subscribe('http://httpbin.org/get', 'http://www.google.com/')
@@ -356,23 +654,24 @@ class HubTests(TestCase):
     def test_unsubscribe(self, mock_get_challenge_string):
         hub = Hub()
         mock_get_challenge_string.return_value = self.challenge
-        with patch('requests.get', new_callable=MockResponse,
+        with patch('pushhub.client.get', new_callable=MockResponse,
                    content=self.challenge, status_code=200):
             hub.subscribe('http://www.google.com/', 'http://www.google.com/')
         sub = hub.get_or_create_subscriber('http://www.google.com/')
         self.assertEqual(len(sub.topics), 1)
-        self.assertTrue('http://www.google.com/' in sub.topics.keys())
-        with patch('requests.get', new_callable=MockResponse,
+        self.assertTrue(hub.topics['http://www.google.com/'].id
+                        in sub.topics)
+        with patch('pushhub.client.get', new_callable=MockResponse,
                    content=self.challenge, status_code=200):
             hub.unsubscribe('http://www.google.com/', 'http://www.google.com/')
         self.assertEqual(len(sub.topics), 0)
         # test repeated unsubscribe
-        with patch('requests.get', new_callable=MockResponse,
+        with patch('pushhub.client.get', new_callable=MockResponse,
                    content=self.challenge, status_code=200):
             hub.unsubscribe('http://www.google.com/', 'http://www.google.com/')
         self.assertEqual(len(sub.topics), 0)
 
-    @patch('requests.get', new_callable=MockResponse, content=good_atom)
+    @patch('pushhub.client.get', new_callable=MockResponse, content=good_atom)
     def test_fetch_all_topics(self, mock):
         hub = Hub()
         hub.publish('http://httpbin.org/get')
@@ -395,7 +694,7 @@ class HubTests(TestCase):
             'http://httpbin.org/get': MockResponse(content=good_atom),
             'http://www.google.com/': MockResponse(content="adslkfhadslfhd"),
         }
-        with patch('requests.get', new_callable=MultiResponse, mapping=urls):
+        with patch('pushhub.client.get', new_callable=MultiResponse, mapping=urls):
             hub.fetch_all_content('http://myhub.com')
         good = hub.topics.get('http://httpbin.org/get')
         bad = hub.topics.get('http://www.google.com/')
@@ -414,7 +713,7 @@ class HubTests(TestCase):
             'http://httpbin.org/get': MockResponse(content=good_atom),
             'http://www.google.com/': MockResponse(content=good_atom),
         }
-        with patch('requests.get', new_callable=MultiResponse, mapping=urls):
+        with patch('pushhub.client.get', new_callable=MultiResponse, mapping=urls):
             hub.fetch_content([
                 'http://httpbin.org/get',
                 'http://www.google.com/'
@@ -435,7 +734,7 @@ class HubTests(TestCase):
             'http://httpbin.org/get': MockResponse(content=good_atom),
             'http://www.google.com/': MockResponse(content="adslkfhadslfhd"),
         }
-        with patch('requests.get', new_callable=MultiResponse, mapping=urls):
+        with patch('pushhub.client.get', new_callable=MultiResponse, mapping=urls):
             hub.fetch_content([
                 'http://httpbin.org/get',
                 'http://www.google.com/'
@@ -457,7 +756,7 @@ class HubTests(TestCase):
         urls = {
             'http://httpbin.org/get': MockResponse(content=good_atom),
         }
-        with patch('requests.get', new_callable=MultiResponse, mapping=urls):
+        with patch('pushhub.client.get', new_callable=MultiResponse, mapping=urls):
             hub.fetch_content([
                 'http://httpbin.org/get',
                 'http://www.google.com/'
@@ -479,7 +778,7 @@ class HubTests(TestCase):
             'http://httpbin.org/get': MockResponse(content=good_atom),
             'http://www.google.com/': MockResponse(content="adslkfhadslfhd"),
         }
-        with patch('requests.get', new_callable=MultiResponse, mapping=urls):
+        with patch('pushhub.client.get', new_callable=MultiResponse, mapping=urls):
             hub.fetch_content([
                 'http://httpbin.org/get',
                 'http://www.google.com/'
@@ -497,6 +796,7 @@ class HubTests(TestCase):
         # XXX This test is in complete.
         t = Topic('http://httpbin.org/get')
         s = Subscriber('http://www.google.com/')
+        s.id = 1
         t.add_subscriber(s)
 
     def test_register_listener(self):
@@ -507,33 +807,38 @@ class HubTests(TestCase):
         l = hub.listeners.get('http://www.site.com/')
         self.assertEqual(l.callback_url, 'http://www.site.com/')
 
-    def test_notify_listener_of_topic(self):
+    @patch('pushhub.delivery.get_connection')
+    def test_notify_listener_of_topic(self, connection):
         hub = Hub()
         hub.listeners = Listeners()
         hub.topics = Topics()
         hub.register_listener('http://www.site.com/')
-        with patch('requests.get', new_callable=MockResponse, status_code=200):
+        with patch('pushhub.client.get', new_callable=MockResponse, status_code=200):
             hub.publish('http://www.example.com/')
             hub.topics['http://www.example.com/'].content_type = 'atom'
             topics = [t for t in hub.topics.values()]
             hub.notify_listeners(topics)
         l = hub.listeners.get('http://www.site.com/')
-        self.assertTrue(l.topics.get('http://www.example.com/'))
+        self.assertEqual(l.high_water,
+                         hub.topics['http://www.example.com/'].sequence)
 
-    def test_notify_listener_of_existing_topics(self):
+    @patch('pushhub.delivery.get_connection')
+    def test_notify_listener_of_existing_topics(self, connection):
         hub = Hub()
         hub.listeners = Listeners()
         hub.topics = Topics()
 
-        with patch('requests.get', new_callable=MockResponse, status_code=200):
+        with patch('pushhub.client.get', new_callable=MockResponse, status_code=200):
             hub.publish('http://www.site.com/')
             hub.topics['http://www.site.com/'].content_type = 'atom'
             hub.register_listener('http://www.example.com/')
         l = hub.listeners.get('http://www.example.com/')
-        self.assertTrue(l.topics.get('http://www.site.com/'))
+        self.assertEqual(l.high_water,
+                         hub.topics['http://www.site.com/'].sequence)
 
-    @patch('pushhub.models.topic.Topic.fetch')
-    def test_fetch_all_failed_topics(self, mocked):
+    @patch('pushhub.client.get', new_callable=MockResponse, content=good_atom)
+    @patch('pushhub.models.topic.Topic.update')
+    def test_fetch_all_failed_topics(self, mocked, mock_get):
         hub = Hub()
         hub.topics = Topics()
         urls = (
@@ -544,10 +849,262 @@ class HubTests(TestCase):
             t = Topic(url)
             t.failed = True
             hub.topics.add(url, t)
+        hub.topics.add('http://www.google.com/',
+                       Topic('http://www.google.com/'))
 
         hub.fetch_all_content('http://hub.com', only_failed=True)
         self.assertEqual(mocked.call_count, 2)
 
+    @patch('pushhub.client.get')
+    def test_fetch_content_timeout(self, mock):
+        hub = Hub()
+        hub.publish('http://www.google.com/')
+        hub.publish('http://www.site.com/')
+        mock.side_effect = ReadTimeout
+        hub.fetch_content(['http://www.google.com/', 'http://www.site.com/'],
+                          'http://hub.com')
+        self.assertTrue(hub.topics.get('http://www.google.com/').failed)
+        self.assertTrue(hub.topics.get('http://www.site.com/').failed)
+        self.assertEqual(mock.call_count, 2)
+
+    @patch('pushhub.client.get')
+    def test_fetch_all_topics_connection_error(self, mock):
+        mock.side_effect = ConnectionError
+        hub = Hub()
+        hub.publish('http://www.google.com/')
+        stats = hub.fetch_all_content('http://hub.com')
+        self.assertTrue(hub.topics.get('http://www.google.com/').failed)
+        self.assertEqual(stats['topics'], 1)
+
+    @patch('pushhub.client.get', new_callable=MockResponse, content=good_atom)
+    def test_fetch_all_topics_checkpoints(self, mock):
+        hub = Hub()
+        for i in range(5):
+            hub.publish('http://www.site%d.com/' % i)
+        checkpoints = []
+        hub.fetch_all_content('http://hub.com',
+                              checkpoint=lambda: checkpoints.append(1),
+                              batch_size=2)
+        self.assertEqual(len(checkpoints), 2)
+
+    @patch('pushhub.client.get', new_callable=MockResponse, content=good_atom)
+    def test_fetch_all_topics_marks_changed_before_checkpoint(self, mock):
+        hub = Hub()
+        for i in range(4):
+            hub.publish('http://www.site%d.com/' % i)
+        marked = []
+        hub.fetch_all_content(
+            'http://hub.com', batch_size=2,
+            checkpoint=lambda: marked.append(len(hub.get_changed_topics())))
+        self.assertEqual(marked, [2, 4])
+
+    @patch('pushhub.delivery.store_payload', return_value='key')
+    @patch('pushhub.delivery.enqueue_many')
+    def test_notify_listeners_in_one_batch(self, enqueue, store):
+        hub = Hub()
+        hub.topics = Topics()
+        for url in ('http://www.site.com/', 'http://www.example.com/'):
+            topic = Topic(url)
+            topic.content_type = 'atom'
+            hub.topics.add(url, topic)
+        hub.listeners = Listeners()
+        hub.listeners.add('http://a.com/', Listener('http://a.com/'))
+        hub.listeners.add('http://b.com/', Listener('http://b.com/'))
+        hub.notify_listeners(hub.topics.values())
+        self.assertEqual(enqueue.call_count, 0)
+        transaction.commit()
+        self.assertEqual(store.call_count, 2)
+        self.assertEqual(enqueue.call_count, 1)
+        func, calls = enqueue.call_args[0]
+        self.assertEqual(func, 'pushhub.delivery.deliver')
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(enqueue.call_args[1], {'meta': {'ordered': True}})
+        for listener in hub.listeners.values():
+            self.assertEqual(listener.high_water, 2)
+
+    def test_topic_sequence(self):
+        hub = Hub()
+        for url in ('http://a.com/', 'http://b.com/', 'http://a.com/'):
+            hub.publish(url)
+        self.assertEqual(hub.topics['http://a.com/'].sequence, 1)
+        self.assertEqual(hub.topics['http://b.com/'].sequence, 2)
+        self.assertEqual(list(hub.get_topic_log().items()),
+                         [(1, 'http://a.com/'), (2, 'http://b.com/')])
+
+    def test_topic_log_built_for_old_hubs(self):
+        hub = Hub()
+        hub.topics = Topics()
+        hub.topics.add('http://a.com/', Topic('http://a.com/'))
+        del hub.topic_log
+        self.assertEqual(list(hub.get_topic_log().values()),
+                         ['http://a.com/'])
+        hub.publish('http://b.com/')
+        self.assertEqual(hub.topics['http://b.com/'].sequence, 2)
+
+    @patch('pushhub.delivery.store_payload', return_value='key')
+    @patch('pushhub.delivery.enqueue_many')
+    def test_register_listener_only_new_topics(self, enqueue, store):
+        hub = Hub()
+        for url in ('http://a.com/', 'http://b.com/'):
+            hub.publish(url)
+            hub.topics[url].content_type = 'atom'
+        hub.register_listener('http://listener.com/')
+        transaction.commit()
+        self.assertEqual(len(enqueue.call_args[0][1]), 2)
+
+        hub.publish('http://c.com/')
+        hub.topics['http://c.com/'].content_type = 'atom'
+        hub.register_listener('http://listener.com/')
+        transaction.commit()
+        calls = enqueue.call_args[0][1]
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0][0], 'http://listener.com/')
+        listener = hub.listeners['http://listener.com/']
+        self.assertEqual(listener.high_water, 3)
+
+        hub.register_listener('http://listener.com/')
+        transaction.commit()
+        self.assertEqual(enqueue.call_args[0][1], [])
+
+    @patch('pushhub.delivery.store_payload', return_value='key')
+    @patch('pushhub.delivery.enqueue_many')
+    def test_register_listener_topics_skipped_by_notify(self, enqueue, store):
+        hub = Hub()
+        hub.register_listener('http://listener.com/')
+        # Subscribing numbers a topic before it has been published
+        hub.get_or_create_topic('http://a.com/').content_type = 'atom'
+        hub.publish('http://b.com/')
+        hub.topics['http://b.com/'].content_type = 'atom'
+        hub.notify_listeners([hub.topics['http://b.com/']])
+        transaction.commit()
+        listener = hub.listeners['http://listener.com/']
+        self.assertEqual(listener.high_water, 2)
+        self.assertEqual(list(listener.unsent), [1])
+
+        hub.register_listener('http://listener.com/')
+        transaction.commit()
+        calls = enqueue.call_args[0][1]
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(store.call_count, 2)
+        self.assertEqual(listener.unsent, None)
+
+    def test_listener_mark_sent(self):
+        listener = Listener('http://listener.com/')
+        listener.mark_sent(1)
+        self.assertEqual(listener.unsent, None)
+        listener.mark_sent(4)
+        self.assertEqual(listener.high_water, 4)
+        self.assertEqual(list(listener.unsent), [2, 3])
+        listener.mark_sent(3)
+        self.assertEqual(list(listener.unsent), [2])
+        listener.mark_sent(4)
+        listener.mark_sent(2)
+        self.assertEqual(listener.high_water, 4)
+        self.assertEqual(listener.unsent, None)
+
+    @patch('pushhub.delivery.store_payload')
+    @patch('pushhub.delivery.enqueue_many')
+    def test_nothing_queued_when_aborted(self, enqueue, store):
+        hub = Hub()
+        hub.publish('http://a.com/')
+        hub.topics['http://a.com/'].content_type = 'atom'
+        hub.register_listener('http://listener.com/')
+        transaction.abort()
+        self.assertFalse(store.called)
+        self.assertFalse(enqueue.called)
+
+    def test_old_listener_upgraded(self):
+        hub = Hub()
+        for url in ('http://a.com/', 'http://b.com/', 'http://c.com/'):
+            hub.publish(url)
+        listener = Listener('http://listener.com/')
+        del listener.high_water
+        listener.topics = Topics()
+        for url in ('http://a.com/', 'http://b.com/'):
+            listener.topics.add(url, hub.topics[url])
+        hub.listeners.add('http://listener.com/', listener)
+        hub.upgrade_listener(listener)
+        self.assertEqual(listener.high_water, 2)
+        self.assertEqual(listener.topics, None)
+
+    @patch('pushhub.delivery.store_payload')
+    @patch('pushhub.delivery.enqueue_many')
+    def test_old_listener_told_of_topics_numbered_below(self, enqueue, store):
+        hub = Hub()
+        hub.topics = Topics()
+        hub.listeners = Listeners()
+        del hub.topic_log
+        # Topics from before numbering, added in the reverse of URL order
+        for url in ('http://c.com/', 'http://b.com/', 'http://a.com/'):
+            topic = Topic(url)
+            topic.content_type = 'atom'
+            hub.topics.add(url, topic)
+        listener = Listener('http://listener.com/')
+        del listener.high_water
+        listener.topics = Topics()
+        listener.topics.add('http://c.com/', hub.topics['http://c.com/'])
+        hub.listeners.add('http://listener.com/', listener)
+        hub.register_listener('http://listener.com/')
+        transaction.commit()
+        self.assertEqual(listener.high_water, 3)
+        self.assertEqual(enqueue.call_count, 1)
+        self.assertEqual(len(enqueue.call_args[0][1]), 2)
+        self.assertEqual(listener.unsent, None)
+
+        hub.register_listener('http://listener.com/')
+        transaction.commit()
+        self.assertEqual(enqueue.call_args[0][1], [])
+
+    @patch('pushhub.delivery.store_payload')
+    def test_notify_no_listeners(self, store):
+        hub = Hub()
+        hub.publish('http://www.site.com/')
+        hub.notify_listeners(hub.topics.values())
+        self.assertEqual(store.call_count, 0)
+
+    @patch('pushhub.client.get', new_callable=MockResponse, content=good_atom)
+    def test_fetch_marks_changed_topics(self, mock):
+        hub = Hub()
+        hub.publish('http://www.site.com/')
+        hub.publish('http://www.example.com/')
+        self.assertEqual(list(hub.get_changed_topics()), [])
+        hub.fetch_content(['http://www.site.com/'], 'http://hub.com')
+        self.assertEqual(list(hub.get_changed_topics()),
+                         ['http://www.site.com/'])
+
+    @patch('pushhub.client.get', new_callable=MockResponse, content=good_atom)
+    def test_fetch_all_marks_changed_topics(self, mock):
+        hub = Hub()
+        hub.publish('http://www.site.com/')
+        hub.publish('http://www.example.com/')
+        hub.fetch_all_content('http://hub.com')
+        self.assertEqual(len(hub.get_changed_topics()), 2)
+
+    @patch('pushhub.models.topic.Topic.notify_subscribers')
+    def test_notify_only_changed_topics(self, mock):
+        hub = Hub()
+        hub.publish('http://www.site.com/')
+        hub.publish('http://www.example.com/')
+        hub.topics['http://www.site.com/'].changed = True
+        hub.mark_changed(hub.topics.values())
+        hub.notify_subscribers()
+        self.assertEqual(mock.call_count, 1)
+        self.assertEqual(len(hub.get_changed_topics()), 0)
+        hub.notify_subscribers()
+        self.assertEqual(mock.call_count, 1)
+
+    @patch('pushhub.models.topic.Topic.notify_subscribers')
+    def test_changed_topics_built_for_old_hubs(self, mock):
+        hub = Hub()
+        hub.publish('http://www.site.com/')
+        hub.publish('http://www.example.com/')
+        hub.topics['http://www.example.com/'].changed = True
+        del hub.changed_topics
+        self.assertEqual(list(hub.get_changed_topics()),
+                         ['http://www.example.com/'])
+        hub.notify_subscribers()
+        self.assertEqual(mock.call_count, 1)
+
 
 class HubQueueTests(TestCase):
 
@@ -559,7 +1116,9 @@ class HubQueueTests(TestCase):
         topic.content_type = 'atom'
         topic.content = good_atom
         s1 = Subscriber('http://httpbin.org/get')
+        s1.id = 1
         s2 = Subscriber('http://github.com/')
+        s2.id = 2
         topic.add_subscriber(s1)
         topic.add_subscriber(s2)
         self.hub.topics.add(topic.url, topic)
@@ -583,13 +1142,198 @@ class ListenerTest(TestCase):
     def tearDown(self):
         pass
 
-    def test_notify_listener(self):
+    def test_notification(self):
         l = Listener('http://www.site.com/')
-        t = Topic('http://www.example.com/')
-        t.content_type = 'atom'
-        with patch('requests.get', new_callable=MockResponse, status_code=200):
-            response = l.notify(t)
-        self.assertEqual(response.status_code, 200)
+        headers = {'Content-Type': 'application/atom+xml'}
+        self.assertEqual(l.notification(headers, 'key'),
+                         ('http://www.site.com/', 'key', headers, 'GET'))
+
+
+class ContainerTests(TestCase):
+
+    def test_mapping(self):
+        c = Container()
+        t = Topic('http://www.google.com/')
+        c.add('http://www.google.com/', t)
+        self.assertEqual(len(c), 1)
+        self.assertTrue('http://www.google.com/' in c)
+        self.assertTrue(c['http://www.google.com/'] is t)
+        self.assertTrue(c.get('http://www.site.com/') is None)
+        self.assertEqual(list(c.keys()), ['http://www.google.com/'])
+        self.assertEqual(list(c), ['http://www.google.com/'])
+        self.assertRaises(KeyError, c.add, 'http://www.google.com/', t)
+        self.assertTrue(c.remove('http://www.google.com/') is t)
+        self.assertEqual(len(c), 0)
+        self.assertTrue(c)
+        self.assertRaises(KeyError, c.remove, 'http://www.google.com/')
+
+    def test_leaves_objects_untouched(self):
+        c = Container()
+        t = Topic('http://www.google.com/')
+        c.add('http://www.google.com/', t)
+        self.assertFalse('__parent__' in t.__dict__)
+        self.assertFalse('__name__' in t.__dict__)
+
+    def test_loads_folder_state(self):
+        folder = Folder()
+        folder.add('http://www.google.com/', Topic('http://www.google.com/'))
+        topics = Topics.__new__(Topics)
+        topics.__setstate__(folder.__getstate__())
+        self.assertEqual(len(topics), 1)
+        self.assertEqual(topics['http://www.google.com/'].url,
+                         'http://www.google.com/')
+        topics.add('http://www.site.com/', Topic('http://www.site.com/'))
+        self.assertEqual(len(topics), 2)
+
+    def test_migrate_folders(self):
+        hub = Hub()
+        hub.publish('http://www.google.com/')
+        hub.subscribers = Subscribers()
+        topic = hub.topics['http://www.google.com/']
+        subscriber = Subscriber('http://httpbin.org/get')
+        hub.subscribers.add(subscriber.callback_url, subscriber)
+        # As stored before URLs were interned
+        del topic.id
+        topic.subscribers = Folder()
+        topic.subscribers.add(subscriber.callback_url, subscriber)
+        subscriber.topics = Topics()
+        subscriber.topics.add(topic.url, topic)
+        topic.__parent__ = hub.topics
+        topic.__name__ = topic.url
+        topic.__dict__['content'] = good_atom
+        topic.__dict__['feed_index'] = index = FeedIndex(parse(good_atom))
+        checkpoints = []
+        counts = migrate_folders(hub, checkpoint=lambda: checkpoints.append(1),
+                                 batch_size=1)
+        self.assertEqual(counts, {'containers': 2, 'objects': 3})
+        self.assertEqual(len(checkpoints), 5)
+        self.assertEqual(topic.body.data, good_atom)
+        self.assertTrue(topic.body.index is index)
+        self.assertFalse('content' in topic.__dict__)
+        self.assertFalse('feed_index' in topic.__dict__)
+        self.assertEqual(list(topic.subscribers), [subscriber.id])
+        self.assertEqual(list(subscriber.topics), [topic.id])
+        self.assertFalse('__parent__' in topic.__dict__)
+        self.assertFalse('__parent__' in subscriber.__dict__)
+
+    def test_migrate_stored_folders(self):
+        db = DB(None)
+        conn = db.open()
+        hub = appmaker(conn.root())
+        hub.publish('http://www.google.com/')
+        hub.subscribe('http://httpbin.org/get', 'http://www.google.com/',
+                      verify_callbacks=False)
+        topic = hub.topics['http://www.google.com/']
+        subscriber = hub.subscribers['http://httpbin.org/get']
+        topic.__parent__ = subscriber.__parent__ = Folder()
+        topic.__name__ = topic.url
+        subscriber.__name__ = subscriber.callback_url
+        hub.listeners = Folder()
+        hub.listeners.order = []
+        transaction.commit()
+        conn.close()
+        db.cacheMinimize()
+
+        # Reopened, the objects are ghosts until their state is loaded
+        conn = db.open()
+        hub = conn.root()['app_root']
+        counts = migrate_folders(hub)
+        transaction.commit()
+        conn.close()
+        self.assertEqual(counts, {'containers': 0, 'objects': 2})
+
+        conn = db.open()
+        hub = conn.root()['app_root']
+        topic = hub.topics['http://www.google.com/']
+        subscriber = hub.subscribers['http://httpbin.org/get']
+        self.assertFalse(hasattr(topic, '__parent__'))
+        self.assertFalse(hasattr(subscriber, '__parent__'))
+        self.assertEqual(hub.listeners._order, None)
+        conn.close()
+        db.close()
+
+
+class URLTableTests(TestCase):
+
+    def test_intern(self):
+        urls = URLTable()
+        first = urls.intern('http://www.google.com/')
+        second = urls.intern('http://www.site.com/')
+        self.assertNotEqual(first, second)
+        self.assertEqual(urls.intern('http://www.google.com/'), first)
+        self.assertEqual(len(urls), 2)
+        self.assertEqual(urls.url_for(second), 'http://www.site.com/')
+        self.assertEqual(list(urls.urls_for([second, first])),
+                         ['http://www.site.com/', 'http://www.google.com/'])
+
+    def test_id_for_unknown_url(self):
+        urls = URLTable()
+        self.assertEqual(urls.id_for('http://www.google.com/'), None)
+        self.assertFalse('http://www.google.com/' in urls)
+        self.assertEqual(len(urls), 0)
+
+    def test_ids_fit_in_int_sets(self):
+        urls = URLTable()
+        urls._v_next_id = URLTable.max_id
+        self.assertEqual(urls.intern('http://www.google.com/'),
+                         URLTable.max_id)
+        self.assertTrue(0 <= urls.intern('http://www.site.com/')
+                        <= URLTable.max_id)
+
+    def test_old_subscriptions_upgraded_on_use(self):
+        hub = Hub()
+        del hub.url_table
+        hub.subscribers = Subscribers()
+        hub.topics = Topics()
+        topic = Topic('http://www.google.com/')
+        topic.subscribers = Container()
+        hub.topics.add(topic.url, topic)
+        subscriber = Subscriber('http://httpbin.org/get')
+        subscriber.topics = Topics()
+        hub.subscribers.add(subscriber.callback_url, subscriber)
+        topic.subscribers.add(subscriber.callback_url, subscriber)
+        topic.subscriber_counter.change(1)
+        subscriber.topics.add(topic.url, topic)
+        hub.unsubscribe('http://httpbin.org/get', 'http://www.google.com/',
+                        verify_callbacks=False)
+        self.assertEqual(len(topic.subscribers), 0)
+        self.assertEqual(len(subscriber.topics), 0)
+        self.assertEqual(hub.url_table.url_for(topic.id), topic.url)
+
+
+class FeedBodyTests(TestCase):
+
+    def tearDown(self):
+        body.configure()
+
+    def test_compressed(self):
+        b = FeedBody(good_atom)
+        self.assertEqual(b.codec, 'gzip')
+        self.assertTrue(len(b.encoded) < len(good_atom))
+        self.assertEqual(gzip_decompress(b.encoded), good_atom)
+        self.assertEqual(len(b), len(good_atom))
+        self.assertTrue(b.gzipped() is b.encoded)
+
+    def test_decompressed_once(self):
+        b = FeedBody(good_atom)
+        del b._v_data
+        self.assertEqual(b.data, good_atom)
+        self.assertTrue(b.data is b._v_data)
+
+    def test_configured_codec(self):
+        body.configure(codec='identity')
+        b = FeedBody(good_atom)
+        self.assertEqual(b.codec, 'identity')
+        self.assertEqual(b.encoded, good_atom)
+        self.assertEqual(b.gzipped(), gzip_compress(good_atom))
+        self.assertRaises(ValueError, body.configure, codec='lzma')
+
+    def test_uncompressed_bodies(self):
+        b = FeedBody.__new__(FeedBody)
+        b.__setstate__({'data': good_atom})
+        self.assertEqual(b.data, good_atom)
+        self.assertEqual(len(b), len(good_atom))
+        self.assertEqual(gzip_decompress(b.gzipped()), good_atom)
 
 
 class UtilTests(TestCase):
@@ -0,0 +1,138 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+from mock import Mock, patch
+
+from paste.util.multidict import MultiDict
+from pyramid import testing
+from pyramid.request import Request
+import transaction
+from ZODB.POSException import ConflictError
+
+from .mocks import DatabaseTestCase
+from ..models import appmaker
+from ..pings import IPingBuffer, PingBuffer, includeme
+from ..pipeline import IFetchPipeline
+from ..views import publish
+
+TOPIC = 'http://www.example.com/'
+
+
+class PingBufferTests(DatabaseTestCase):
+
+    def populate(self, hub):
+        hub.publish(TOPIC)
+
+    def setUp(self):
+        super(PingBufferTests, self).setUp()
+        # Flushed by hand unless a test stops the buffer
+        self.pings = PingBuffer(self.db, interval=3600)
+
+    def tearDown(self):
+        self.pings.stop()
+        super(PingBufferTests, self).tearDown()
+
+    def last_pinged(self):
+        return self.get_hub().topics[TOPIC].last_pinged
+
+    def test_keeps_latest_ping(self):
+        now = datetime.now()
+        self.pings.record(TOPIC, now)
+        self.pings.record(TOPIC, now - timedelta(seconds=1))
+        self.assertEqual(self.pings.pings, {TOPIC: now})
+
+    def test_flush_writes_pings(self):
+        pinged = datetime.now() + timedelta(seconds=60)
+        self.pings.record(TOPIC, pinged)
+        self.assertNotEqual(self.last_pinged(), pinged)
+        self.assertEqual(self.pings.flush(), 1)
+        self.assertEqual(self.last_pinged(), pinged)
+        self.assertEqual(self.pings.pings, {})
+        self.assertEqual(self.pings.flush(), 0)
+
+    def test_older_ping_not_written(self):
+        self.pings.record(TOPIC, datetime(2000, 1, 1))
+        self.pings.record('http://www.unknown.com/', datetime.now())
+        self.assertEqual(self.pings.flush(), 0)
+        self.assertNotEqual(self.last_pinged(), datetime(2000, 1, 1))
+
+    def test_pings_kept_after_conflicts(self):
+        pinged = datetime.now() + timedelta(seconds=60)
+        self.pings.record(TOPIC, pinged)
+        with patch('transaction.commit', side_effect=ConflictError):
+            self.assertEqual(self.pings.flush(), 0)
+        self.assertEqual(self.pings.pings, {TOPIC: pinged})
+        self.assertEqual(self.pings.flush(), 1)
+        self.assertEqual(self.last_pinged(), pinged)
+
+    def test_stop_flushes(self):
+        pinged = datetime.now() + timedelta(seconds=60)
+        self.pings.record(TOPIC, pinged)
+        self.pings.stop()
+        self.assertEqual(self.last_pinged(), pinged)
+
+    @patch('atexit.register')
+    def test_stopped_at_exit(self, register):
+        config = self.configure()
+        includeme(config)
+        pings = config.registry.getUtility(IPingBuffer)
+        register.assert_called_once_with(pings.stop)
+
+
+class PublishPingTests(TestCase):
+
+    valid_headers = [("Content-Type", "application/x-www-form-urlencoded")]
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.pings = Mock()
+        self.config.registry.registerUtility(self.pings, IPingBuffer)
+        self.config.registry.registerUtility(Mock(), IFetchPipeline)
+
+    def tearDown(self):
+        transaction.abort()
+        testing.tearDown()
+
+    def test_publish_buffers_ping(self):
+        data = MultiDict({'hub.mode': 'publish'})
+        data.add('hub.url', TOPIC)
+        request = Request.blank('/publish', headers=self.valid_headers,
+                                POST=data)
+        request.root = hub = appmaker({})
+        hub.publish(TOPIC)
+        last_pinged = hub.topics[TOPIC].last_pinged
+        request.registry = self.config.registry
+        info = publish(None, request)
+
+        self.assertEqual(info.status_code, 204)
+        self.pings.record.assert_called_once_with(TOPIC)
+        self.assertEqual(hub.topics[TOPIC].last_pinged, last_pinged)
@@ -0,0 +1,201 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from unittest import TestCase
+from mock import Mock, patch
+
+from paste.util.multidict import MultiDict
+from pyramid import testing
+from pyramid.request import Request
+import transaction
+from ZODB.POSException import ConflictError
+
+from .mocks import DatabaseTestCase, MockResponse, good_atom
+from ..models import appmaker
+from ..pipeline import FetchPipeline, IFetchPipeline
+from ..views import publish
+
+
+class FetchPipelineTests(DatabaseTestCase):
+
+    def populate(self, hub):
+        hub.publish('http://www.example.com/')
+        hub.publish('http://www.site.com/')
+
+    def setUp(self):
+        super(FetchPipelineTests, self).setUp()
+        self.pipeline = FetchPipeline(self.db, workers=2, debounce=0)
+
+    def tearDown(self):
+        self.pipeline.stop()
+        super(FetchPipelineTests, self).tearDown()
+
+    @patch('pushhub.client.get', new_callable=MockResponse, content=good_atom)
+    def test_submitted_topics_are_fetched(self, mock):
+        self.pipeline.submit(['http://www.example.com/'], 'http://hub.com')
+        self.pipeline.join()
+        hub = self.get_hub()
+        fetched = hub.topics.get('http://www.example.com/')
+        other = hub.topics.get('http://www.site.com/')
+        self.assertTrue('John Doe' in fetched.content)
+        self.assertTrue(other.content is None)
+
+    @patch('pushhub.client.get', new_callable=MockResponse, content="bad")
+    def test_failed_batch_is_aborted(self, mock):
+        self.pipeline.submit(['http://www.example.com/'], 'http://hub.com')
+        self.pipeline.join()
+        hub = self.get_hub()
+        topic = hub.topics.get('http://www.example.com/')
+        self.assertTrue(topic.timestamp is None)
+
+    @patch('pushhub.delivery.store_payload')
+    @patch('pushhub.delivery.enqueue_many')
+    def test_retry_after_conflict_fetches_and_queues_once(self, enqueue,
+                                                          store):
+        conn = self.db.open()
+        appmaker(conn.root()).subscribe('http://sub.com/',
+                                        'http://www.example.com/',
+                                        verify_callbacks=False)
+        transaction.commit()
+        conn.close()
+
+        commit = transaction.commit
+        attempts = []
+
+        def conflict_once():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise ConflictError
+            commit()
+
+        fetch = Mock(return_value=MockResponse(content=good_atom))
+        with patch('pushhub.client.get', new=fetch):
+            with patch('transaction.commit', side_effect=conflict_once):
+                self.pipeline.process(['http://www.example.com/'],
+                                      'http://hub.com')
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(enqueue.call_count, 1)
+        hub = self.get_hub()
+        topic = hub.topics.get('http://www.example.com/')
+        self.assertTrue('John Doe' in topic.content)
+
+    def test_pings_merge_into_waiting_fetch(self):
+        pipeline = FetchPipeline(self.db, workers=2, debounce=0.2)
+        self.addCleanup(pipeline.stop)
+        fetch = Mock(return_value=MockResponse(content=good_atom))
+        with patch('pushhub.client.get', new=fetch):
+            for i in range(5):
+                pipeline.submit(['http://www.example.com/'], 'http://hub.com')
+            pipeline.join()
+        self.assertEqual(fetch.call_count, 1)
+
+    def test_pings_during_fetch_fetch_once_more(self):
+        def fetch(url, **kwargs):
+            if len(urls) == 0:
+                for i in range(3):
+                    self.pipeline.submit([url], 'http://hub.com')
+            urls.append(url)
+            return MockResponse(content=good_atom)
+
+        urls = []
+        with patch('pushhub.client.get', new=fetch):
+            self.pipeline.submit(['http://www.example.com/'],
+                                 'http://hub.com')
+            self.pipeline.join()
+        self.assertEqual(urls, ['http://www.example.com/'] * 2)
+
+    def test_topic_locked_by_another_process(self):
+        connection = Mock()
+        connection.lock.return_value.acquire.return_value = False
+        pipeline = FetchPipeline(self.db, workers=1, debounce=0,
+                                 connection=connection)
+        self.addCleanup(pipeline.stop)
+        fetch = Mock(return_value=MockResponse(content=good_atom))
+        with patch('pushhub.client.get', new=fetch):
+            pipeline.submit(['http://www.example.com/'], 'http://hub.com')
+            pipeline.join()
+        self.assertFalse(fetch.called)
+        key = pipeline.lock_key('http://www.example.com/', 'again')
+        connection.set.assert_called_once_with(key, 'http://hub.com',
+                                               ex=60)
+
+    def test_pinged_in_another_process_fetch_once_more(self):
+        connection = Mock()
+        connection.lock.return_value.acquire.return_value = True
+        connection.pipeline.return_value.execute.side_effect = [
+            ['http://hub.com', 1], [None, 0]]
+        pipeline = FetchPipeline(self.db, workers=1, debounce=0,
+                                 connection=connection)
+        self.addCleanup(pipeline.stop)
+        fetch = Mock(return_value=MockResponse(content=good_atom))
+        with patch('pushhub.client.get', new=fetch):
+            pipeline.submit(['http://www.example.com/'], 'http://hub.com')
+            pipeline.join()
+        self.assertEqual(fetch.call_count, 2)
+        self.assertEqual(connection.lock.return_value.release.call_count, 2)
+
+    def test_full_pipeline_drops_batches(self):
+        pipeline = FetchPipeline(self.db, workers=0, max_pending=1)
+        self.assertTrue(pipeline.submit(['http://www.example.com/'], ''))
+        self.assertFalse(pipeline.submit(['http://www.site.com/'], ''))
+
+
+class PublishPipelineTests(TestCase):
+
+    valid_headers = [("Content-Type", "application/x-www-form-urlencoded")]
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.pipeline = Mock()
+        self.config.registry.registerUtility(self.pipeline, IFetchPipeline)
+
+    def tearDown(self):
+        transaction.abort()
+        testing.tearDown()
+
+    @patch('pushhub.client.get', new_callable=MockResponse, content=good_atom)
+    def test_publish_defers_fetching(self, mock):
+        data = MultiDict({'hub.mode': 'publish'})
+        data.add('hub.url', 'http://www.example.com/')
+        request = Request.blank('/publish', headers=self.valid_headers,
+                                POST=data)
+        request.root = hub = appmaker({})
+        request.registry = self.config.registry
+        info = publish(None, request)
+
+        self.assertEqual(info.status_code, 204)
+        topic = hub.topics.get('http://www.example.com/')
+        self.assertTrue(topic.timestamp is None)
+        self.assertFalse(self.pipeline.submit.called)
+
+        transaction.commit()
+        self.pipeline.submit.assert_called_once_with(
+            ['http://www.example.com/'], 'http://localhost')
@@ -30,12 +30,14 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 from unittest import TestCase
 
-from feedparser import parse
+from feedparser import FeedParserDict, parse
+from mock import Mock
 
 from .mocks import good_atom, updated_atom
 from .mocks import no_author_good_atom, no_author_updated_atom
 
-from ..utils import FeedComparator
+from ..utils import Atom1FeedKwargs, Counters, FeedComparator, FeedIndex
+from ..utils import get_primary_database
 
 
 class BaseComparatorTestCase(TestCase):
@@ -104,6 +106,29 @@ class TestFeedMetaDataChanged(BaseComparatorTestCase):
         self.assertEqual(changed_metadata['feed']['title'], 'Updated Feed')
 
 
+class TestFeedMetadataCopies(BaseComparatorTestCase):
+
+    def test_metadata_is_not_the_parsed_feed(self):
+        changed_metadata = self.compare.changed_metadata()
+        changed_metadata['feed']['title'] = 'Changed'
+        changed_metadata['entries'] = []
+        self.assertEqual(self.new_parsed['feed']['title'], 'Updated Feed')
+        self.assertTrue(len(self.new_parsed['entries']) > 0)
+
+
+class TestAtom1FeedKwargs(TestCase):
+
+    def test_dict_values_are_not_modified(self):
+        feed = Atom1FeedKwargs(title=u'Feed', link=u'http://site.com/',
+                               description=u'')
+        value = {'value': u'Text', 'type': u'text/plain', 'lang': None}
+        feed.add_item(u'Title', u'http://site.com/1', u'', rights=value)
+        output = feed.writeString('utf-8')
+        self.assertTrue('<rights type="text/plain">Text</rights>' in output)
+        self.assertEqual(
+            value, {'value': u'Text', 'type': u'text/plain', 'lang': None})
+
+
 class TestFeedNoAuthor(BaseComparatorTestCase):
     """This is the same as TestFeedMetaDataChanged, but with atom feeds
     with no author.
@@ -119,3 +144,83 @@ class TestFeedNoAuthor(BaseComparatorTestCase):
     def test_feed_tag_title_changed(self):
         changed_metadata = self.compare.changed_metadata()
         self.assertEqual(changed_metadata['feed']['title'], 'Updated Feed')
+
+
+class TestFeedIndexComparison(BaseComparatorTestCase):
+    """The same comparisons, diffing against an index of the old feed."""
+
+    def setUp(self):
+        self.compare = FeedComparator(self.new_parsed,
+                                      FeedIndex(self.old_parsed))
+
+    def test_new_entries(self):
+        new_entries = self.compare.new_entries()
+        self.assertEqual([e['title'] for e in new_entries], ['Colby Nolan'])
+
+    def test_updated_entries(self):
+        updated_entries = self.compare.updated_entries()
+        self.assertEqual([e['title'] for e in updated_entries],
+                         ['Heathcliff', 'Felix'])
+
+    def test_removed_entries(self):
+        removed_entries = self.compare.removed_entries()
+        self.assertEqual([e['id'] for e in removed_entries],
+                         ['http://publisher.example.com/happycat23s.xml'])
+
+    def test_metadata_from_new_feed(self):
+        changed_metadata = self.compare.changed_metadata()
+        self.assertEqual(changed_metadata['feed']['title'], 'Updated Feed')
+
+
+class TestFeedUpdatedOnce(TestCase):
+
+    def feed(self, updated, link):
+        return FeedParserDict(
+            feed=FeedParserDict(title=u'Feed'),
+            entries=[FeedParserDict(
+                id=u'1', title=u'Entry', updated_parsed=updated, link=link)],
+        )
+
+    def test_date_and_link_changed(self):
+        past = self.feed((2012, 1, 1), u'http://site.com/old')
+        new = self.feed((2013, 1, 1), u'http://site.com/new')
+        compare = FeedComparator(new, past)
+        self.assertEqual(len(compare.updated_entries()), 1)
+
+    def test_undated_content_changed(self):
+        past = self.feed(None, u'http://site.com/')
+        new = self.feed(None, u'http://site.com/')
+        new.entries[0]['summary'] = u'Changed'
+        compare = FeedComparator(new, past)
+        self.assertEqual(len(compare.updated_entries()), 1)
+        compare = FeedComparator(past, past)
+        self.assertEqual(len(compare.updated_entries()), 0)
+
+
+class TestCounters(TestCase):
+
+    def test_incr(self):
+        counters = Counters('hits', 'misses')
+        counters.incr('hits')
+        counters.incr('hits', 2)
+        self.assertEqual(counters.snapshot(), {'hits': 3, 'misses': 0})
+
+    def test_reset(self):
+        counters = Counters('hits')
+        counters.incr('hits')
+        counters.incr('other')
+        counters.reset()
+        self.assertEqual(counters.snapshot(), {'hits': 0})
+
+
+class TestGetPrimaryDatabase(TestCase):
+
+    def test_no_databases(self):
+        config = Mock(registry=Mock(spec=[]))
+        self.assertEqual(get_primary_database(config), None)
+
+    def test_primary_database(self):
+        db = Mock()
+        config = Mock()
+        config.registry._zodb_databases = {'': db, 'other': Mock()}
+        self.assertTrue(get_primary_database(config) is db)
@@ -0,0 +1,266 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import threading
+from unittest import TestCase
+from mock import Mock, patch
+
+from paste.util.multidict import MultiDict
+from pyramid import testing
+from pyramid.request import Request
+from requests.exceptions import ConnectionError
+
+from .mocks import DatabaseTestCase, MockResponse
+from ..models import appmaker
+from ..models.hub import Hub
+from ..verifier import IVerifierPool, VerifierPool, includeme
+from ..views import subscribe, DEFAULT_LEASE_SECONDS
+
+CHALLENGE = 'abcdefg'
+
+
+class VerifierPoolTests(DatabaseTestCase):
+
+    def setUp(self):
+        super(VerifierPoolTests, self).setUp()
+        self.pool = VerifierPool(self.db, workers=3, batch_wait=0.05)
+        patcher = patch.object(Hub, 'get_challenge_string',
+                               return_value=CHALLENGE)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.pool.stop()
+        super(VerifierPoolTests, self).tearDown()
+
+    def subscriptions(self):
+        hub = self.get_hub()
+        if hub.subscribers is None:
+            return []
+        urls = hub.get_url_table()
+        return sorted(
+            (callback_url, topic_url)
+            for callback_url, subscriber in hub.subscribers.items()
+            for topic_url in urls.urls_for(subscriber.topics)
+        )
+
+    @patch('pushhub.client.get', new_callable=MockResponse,
+           content=CHALLENGE, status_code=200)
+    def test_verified_intents_are_applied(self, mock):
+        for i in range(5):
+            self.pool.submit('http://sub%d.com/' % i,
+                             'http://www.example.com/', 'subscribe')
+        self.pool.join()
+        self.assertEqual(len(self.subscriptions()), 5)
+
+        self.pool.submit('http://sub0.com/', 'http://www.example.com/',
+                         'unsubscribe')
+        self.pool.join()
+        self.assertEqual(len(self.subscriptions()), 4)
+
+    @patch('pushhub.client.get', new_callable=MockResponse,
+           content=CHALLENGE, status_code=200)
+    def test_lease_is_sent_and_recorded(self, mock):
+        with patch('pushhub.client.get') as get:
+            get.return_value = MockResponse(content=CHALLENGE,
+                                            status_code=200)
+            self.pool.submit('http://sub.com/', 'http://www.example.com/',
+                             'subscribe', 3600)
+            self.pool.join()
+        params = get.call_args[1]['params']
+        self.assertEqual(params['hub.lease_seconds'], 3600)
+        self.assertNotEqual(self.get_hub().get_lease(
+            'http://sub.com/', 'http://www.example.com/'), None)
+
+    @patch('pushhub.client.get', new_callable=MockResponse,
+           content='wrong', status_code=200)
+    def test_unverified_intents_are_dropped(self, mock):
+        self.pool.submit('http://sub.com/', 'http://www.example.com/',
+                         'subscribe')
+        self.pool.join()
+        self.assertEqual(self.subscriptions(), [])
+
+    @patch('pushhub.client.get')
+    def test_unreachable_subscribers_are_dropped(self, mock):
+        mock.side_effect = ConnectionError
+        self.pool.submit('http://sub.com/', 'http://www.example.com/',
+                         'subscribe')
+        self.pool.join()
+        self.assertEqual(self.subscriptions(), [])
+
+    @patch('pushhub.client.get', new_callable=MockResponse,
+           content=CHALLENGE, status_code=200)
+    def test_intents_are_committed_in_batches(self, mock):
+        pool = VerifierPool(self.db, workers=3, batch_size=2,
+                            batch_wait=0.05)
+        self.addCleanup(pool.stop)
+        batches = []
+        apply = pool.apply
+        pool.apply = lambda intents: (batches.append(len(intents)),
+                                      apply(intents))
+        for i in range(5):
+            pool.submit('http://sub%d.com/' % i,
+                        'http://www.example.com/', 'subscribe')
+        pool.join()
+        self.assertEqual(sum(batches), 5)
+        self.assertTrue(max(batches) <= 2)
+        self.assertEqual(len(self.subscriptions()), 5)
+
+    @patch('pushhub.client.get', new_callable=MockResponse,
+           content=CHALLENGE, status_code=200)
+    def test_stop_applies_pending_intents(self, mock):
+        for i in range(5):
+            self.pool.submit('http://sub%d.com/' % i,
+                             'http://www.example.com/', 'subscribe')
+        self.pool.stop()
+        self.assertEqual(len(self.subscriptions()), 5)
+
+    @patch('atexit.register')
+    def test_stopped_at_exit(self, register):
+        config = self.configure()
+        includeme(config)
+        pool = config.registry.getUtility(IVerifierPool)
+        register.assert_called_once_with(pool.stop)
+
+    def verify_after_unsubscribe(self, unsubscribe_verified=True):
+        """
+        Patches verification so subscribe intents only finish once an
+        unsubscribe intent has been handled.
+        """
+        handled = threading.Event()
+
+        def verify(cls, callback_url, topic_url, mode, lease_seconds=None):
+            if mode == 'subscribe':
+                handled.wait(5)
+                return True
+            handled.set()
+            return unsubscribe_verified
+
+        patcher = patch.object(Hub, 'verify_intent',
+                               new=classmethod(verify))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_superseded_intents_are_dropped(self):
+        self.verify_after_unsubscribe()
+        self.pool.submit('http://sub.com/', 'http://www.example.com/',
+                         'subscribe')
+        self.pool.submit('http://sub.com/', 'http://www.example.com/',
+                         'unsubscribe')
+        self.pool.join()
+        self.assertEqual(self.subscriptions(), [])
+        self.assertEqual(self.pool._pairs, {})
+
+    def test_intent_kept_when_later_one_is_unverified(self):
+        self.verify_after_unsubscribe(unsubscribe_verified=False)
+        self.pool.submit('http://sub.com/', 'http://www.example.com/',
+                         'subscribe')
+        self.pool.submit('http://sub.com/', 'http://www.example.com/',
+                         'unsubscribe')
+        self.pool.join()
+        self.assertEqual(self.subscriptions(),
+                         [('http://sub.com/', 'http://www.example.com/')])
+
+    @patch('pushhub.client.get', new_callable=MockResponse,
+           content=CHALLENGE, status_code=200)
+    def test_verifier_survives_errors(self, mock):
+        pool = VerifierPool(self.db, workers=1, batch_wait=0.05)
+        self.addCleanup(pool.stop)
+        verify = Hub.verify_intent.im_func
+
+        def flaky(cls, callback_url, *args):
+            if callback_url == 'http://bad.com/':
+                raise ValueError('bad')
+            return verify(cls, callback_url, *args)
+
+        with patch.object(Hub, 'verify_intent', new=classmethod(flaky)):
+            pool.submit('http://bad.com/', 'http://www.example.com/',
+                        'subscribe')
+            pool.submit('http://sub.com/', 'http://www.example.com/',
+                        'subscribe')
+            pool.join()
+        self.assertEqual(self.subscriptions(),
+                         [('http://sub.com/', 'http://www.example.com/')])
+
+    def test_full_pool_refuses_intents(self):
+        pool = VerifierPool(self.db, workers=0, max_pending=1)
+        self.addCleanup(pool.stop)
+        self.assertTrue(pool.submit('http://a.com/', 'http://b.com/',
+                                    'subscribe'))
+        self.assertFalse(pool.submit('http://a.com/', 'http://c.com/',
+                                     'subscribe'))
+
+
+class AsyncSubscribeTests(TestCase):
+
+    valid_headers = [("Content-Type", "application/x-www-form-urlencoded")]
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.pool = Mock()
+        self.pool.submit.return_value = True
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def subscribe(self, register=True):
+        if register:
+            self.config.registry.registerUtility(self.pool, IVerifierPool)
+        data = MultiDict({
+            'hub.callback': 'http://httpbin.org/get',
+            'hub.mode': 'subscribe',
+            'hub.topic': 'http://www.google.com/',
+            'hub.verify': 'async',
+        })
+        request = Request.blank('/subscribe', headers=self.valid_headers,
+                                POST=data)
+        request.root = appmaker({})
+        request.registry = self.config.registry
+        return subscribe(None, request)
+
+    @patch('pushhub.client.get')
+    def test_async_is_accepted(self, mock):
+        info = self.subscribe()
+        self.assertEqual(info.status_code, 202)
+        args = self.pool.submit.call_args[0]
+        self.assertEqual(args[:3], (
+            'http://httpbin.org/get', 'http://www.google.com/', 'subscribe'))
+        self.assertTrue(0.9 * DEFAULT_LEASE_SECONDS <= args[3] <=
+                        DEFAULT_LEASE_SECONDS)
+        self.assertFalse(mock.called)
+
+    def test_async_without_pool(self):
+        info = self.subscribe(register=False)
+        self.assertEqual(info.status_code, 400)
+
+    def test_async_pool_full(self):
+        self.pool.submit.return_value = False
+        info = self.subscribe()
+        self.assertEqual(info.status_code, 503)
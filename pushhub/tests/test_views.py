@@ -28,12 +28,14 @@ OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import time
 import unittest
 
-from mock import patch
+from mock import Mock, patch
 from paste.util.multidict import MultiDict
 from pyramid import testing
 from pyramid.request import Request
+import transaction
 
 from .mocks import MockResponse, MultiResponse, good_atom
 from ..models.hub import Hub
@@ -47,8 +49,10 @@ class BaseTest(unittest.TestCase):
         self.config = testing.setUp()
         # Create an in-memory instance of the hub so requests can use it
         self.root = Hub()
+        transaction.begin()
 
     def tearDown(self):
+        transaction.abort()
         testing.tearDown()
         self.root = None
         self.challenge = None
@@ -60,6 +64,7 @@ class BaseTest(unittest.TestCase):
                             headers=headers,
                             POST=POST)
         req.root = self.root
+        req.registry = self.config.registry
         return req
 
 
@@ -69,7 +74,7 @@ urls = {
 }
 
 
-@patch('requests.get', new_callable=MultiResponse, mapping=urls)
+@patch('pushhub.client.get', new_callable=MultiResponse, mapping=urls)
 class PublishTests(BaseTest):
 
     valid_headers = [("Content-Type", "application/x-www-form-urlencoded")]
@@ -105,7 +110,7 @@ class PublishTests(BaseTest):
         headers = [("Content-Type", "application/x-www-form-urlencoded")]
         data = {'hub.mode': 'publish', 'hub.url': 'http://www.google.com/'}
         request = self.r('/publish', headers, POST=data)
-        with patch('requests.get', new_callable=MockResponse, status_code=204):
+        with patch('pushhub.client.get', new_callable=MockResponse, status_code=204):
             info = publish(None, request)
         self.assertEqual(info.status_code, 204)
 
@@ -150,6 +155,36 @@ class PublishTests(BaseTest):
         #self.assertTrue('John Doe' in first.content)
         #self.assertTrue('John Doe' in second.content)
 
+    def test_retried_publish_fetches_once(self, mock):
+        data = MultiDict({'hub.mode': 'publish'})
+        data.add('hub.url', 'http://www.example.com/')
+        request = self.r('/publish', self.valid_headers, POST=data)
+        fetch = Mock(return_value=MockResponse(content=good_atom))
+        with patch('pushhub.client.get', new=fetch):
+            publish(None, request)
+            # As if the first attempt had hit a ConflictError
+            transaction.abort()
+            info = publish(None, request)
+        self.assertEqual(info.status_code, 204)
+        self.assertEqual(fetch.call_count, 1)
+        topic = self.root.topics.get('http://www.example.com/')
+        self.assertTrue(topic.timestamp is not None)
+
+    def test_publish_only_fetches_pinged_topics(self, mock):
+        self.root.publish('http://www.site.com/')
+        data = MultiDict({'hub.mode': 'publish'})
+        data.add('hub.url', 'http://www.example.com/')
+        request = self.r('/publish', self.valid_headers, POST=data)
+        hub = request.root
+        info = publish(None, request)
+
+        pinged = hub.topics.get('http://www.example.com/')
+        other = hub.topics.get('http://www.site.com/')
+
+        self.assertEqual(info.status_code, 204)
+        self.assertTrue(pinged.timestamp is not None)
+        self.assertTrue(other.timestamp is None)
+
     # XXX: Need to change this to use the new queue system
     #def test_callback_requests_queued(self, mock):
     #    """
@@ -223,7 +258,7 @@ class SubscribeTests(BaseTest):
             '/subscribe',
             POST=data
         )
-        with patch('requests.get', new_callable=MockResponse,
+        with patch('pushhub.client.get', new_callable=MockResponse,
                    content=self.challenge, status_code=200):
             info = subscribe(None, request)
         self.assertEqual(info.status_code, 204)
@@ -262,10 +297,63 @@ class SubscribeTests(BaseTest):
             '/subscribe',
             POST=data
         )
-        with patch('requests.get', new_callable=MockResponse,
+        with patch('pushhub.client.get', new_callable=MockResponse,
+                   content=self.challenge, status_code=200):
+            info = subscribe(None, request)
+        self.assertEqual(info.status_code, 204)
+
+    @patch.object(Hub, 'get_challenge_string')
+    def test_lease_seconds(self, mock_get_challenge_string):
+        data = self.default_data.copy()
+        data.add('hub.lease_seconds', '3600')
+        mock_get_challenge_string.return_value = self.challenge
+        request = self.r(
+            '/subscribe',
+            POST=data
+        )
+        with patch('pushhub.client.get', new_callable=MockResponse,
                    content=self.challenge, status_code=200):
             info = subscribe(None, request)
         self.assertEqual(info.status_code, 204)
+        expires = self.root.get_lease('http://httpbin.org/get',
+                                      'http://www.google.com/')
+        self.assertTrue(expires <= time.time() + 3600)
+        self.assertTrue(expires >= time.time() + 3200)
+
+    @patch.object(Hub, 'get_challenge_string')
+    def test_retried_subscribe_verifies_once(self, mock_get_challenge_string):
+        mock_get_challenge_string.return_value = self.challenge
+        request = self.r('/subscribe', POST=self.default_data.copy())
+        verify = Mock(return_value=MockResponse(content=self.challenge,
+                                                status_code=200))
+        with patch('pushhub.client.get', new=verify):
+            subscribe(None, request)
+            # As if the first attempt had hit a ConflictError
+            transaction.abort()
+            info = subscribe(None, request)
+        self.assertEqual(info.status_code, 204)
+        self.assertEqual(verify.call_count, 1)
+        subscriber = self.root.subscribers.get('http://httpbin.org/get')
+        self.assertEqual(len(subscriber.topics), 1)
+
+    def test_not_verified_subscription_writes_nothing(self):
+        request = self.r('/subscribe', POST=self.default_data.copy())
+        with patch('pushhub.client.get', new_callable=MockResponse,
+                   status_code=404):
+            info = subscribe(None, request)
+        self.assertEqual(info.status_code, 409)
+        self.assertEqual(self.root.subscribers, None)
+
+    def test_invalid_lease_seconds(self):
+        data = self.default_data.copy()
+        data.add('hub.lease_seconds', 'soon')
+        request = self.r(
+            '/subscribe',
+            POST=data,
+        )
+        info = subscribe(None, request)
+        self.assertEqual(info.status_code, 400)
+        self.assertTrue('hub.lease_seconds' in info.body)
 
     def test_invalid_mode(self):
         data = self.default_data.copy()
@@ -287,7 +375,7 @@ class SubscribeTests(BaseTest):
             '/subscribe',
             POST=data
         )
-        with patch('requests.get', new_callable=MockResponse,
+        with patch('pushhub.client.get', new_callable=MockResponse,
                    content=self.challenge, status_code=200):
             info = subscribe(None, request)
         self.assertEqual(info.status_code, 204)
@@ -300,7 +388,7 @@ class SubscribeTests(BaseTest):
             '/subscribe',
             POST=data
         )
-        with patch('requests.get', new_callable=MockResponse,
+        with patch('pushhub.client.get', new_callable=MockResponse,
                    content=self.challenge, status_code=200):
             info = subscribe(None, request)
         self.assertEqual(info.status_code, 204)
@@ -325,7 +413,7 @@ class SubscribeTests(BaseTest):
             '/subscribe',
             POST=data
         )
-        with patch('requests.get', new_callable=MockResponse, status_code=404):
+        with patch('pushhub.client.get', new_callable=MockResponse, status_code=404):
             info = subscribe(None, request)
         self.assertEqual(info.status_code, 409)
 
@@ -349,20 +437,21 @@ class SubscribeTests(BaseTest):
                     status_code=200
             )
         }
-        with patch('requests.get', new_callable=MultiResponse, mapping=urls):
+        with patch('pushhub.client.get', new_callable=MultiResponse, mapping=urls):
             subscribe(None, request)
 
         hub = self.root
         topic = hub.topics.get('http://www.google.com/')
         subscriber = hub.subscribers.get('http://httpbin.org/get')
-        self.assertEqual(
-            topic, subscriber.topics.get('http://www.google.com/'))
+        self.assertTrue(topic.id in subscriber.topics)
+        self.assertTrue(subscriber.id in topic.subscribers)
 
 
-@patch('requests.get', new_callable=MockResponse, content=good_atom)
+@patch('pushhub.delivery.get_connection')
+@patch('pushhub.client.get', new_callable=MockResponse, content=good_atom)
 @patch('requests.post', new_callable=MockResponse, status_code=200)
 class ListenTests(BaseTest):
-    def test_adding_listener(self, mock_get, mock_post):
+    def test_adding_listener(self, mock_get, mock_post, connection):
         request = self.r('/listen',
                          POST={'listener.callback': 'http://www.example.com/'})
         self.root.publish('http://www.site.com/')
@@ -373,7 +462,7 @@ class ListenTests(BaseTest):
         l = self.root.listeners.get('http://www.example.com/')
         self.assertTrue(l)
 
-    def test_failing_listener(self, mock_get, mock_post):
+    def test_failing_listener(self, mock_get, mock_post, connection):
         """
         The listener's callback response doesn't matter at this stage;
         it will only be tested at the queue.
@@ -388,7 +477,7 @@ class ListenTests(BaseTest):
         l = self.root.listeners.get('http://www.example.com', None)
         self.assertEqual(l.callback_url, 'http://www.example.com')
 
-    def test_bad_topic_content_type(self, mock_get, mock_post):
+    def test_bad_topic_content_type(self, mock_get, mock_post, connection):
         """
         If the content type on the feed is bad, let the listener know.
         """
@@ -401,7 +490,7 @@ class ListenTests(BaseTest):
         )
         self.assertEqual(response.status_code, 400)
 
-    def test_bad_callback_url(self, mock_get, mock_post):
+    def test_bad_callback_url(self, mock_get, mock_post, connection):
         request = self.r('/listen',
                          POST={'listener.callback': 'htt://www.example'})
         self.root.publish('http://www.site.com/')
@@ -0,0 +1,387 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from collections import deque
+from itertools import count
+import threading
+import time
+from unittest import TestCase
+
+from mock import Mock, patch
+from redis.exceptions import LockError
+from requests.exceptions import ConnectionError, HTTPError, ReadTimeout
+from rq import Queue as JobQueue
+
+from .. import client
+from ..worker import DeliveryWorker, is_transient, percentile
+from .test_fetcher import ConcurrencyRecorder
+
+enqueued = count()
+
+
+class FakeJob(object):
+    """A queued delivery that posts to its callback URL."""
+    def __init__(self, url, ordered=False):
+        self.id = url
+        self.args = (url, 'key', {})
+        self.meta = {'ordered': ordered}
+        self.enqueued_at = next(enqueued)
+
+    def perform(self):
+        return client.post(self.args[0])
+
+
+class FakeWorker(DeliveryWorker):
+    """Takes jobs from a list instead of Redis."""
+    def __init__(self, jobs, **kwargs):
+        kwargs.setdefault('poll', 0.01)
+        kwargs.setdefault('backoff', 0)
+        super(FakeWorker, self).__init__(Mock(), **kwargs)
+        self.jobs = deque(jobs)
+        self.finished = []
+        self.failed = []
+        self.requeued = []
+
+    def _dequeue(self, block):
+        if self.jobs:
+            return self.jobs.popleft()
+        return None
+
+    def _finished(self, job):
+        self.finished.append(job)
+
+    def _failed(self, job, exc_info):
+        self.failed.append((job, exc_info[1]))
+
+    def _requeue(self, job):
+        self.requeued.append(job)
+
+
+class FlakyPost(object):
+    """Mocks ``client.post``, failing the first calls to each URL."""
+    def __init__(self, failures, error=ConnectionError):
+        self.failures = failures
+        self.error = error
+        self.calls = {}
+
+    def __call__(self, url, *args, **kwargs):
+        self.calls[url] = self.calls.get(url, 0) + 1
+        if self.calls[url] <= self.failures:
+            raise self.error('failed')
+        return Mock(status_code=200)
+
+
+def http_error(status):
+    """Returns an error factory for ``FlakyPost`` answering with ``status``."""
+    def error(message):
+        return HTTPError(message, response=Mock(status_code=status))
+    return error
+
+
+class OrderRecorder(object):
+    """Mocks ``client.post``, recording the order of successful posts."""
+    def __init__(self, failures=0):
+        self.lock = threading.Lock()
+        self.failures = failures
+        self.active = 0
+        self.max_active = 0
+        self.calls = []
+        self.delivered = []
+
+    def __call__(self, url, *args, **kwargs):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.calls.append(url)
+            failed = len(self.calls) <= self.failures
+        time.sleep(0.005)
+        with self.lock:
+            self.active -= 1
+            if failed:
+                raise ConnectionError('failed')
+            self.delivered.append(url)
+        return Mock(status_code=200)
+
+
+class OrderedJob(FakeJob):
+    """A listener notification; the callback URL is shared."""
+    def __init__(self, name):
+        super(OrderedJob, self).__init__('http://listener.com/', True)
+        self.id = name
+
+    def perform(self):
+        return client.post(self.id)
+
+
+class DeliveryWorkerTests(TestCase):
+
+    def jobs(self, hosts, per_host):
+        return [
+            FakeJob('http://host%d.com/%d' % (h, i))
+            for h in range(hosts)
+            for i in range(per_host)
+        ]
+
+    def test_all_jobs_delivered(self):
+        worker = FakeWorker(self.jobs(3, 5), concurrency=4, per_host=2)
+        with patch('pushhub.client.post', new=ConcurrencyRecorder(0)):
+            report = worker.run(burst=True)
+        self.assertEqual(len(worker.finished), 15)
+        self.assertEqual(report['delivered'], 15)
+        self.assertEqual(report['failed'], 0)
+
+    def test_concurrency_limits(self):
+        recorder = ConcurrencyRecorder()
+        worker = FakeWorker(self.jobs(4, 6), concurrency=6, per_host=2)
+        with patch('pushhub.client.post', new=recorder):
+            worker.run(burst=True)
+        self.assertEqual(len(worker.finished), 24)
+        self.assertTrue(recorder.max_active <= 6)
+        self.assertEqual(recorder.max_per_host, 2)
+        self.assertTrue(recorder.max_active > 2)
+
+    def test_retries_connection_errors(self):
+        post = FlakyPost(failures=2)
+        worker = FakeWorker(self.jobs(1, 2), attempts=3)
+        with patch('pushhub.client.post', new=post):
+            report = worker.run(burst=True)
+        self.assertEqual(len(worker.finished), 2)
+        self.assertEqual(report['retried'], 4)
+        self.assertEqual(post.calls.values(), [3, 3])
+
+    def test_fails_after_attempts(self):
+        post = FlakyPost(failures=5)
+        worker = FakeWorker(self.jobs(1, 1), attempts=3)
+        with patch('pushhub.client.post', new=post):
+            report = worker.run(burst=True)
+        self.assertEqual(report['failed'], 1)
+        self.assertEqual(len(worker.failed), 1)
+        self.assertEqual(post.calls.values(), [3])
+
+    def test_other_errors_are_not_retried(self):
+        post = FlakyPost(failures=1, error=ValueError)
+        worker = FakeWorker(self.jobs(1, 1), attempts=3)
+        with patch('pushhub.client.post', new=post):
+            worker.run(burst=True)
+        self.assertEqual(len(worker.failed), 1)
+        self.assertTrue(isinstance(worker.failed[0][1], ValueError))
+        self.assertEqual(post.calls.values(), [1])
+
+    def test_retries_timeouts(self):
+        post = FlakyPost(failures=1, error=ReadTimeout)
+        worker = FakeWorker(self.jobs(1, 1), attempts=3)
+        with patch('pushhub.client.post', new=post):
+            report = worker.run(burst=True)
+        self.assertEqual(len(worker.finished), 1)
+        self.assertEqual(report['retried'], 1)
+
+    def test_retries_server_errors(self):
+        post = FlakyPost(failures=1, error=http_error(503))
+        worker = FakeWorker(self.jobs(1, 1), attempts=3)
+        with patch('pushhub.client.post', new=post):
+            report = worker.run(burst=True)
+        self.assertEqual(len(worker.finished), 1)
+        self.assertEqual(report['retried'], 1)
+        self.assertEqual(post.calls.values(), [2])
+
+    def test_client_errors_are_not_retried(self):
+        post = FlakyPost(failures=1, error=http_error(404))
+        worker = FakeWorker(self.jobs(1, 1), attempts=3)
+        with patch('pushhub.client.post', new=post):
+            report = worker.run(burst=True)
+        self.assertEqual(report['retried'], 0)
+        self.assertEqual(len(worker.failed), 1)
+        self.assertTrue(isinstance(worker.failed[0][1], HTTPError))
+        self.assertEqual(post.calls.values(), [1])
+
+    def test_is_transient(self):
+        self.assertTrue(is_transient(ConnectionError()))
+        self.assertTrue(is_transient(ReadTimeout()))
+        self.assertTrue(is_transient(http_error(500)('failed')))
+        self.assertFalse(is_transient(http_error(410)('failed')))
+        self.assertFalse(is_transient(ValueError()))
+
+    def test_stop_requeues_pending_retries(self):
+        worker = FakeWorker(self.jobs(1, 1), attempts=3, backoff=60)
+        jobs = worker.jobs
+
+        def dequeue(block):
+            if jobs:
+                return jobs.popleft()
+            worker.stop()
+
+        worker._dequeue = dequeue
+        with patch('pushhub.client.post', new=FlakyPost(failures=1)):
+            report = worker.run()
+        self.assertEqual(report['retried'], 1)
+        self.assertEqual(len(worker.requeued), 1)
+
+    def test_ordered_jobs_one_at_a_time(self):
+        recorder = OrderRecorder()
+        jobs = [OrderedJob(str(i)) for i in range(10)]
+        worker = FakeWorker(jobs, concurrency=4, per_host=4)
+        with patch('pushhub.client.post', new=recorder):
+            worker.run(burst=True)
+        self.assertEqual(recorder.max_active, 1)
+        self.assertEqual(recorder.delivered, [str(i) for i in range(10)])
+
+    def test_ordered_jobs_wait_for_retries(self):
+        recorder = OrderRecorder(failures=1)
+        jobs = [OrderedJob(str(i)) for i in range(3)]
+        worker = FakeWorker(jobs, concurrency=4, attempts=3)
+        with patch('pushhub.client.post', new=recorder):
+            report = worker.run(burst=True)
+        self.assertEqual(report['retried'], 1)
+        self.assertEqual(recorder.calls, ['0', '0', '1', '2'])
+        self.assertEqual(recorder.delivered, ['0', '1', '2'])
+
+    def test_failing_listener_does_not_stall_others(self):
+        jobs = [OrderedJob('http://listener.com/%d' % i) for i in range(50)]
+        jobs.extend(self.jobs(2, 5))
+        delivered = []
+
+        def post(url, *args, **kwargs):
+            if url.startswith('http://listener.com/'):
+                raise ConnectionError('failed')
+            delivered.append(url)
+            return Mock(status_code=200)
+
+        worker = FakeWorker(jobs, concurrency=4, attempts=3, backoff=60)
+        jobs = worker.jobs
+
+        def dequeue(block):
+            if jobs:
+                return jobs.popleft()
+            if len(delivered) == 10:
+                worker.stop()
+
+        worker._dequeue = dequeue
+        with patch('pushhub.client.post', new=post):
+            report = worker.run()
+        self.assertEqual(report['delivered'], 10)
+        self.assertEqual(report['retried'], 1)
+        # The listener's notifications are handed back, pushed to the
+        # front of the queue last first, so they keep their order.
+        self.assertEqual([job.id for job in reversed(worker.requeued)],
+                         ['http://listener.com/%d' % i for i in range(50)])
+
+    def test_buffered_jobs_are_bounded(self):
+        jobs = [OrderedJob('http://listener.com/%d' % i) for i in range(50)]
+        worker = FakeWorker(jobs, concurrency=4, attempts=3, backoff=60,
+                            max_buffered=20)
+
+        timer = threading.Timer(0.1, worker.stop)
+        timer.start()
+        with patch('pushhub.client.post', new=FlakyPost(failures=1)):
+            worker.run()
+        # The first job waiting for its retry, and 20 behind it
+        self.assertEqual(len(worker.requeued), 21)
+        self.assertEqual(len(worker.jobs), 29)
+
+    def test_report(self):
+        worker = FakeWorker([])
+        worker.run(burst=True)
+        worker.latencies.extend([0.001 * i for i in range(1, 101)])
+        report = worker.report()
+        self.assertAlmostEqual(report['p50'], 51, 0)
+        self.assertAlmostEqual(report['p99'], 99, 0)
+        self.assertTrue('Delivered 0' in worker.format_report(report))
+
+
+class OrderedQueueTests(TestCase):
+
+    def setUp(self):
+        self.connection = Mock()
+        self.lock = self.connection.lock.return_value
+        self.worker = DeliveryWorker(self.connection, 'notify',
+                                     lock_timeout=30)
+
+    def dequeued_from(self):
+        with patch.object(JobQueue, 'dequeue_any',
+                          return_value=None) as dequeue:
+            self.worker._dequeue(block=False)
+        return [queue.name for queue in dequeue.call_args[0][0]]
+
+    def test_lock_is_per_queue(self):
+        self.connection.lock.assert_called_once_with(
+            'pushhub:lock:ordered:notify', timeout=30)
+
+    def test_ordered_queue_left_without_lock(self):
+        self.lock.acquire.return_value = False
+        self.assertFalse(self.worker.claim_ordered())
+        self.lock.acquire.assert_called_once_with(blocking=False)
+        self.assertEqual(self.dequeued_from(), ['notify'])
+
+    def test_ordered_queue_taken_with_lock(self):
+        self.lock.acquire.return_value = True
+        self.assertTrue(self.worker.claim_ordered())
+        # The queues take turns going first
+        self.assertEqual(self.dequeued_from(), ['notify:ordered', 'notify'])
+        self.assertEqual(self.dequeued_from(), ['notify', 'notify:ordered'])
+
+    def test_lock_is_renewed(self):
+        self.lock.acquire.return_value = True
+        self.worker.claim_ordered(now=100)
+        self.worker.claim_ordered(now=105)
+        self.assertEqual(self.lock.reacquire.call_count, 0)
+        self.worker.claim_ordered(now=110)
+        self.assertEqual(self.lock.reacquire.call_count, 1)
+        self.assertEqual(self.lock.acquire.call_count, 1)
+
+    def test_lost_lock(self):
+        self.lock.acquire.return_value = True
+        self.lock.reacquire.side_effect = LockError
+        self.worker.claim_ordered(now=100)
+        self.assertFalse(self.worker.claim_ordered(now=110))
+        self.assertEqual(self.dequeued_from(), ['notify'])
+
+    def test_lock_released_on_exit(self):
+        worker = FakeWorker([])
+        worker.ordered_lock.acquire.return_value = True
+        worker.run(burst=True)
+        self.assertTrue(worker.ordered_lock.release.called)
+        self.assertFalse(worker.owns_ordered)
+
+    def test_ordered_jobs_requeued_to_ordered_queue(self):
+        with patch.object(JobQueue, 'push_job_id', autospec=True) as push:
+            self.worker._requeue(OrderedJob('a'))
+            self.worker._requeue(FakeJob('http://host.com/'))
+        self.assertEqual([(call[0][0].name, call[0][1])
+                          for call in push.call_args_list],
+                         [('notify:ordered', 'a'),
+                          ('notify', 'http://host.com/')])
+
+
+class PercentileTests(TestCase):
+
+    def test_percentile(self):
+        self.assertEqual(percentile([], 0.5), 0.0)
+        self.assertEqual(percentile([1, 2, 3], 0.5), 2)
+        self.assertEqual(percentile([1, 2, 3], 1), 3)
@@ -31,12 +31,15 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 Various utility functions.
 """
-from copy import deepcopy
+from hashlib import sha1
+import threading
 import urllib
 import urlparse
+import zlib
 
 from functools import wraps
 
+from feedparser import FeedParserDict
 from pyramid.httpexceptions import exception_response
 from webhelpers.feedgenerator import Atom1Feed
 
@@ -75,6 +78,46 @@ def require_post(fn):
     return wrapper
 
 
+def once_per_request(request, key, func, *args, **kwargs):
+    """
+    Calls func once per request, returning the first result again when
+    the request is retried after a ZODB conflict.
+
+    The result is kept in the WSGI environ, which is shared by every
+    attempt at a request, so network I/O such as fetching a topic or
+    verifying a subscriber isn't repeated by retries.
+    """
+    results = request.environ.setdefault('pushhub.once', {})
+    if key not in results:
+        results[key] = func(*args, **kwargs)
+    return results[key]
+
+
+def get_primary_database(config):
+    """
+    Returns the primary ZODB database pyramid_zodbconn has configured,
+    or None if it hasn't configured one.
+    """
+    databases = getattr(config.registry, '_zodb_databases', None) or {}
+    return databases.get('')
+
+
+def gzip_compress(data, level=6):
+    """
+    Compresses data with gzip framing, so the result can be sent as is
+    with a ``Content-Encoding: gzip`` header.
+    """
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def gzip_decompress(data):
+    """Decompresses data compressed by gzip_compress."""
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
 # taken from the pubsubhubbub source
 def normalize_iri(url):
     """Converts a URL (possibly containing unicode characters) to an IRI.
@@ -113,6 +156,82 @@ def is_valid_url(url):
     return True
 
 
+class Counters(object):
+    """Named counters that can be updated from several threads."""
+
+    def __init__(self, *names):
+        self._lock = threading.Lock()
+        self._names = names
+        self._values = dict.fromkeys(names, 0)
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    def snapshot(self):
+        """Returns a copy of the current values."""
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values = dict.fromkeys(self._names, 0)
+
+
+def entry_fingerprint(entry):
+    """Returns a digest of an entry's title, summary and content."""
+    values = [entry.get('title'), entry.get('summary')]
+    values.extend(c.get('value') for c in entry.get('content', []))
+    digest = sha1()
+    for value in values:
+        if value:
+            digest.update(value.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class FeedIndex(object):
+    def __init__(self, parsed):
+        """
+        A compact summary of a parsed feed, holding just what
+        FeedComparator needs to diff a newer version of the feed
+        against it.
+
+        Arguments:
+            * parsed: The parsed feed to summarize
+        """
+        feed = parsed['feed']
+        self.title = feed.get('title')
+        self.author = feed.get('author')
+        self.key_count = len(feed.keys())
+        # id -> (updated_parsed, link, fingerprint); if an id repeats,
+        # the first entry with it wins. Only undated entries are compared
+        # by content, so only they get a fingerprint.
+        self.entries = entries = {}
+        for entry in parsed.entries:
+            entry_id = entry.get('id')
+            if entry_id in entries:
+                continue
+            updated_parsed = entry.get('updated_parsed')
+            if updated_parsed is None:
+                fingerprint = entry_fingerprint(entry)
+            else:
+                fingerprint = None
+            entries[entry_id] = (
+                updated_parsed,
+                entry.get('link'),
+                fingerprint,
+            )
+
+    def entry(self, entry_id):
+        """Returns the summary of an entry as a FeedParserDict."""
+        updated_parsed, link, fingerprint = self.entries[entry_id]
+        return FeedParserDict(
+            id=entry_id,
+            updated_parsed=updated_parsed,
+            link=link,
+        )
+
+
 class FeedComparator(object):
     def __init__(self, new_feed, past_feed):
         """
@@ -120,27 +239,84 @@ class FeedComparator(object):
 
         Arguments:
             * new_feed: The parsed feed of the newer content
-            * past_feed: The parsed feed of an older version of the content.
+            * past_feed: The parsed feed of an older version of the
+                         content, or the FeedIndex of one.
         """
         self.new_feed = new_feed
-        self.past_feed = past_feed
+        if isinstance(past_feed, FeedIndex):
+            self.past_feed = None
+            self.past_index = past_feed
+        else:
+            self.past_feed = past_feed
+            self.past_index = FeedIndex(past_feed)
+        self._diff = None
 
-    def new_entries(self):
+    def compare(self):
         """
-        Finds new entries in the feed and returns them.
+        Classifies the entries of the new feed in a single pass over it.
 
-        New entries are determined by comparing the set of IDs
-        found in each feed.
+        Returns a (new, updated, removed, metadata_changed) tuple. The
+        result is computed once and shared by the other methods.
         """
-        new = []
-        new_entry_ids = [e.id for e in self.new_feed.entries]
-        past_entry_ids = [e.id for e in self.past_feed.entries]
+        if self._diff is not None:
+            return self._diff
 
+        new = []
+        updated = []
+        seen = set()
+        past_entries = self.past_index.entries
         for entry in self.new_feed.entries:
-            if entry.id in new_entry_ids and entry.id not in past_entry_ids:
+            entry_id = entry.get('id')
+            seen.add(entry_id)
+            past = past_entries.get(entry_id)
+            if past is None:
                 new.append(entry)
+            elif self._is_updated(entry, past):
+                updated.append(entry)
+
+        if self.past_feed is not None:
+            removed = [
+                entry for entry in self.past_feed.entries
+                if entry.get('id') not in seen
+            ]
+        else:
+            removed = [
+                self.past_index.entry(past_id)
+                for past_id in past_entries
+                if past_id not in seen
+            ]
+
+        self._diff = (new, updated, removed, self._is_metadata_changed())
+        return self._diff
+
+    def _is_updated(self, entry, past):
+        past_updated, past_link, past_fingerprint = past
+        updated_parsed = entry.get('updated_parsed')
+        if updated_parsed > past_updated:
+            return True
+        if entry.get('link') != past_link:
+            return True
+        if updated_parsed is None and past_updated is None:
+            return entry_fingerprint(entry) != past_fingerprint
+        return False
 
-        return new
+    def _is_metadata_changed(self):
+        past = self.past_index
+        new_feed = self.new_feed['feed']
+        return (
+            past.title != new_feed.get('title') or
+            past.author != new_feed.get('author', None) or
+            len(new_feed.keys()) > past.key_count
+        )
+
+    def new_entries(self):
+        """
+        Finds new entries in the feed and returns them.
+
+        New entries are determined by comparing the set of IDs
+        found in each feed.
+        """
+        return self.compare()[0]
 
     def updated_entries(self):
         """
@@ -148,32 +324,19 @@ class FeedComparator(object):
 
         Entries are differentiated by their ID, and are considered updated
         if the parsed date/time of the new entry is more recent than the
-        old entry's.
+        old entry's, or their link changed. Entries without dates are
+        compared by content. Each updated entry is returned once.
         """
-
-        updated = []
-        past_ids = [e.id for e in self.past_feed.entries]
-        for entry in self.new_feed.entries:
-            if entry.id not in past_ids:
-                continue
-
-            idx = past_ids.index(entry.id)
-            past_entry = self.past_feed.entries[idx]
-            if entry.updated_parsed > past_entry.updated_parsed:
-                updated.append(entry)
-            if entry.link != past_entry.link:
-                updated.append(entry)
-        return updated
+        return self.compare()[1]
 
     def removed_entries(self):
-        removed = []
-        new_ids = [e.id for e in self.new_feed.entries]
-        for entry in self.past_feed.entries:
-            if entry.id in new_ids:
-                continue
+        """
+        Finds entries of the past feed missing from the new one.
 
-            removed.append(entry)
-        return removed
+        When only an index of the past feed is available, the entries
+        are summaries holding their id, date and link.
+        """
+        return self.compare()[2]
 
     def changed_metadata(self):
         """
@@ -181,26 +344,22 @@ class FeedComparator(object):
 
         If *any* of the attributes have changed, we use them all.
         """
-        changed = False
-
-        past_feed = self.past_feed['feed']
-        new_feed = self.new_feed['feed']
-
-        if past_feed['title'] != new_feed['title']:
-            changed = True
+        changed = self.compare()[3]
 
-        if past_feed.get('author', None) != new_feed.get('author', None):
-            changed = True
-
-        if len(new_feed.keys()) > len(past_feed.keys()):
-            changed = True
-
-        if changed:
-            metadata = deepcopy(self.new_feed)
+        # Only an index of the past feed may be available, in which case
+        # the unchanged metadata is taken from the new feed.
+        if changed or self.past_feed is None:
+            source = self.new_feed
         else:
-            metadata = deepcopy(self.past_feed)
-
-        del metadata['entries']
+            source = self.past_feed
+
+        # Copy the top level and the feed header so callers can change
+        # them; the entries are left out rather than copied and dropped.
+        metadata = FeedParserDict(
+            (key, value) for key, value in source.items()
+            if key != 'entries'
+        )
+        metadata['feed'] = FeedParserDict(source['feed'])
         return metadata
 
 
@@ -243,16 +402,16 @@ class Atom1FeedKwargs(Atom1Feed):
         if isinstance(value, dict):
             # Handle a dictionary and assume the "value" is what
             # will be the text of the element.
-            value = deepcopy(value)
-            el_content = value.pop('value', '')
+            el_content = value.get('value', '')
             # The xml parser can't handle a None value
-            for k, v in value.items():
-                if v is None:
-                    value.pop(k)
-            if value.get("type") == "application/xhtml+xml": # XXX: fragile
-                self.add_xml_element(handler, key, el_content, value)
+            attrs = dict(
+                (k, v) for k, v in value.items()
+                if k != 'value' and v is not None
+            )
+            if attrs.get("type") == "application/xhtml+xml": # XXX: fragile
+                self.add_xml_element(handler, key, el_content, attrs)
             else:
-                handler.addQuickElement(key, el_content, value)
+                handler.addQuickElement(key, el_content, attrs)
         elif isinstance(value, (list, tuple)):
             # Loop over a list and add each item
             for item in value:
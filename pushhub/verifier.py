@@ -0,0 +1,310 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Asynchronous verification of subscription requests.
+
+A subscribe request with ``hub.verify=async`` is answered right away.
+The intent is queued here, where a pool of threads sends the challenge
+requests to subscribers concurrently. Verified intents are applied to the
+hub in batches by a single thread with its own ZODB connection, so the
+slow round trips never hold a transaction open.
+
+Intents finish verifying in any order, so each is numbered when it is
+submitted. A verified intent is dropped if a later one for the same
+callback and topic has already been applied; otherwise a slow subscribe
+could undo the unsubscribe sent after it.
+
+Pending intents are kept in memory only. When the process exits they are
+verified and applied before it stops, but a process that is killed loses
+them, and their subscribers have to send their requests again.
+"""
+
+import atexit
+from itertools import count
+from Queue import Queue, Empty, Full
+import threading
+import time
+
+import transaction
+from requests.exceptions import RequestException
+from ZODB.POSException import ConflictError
+from zope.interface import Interface, implements
+
+from .models import appmaker
+from .models.hub import Hub
+from .utils import get_primary_database
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class IVerifierPool(Interface):
+    """Marker interface for the asynchronous verification pool"""
+    pass
+
+
+def apply_intents(hub, intents):
+    """
+    Applies verified (callback_url, topic_url, mode, lease_seconds)
+    intents to a hub.
+    """
+    for callback_url, topic_url, mode, lease_seconds in intents:
+        if mode == 'subscribe':
+            hub.subscribe(callback_url, topic_url, verify_callbacks=False,
+                          lease_seconds=lease_seconds)
+        else:
+            hub.unsubscribe(callback_url, topic_url, verify_callbacks=False)
+
+
+class VerifierPool(object):
+    implements(IVerifierPool)
+
+    def __init__(self, db, workers=10, batch_size=100, batch_wait=1.0,
+                 attempts=3, max_pending=10000):
+        """
+        Verifies queued subscription intents and records them in batches.
+
+        Arguments:
+            * db: The ZODB database holding the hub
+            * workers: How many verification requests run concurrently
+            * batch_size: The most verified intents applied per commit
+            * batch_wait: Seconds to wait for a batch to fill up
+            * attempts: How many times a batch is tried on ConflictError
+            * max_pending: How many intents may wait for verification
+                           before new ones are refused
+        """
+        self.db = db
+        self.workers = workers
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+        self.attempts = attempts
+        self.intents = Queue(max_pending)
+        self.verified = Queue()
+        self.threads = []
+        self.committer = None
+        self._lock = threading.Lock()
+        # (callback_url, topic_url) -> [intents pending, newest applied],
+        # for pairs with intents still pending
+        self._pairs = {}
+        self._pairs_lock = threading.Lock()
+        self._sequence = count(1)
+
+    def start(self):
+        """Starts the verifier and committer threads if not running yet."""
+        with self._lock:
+            if self.committer is not None:
+                return
+            for i in xrange(self.workers):
+                thread = threading.Thread(
+                    target=self._verify,
+                    name='pushhub-verify-%d' % i,
+                )
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            self.committer = threading.Thread(
+                target=self._commit,
+                name='pushhub-verify-commit',
+            )
+            self.committer.daemon = True
+            self.committer.start()
+
+    def stop(self):
+        """Stops the threads once the pending intents are done."""
+        with self._lock:
+            if self.committer is None:
+                return
+            for thread in self.threads:
+                self.intents.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.verified.put(None)
+            self.committer.join()
+            self.threads = []
+            self.committer = None
+
+    def join(self):
+        """Blocks until every submitted intent has been handled."""
+        self.intents.join()
+        self.verified.join()
+
+    def submit(self, callback_url, topic_url, mode, lease_seconds=None):
+        """
+        Queues a subscription intent for verification. The lease, if
+        given, is sent to the subscriber and recorded once verified.
+
+        Returns False if too many intents are pending and this one was
+        refused.
+        """
+        self.start()
+        pair = (callback_url, topic_url)
+        with self._pairs_lock:
+            sequence = next(self._sequence)
+            self._pairs.setdefault(pair, [0, 0])[0] += 1
+        try:
+            self.intents.put_nowait((sequence, (callback_url, topic_url,
+                                                mode, lease_seconds)))
+        except Full:
+            self._done(pair)
+            logger.warning('Verifier pool full, refused %s of %s to %s'
+                           % (mode, callback_url, topic_url))
+            return False
+        return True
+
+    def _done(self, pair):
+        with self._pairs_lock:
+            entry = self._pairs[pair]
+            entry[0] -= 1
+            if not entry[0]:
+                del self._pairs[pair]
+
+    def _newest(self, batch):
+        """
+        Returns the intents of a batch that no later intent for the same
+        callback and topic has been applied before, in the order given.
+        """
+        intents = []
+        with self._pairs_lock:
+            for sequence, intent in batch:
+                entry = self._pairs[intent[:2]]
+                if sequence < entry[1]:
+                    logger.info('Dropped %s of %s to %s, superseded by a '
+                                'later request' % (intent[2], intent[0],
+                                                   intent[1]))
+                    continue
+                entry[1] = sequence
+                intents.append(intent)
+        return intents
+
+    def _verify(self):
+        while True:
+            item = self.intents.get()
+            try:
+                if item is None:
+                    return
+                sequence, intent = item
+                try:
+                    verified = Hub.verify_intent(*intent)
+                except RequestException as e:
+                    logger.info('Could not reach subscriber %s: %s'
+                                % (intent[0], e))
+                    verified = False
+                except Exception:
+                    logger.exception('Failed verifying %s of %s to %s'
+                                     % (intent[2], intent[0], intent[1]))
+                    verified = False
+                if verified:
+                    self.verified.put(item)
+                else:
+                    logger.info('Could not verify %s of %s to %s'
+                                % (intent[2], intent[0], intent[1]))
+                    self._done(intent[:2])
+            finally:
+                self.intents.task_done()
+
+    def _commit(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            item = self.verified.get()
+            deadline = time.time() + self.batch_wait
+            while True:
+                if item is None:
+                    stopping = True
+                    self.verified.task_done()
+                else:
+                    batch.append(item)
+                if stopping or len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.verified.get(
+                        timeout=max(0, deadline - time.time()))
+                except Empty:
+                    break
+            if batch:
+                try:
+                    intents = self._newest(batch)
+                    if intents:
+                        self.apply(intents)
+                finally:
+                    for sequence, intent in batch:
+                        self._done(intent[:2])
+                        self.verified.task_done()
+
+    def apply(self, intents):
+        """
+        Records a batch of verified intents in one transaction, retrying
+        on write conflicts.
+        """
+        for attempt in xrange(self.attempts):
+            conn = self.db.open()
+            try:
+                hub = appmaker(conn.root())
+                apply_intents(hub, intents)
+                transaction.commit()
+                logger.info('Applied %d verified subscription changes'
+                            % len(intents))
+                return
+            except ConflictError:
+                transaction.abort()
+                logger.info('Conflict applying %d subscription changes, '
+                            'attempt %d' % (len(intents), attempt + 1))
+            except Exception:
+                transaction.abort()
+                logger.exception('Failed applying %d subscription changes'
+                                 % len(intents))
+                return
+            finally:
+                conn.close()
+        logger.warning('Gave up applying %d subscription changes after %d '
+                       'attempts' % (len(intents), self.attempts))
+
+
+def includeme(config):
+    """
+    Registers a VerifierPool for the primary ZODB database, if
+    pyramid_zodbconn has configured one.
+    """
+    db = get_primary_database(config)
+    if db is None:
+        return
+
+    settings = config.registry.settings
+    pool = VerifierPool(
+        db,
+        workers=int(settings.get('pushhub.verify_workers', 10)),
+        batch_size=int(settings.get('pushhub.verify_batch_size', 100)),
+        attempts=int(settings.get('tm.attempts', 3)),
+        max_pending=int(settings.get('pushhub.verify_max_pending', 10000)),
+    )
+    config.registry.registerUtility(pool, IVerifierPool)
+    # Verify and apply the intents still pending when the process exits
+    atexit.register(pool.stop)
@@ -29,8 +29,13 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 from pyramid.httpexceptions import exception_response
+import transaction
 
+from .pings import IPingBuffer
+from .pipeline import IFetchPipeline, process_topics
+from .verifier import IVerifierPool
 from .utils import require_post, is_valid_url, normalize_iri
+from .utils import once_per_request
 
 import logging
 logger = logging.getLogger(__name__)
@@ -56,32 +61,36 @@ def publish(context, request):
         error_msg = "No topic URLs provided"
 
     hub = request.root
+    pings = request.registry.queryUtility(IPingBuffer)
 
     for topic_url in topic_urls:
         try:
-            hub.publish(topic_url)
+            hub.publish(topic_url, pings=pings)
         except ValueError:
             bad_data = True
             error_msg = "Malformed URL: %s" % topic_url
 
-    if not bad_data:
-        topics = [
-            topic
-            for (url, topic) in hub.topics.items()
-            if url in topic_urls
-        ]
-        # XXX: Currently this is needed to ensure the listener gets
-        #      the latest data.
-        hub.fetch_content(topic_urls, request.application_url)
-        hub.notify_listeners(topics)
-        hub.fetch_all_content(request.application_url)
-
     if bad_data and error_msg:
         return exception_response(400,
                                   body=error_msg,
                                   headers=[('Content-Type', 'text/plain')])
 
-    hub.notify_subscribers()
+    # Only the pinged topics are fetched here; sweeping the rest of
+    # the hub is left to the scheduled ``fetch_all_topics`` script.
+    pipeline = request.registry.queryUtility(IFetchPipeline)
+    if pipeline is None:
+        # Retries of this request apply the same responses instead of
+        # fetching the topics again
+        fetches = once_per_request(request, 'fetches', hub.fetch_responses,
+                                   topic_urls, request.application_url)
+        process_topics(hub, topic_urls, request.application_url, fetches)
+    else:
+        # The workers use their own connections, so they can only see
+        # new topics once this request has committed.
+        def submit(success):
+            if success:
+                pipeline.submit(topic_urls, request.application_url)
+        transaction.get().addAfterCommitHook(submit)
 
     return exception_response(204)
 
@@ -106,6 +115,15 @@ def subscribe(context, request):
     )
 
     error_message = None
+    try:
+        lease_seconds = int(lease_seconds)
+    except ValueError:
+        lease_seconds = 0
+    if lease_seconds <= 0:
+        error_message = (
+            'Invalid parameter: hub.lease_seconds; '
+            'must be a positive number of seconds'
+        )
     if not callback or not is_valid_url(callback):
         error_message = (
             'Invalid parameter: hub.callback; '
@@ -152,13 +170,29 @@ def subscribe(context, request):
         )
 
     hub = request.root
+    lease_seconds = once_per_request(request, 'lease_seconds',
+                                     hub.jitter_lease, lease_seconds)
 
     # give preference to sync
     if 'sync' in verify_type:
-        if mode == 'subscribe':
-            verified = hub.subscribe(callback, topic, verify_callbacks=verify_callbacks)
+        # The subscriber is asked to verify before anything is written,
+        # and only once, even if the request is retried after a conflict.
+        if not verify_callbacks:
+            verified = True
+        elif mode == 'subscribe':
+            verified = once_per_request(request, 'verified',
+                                        hub.verify_intent, callback, topic,
+                                        mode, lease_seconds)
         else:
-            verified = hub.unsubscribe(callback, topic, verify_callbacks=verify_callbacks)
+            verified = once_per_request(request, 'verified',
+                                        hub.verify_intent, callback, topic,
+                                        mode)
+
+        if verified and mode == 'subscribe':
+            hub.subscribe(callback, topic, verify_callbacks=False,
+                          lease_seconds=lease_seconds)
+        elif verified:
+            hub.unsubscribe(callback, topic, verify_callbacks=False)
 
         if not verified:
             return exception_response(
@@ -168,16 +202,22 @@ def subscribe(context, request):
             )
             logger.info('Could not verify intent for subscriber %s', callback)
     else:
-        # TODO: async verification
-        # should return a 202 and then perform verification
-        # at a later date as determined by the hub
-        # we'll return a 400 right now until it's supported
-        return exception_response(
-            400,
-            body="async verification currently not supported",
-            headers=[("Content-Type", "text/plain")]
-        )
-        logger.info('Request for async verification by %s', callback)
+        verifier = request.registry.queryUtility(IVerifierPool)
+        if verifier is None:
+            return exception_response(
+                400,
+                body="async verification currently not supported",
+                headers=[("Content-Type", "text/plain")]
+            )
+        # The intent is verified and recorded later by the verifier pool
+        if not verifier.submit(callback, topic, mode, lease_seconds):
+            return exception_response(
+                503,
+                body="Too many pending verifications, try again later",
+                headers=[("Content-Type", "text/plain")]
+            )
+        logger.info('Queued async verification for %s', callback)
+        return exception_response(202)
     # verified and active
     return exception_response(204)
 
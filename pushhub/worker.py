@@ -0,0 +1,452 @@
+"""
+Copyright (c) 2013, Regents of the University of California
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+  * Neither the name of the University of California nor the names of its
+    contributors may be used to endorse or promote products derived from this
+    software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+A delivery worker for the notification queue.
+
+The worker takes jobs from the rq queue and runs many of them at once on
+a pool of threads, instead of forking a process per job like rq's own
+worker. Requests to the same callback host are limited so one slow
+subscriber can't hold every thread, and failed requests are retried with
+exponential backoff; a callback that answers with a client error won't
+do better next time, so those go straight to the failed queue. Jobs
+queued as ordered, like listener notifications, are sent one at a time
+per callback URL. They have a queue of their own, and only the worker
+holding a lock in Redis takes jobs from it; other workers leave it alone
+until the lock is released or expires, so running several workers
+doesn't reorder them. Connections are reused through the shared HTTP
+client.
+
+Jobs are only touched by the thread running ``run``; the pool threads
+just call the job function and hand back the outcome.
+"""
+
+from collections import deque
+import heapq
+from itertools import count
+from Queue import Queue, Empty
+from urlparse import urlparse
+import sys
+import threading
+import time
+import traceback
+
+from redis.exceptions import LockError
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+from rq import Queue as JobQueue
+from rq.exceptions import DequeueTimeout
+from rq.queue import get_failed_queue
+
+from .delivery import ORDERED_SUFFIX
+from .utils import Counters
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def is_transient(exc):
+    """
+    Returns whether a failed delivery is worth trying again: the callback
+    couldn't be reached, didn't answer in time or had a server error.
+    """
+    if isinstance(exc, HTTPError):
+        return exc.response is None or exc.response.status_code >= 500
+    return isinstance(exc, (ConnectionError, Timeout))
+
+
+def percentile(values, fraction):
+    """Returns the value below which ``fraction`` of sorted values fall."""
+    if not values:
+        return 0.0
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+class DeliveryWorker(object):
+    def __init__(self, connection, queue_name='default', concurrency=20,
+                 per_host=4, attempts=5, backoff=1.0, max_backoff=300.0,
+                 poll=1, max_buffered=10000, lock_timeout=60):
+        """
+        Delivers queued notifications concurrently.
+
+        Arguments:
+            * connection: The Redis connection the queue lives on
+            * queue_name: The rq queue to take jobs from
+            * concurrency: The most deliveries in flight at once
+            * per_host: The most deliveries in flight to any callback host
+            * attempts: How many times a delivery is tried before failing
+            * backoff: Seconds to wait before the first retry; each
+                       further retry waits twice as long
+            * max_backoff: The longest wait between retries
+            * poll: Seconds to block waiting for new jobs
+            * max_buffered: The most jobs taken from the queue and
+                            waiting to be sent, including those behind a
+                            busy host or a listener being retried
+            * lock_timeout: Seconds the ordered queue stays claimed by
+                            this worker after it last renewed the lock,
+                            e.g. if it dies without releasing it
+        """
+        self.queue = JobQueue(queue_name, connection=connection)
+        self.ordered_queue = JobQueue(queue_name + ORDERED_SUFFIX,
+                                      connection=connection)
+        self.ordered_lock = connection.lock(
+            'pushhub:lock:ordered:' + queue_name, timeout=lock_timeout)
+        self.lock_timeout = lock_timeout
+        self.owns_ordered = False
+        self._next_claim = 0
+        self._turn = 0
+        self.concurrency = max(1, concurrency)
+        self.per_host = max(1, per_host)
+        self.attempts = max(1, attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll = poll
+        self.max_buffered = max(self.concurrency * 2, max_buffered)
+        self.stats = Counters('delivered', 'retried', 'failed')
+        # Seconds taken by recent deliveries, for latency percentiles
+        self.latencies = deque(maxlen=10000)
+        self.started = None
+        self._stopping = threading.Event()
+
+    def stop(self):
+        """Asks ``run`` to finish the deliveries in flight and return."""
+        self._stopping.set()
+
+    def run(self, burst=False, report_interval=60):
+        """
+        Takes and delivers jobs until stopped.
+
+        Arguments:
+            * burst: Return once the queue is empty instead of waiting
+                     for more jobs
+            * report_interval: Seconds between logged reports
+
+        Returns the final report.
+        """
+        self.started = time.time()
+        next_report = self.started + report_interval
+
+        # Jobs wait in lanes: one per callback host, or one per callback
+        # URL for jobs that must be delivered in order.
+        waiting = {}
+        ready = deque()
+        active = {}
+        limits = {}
+        # (due, sequence, lane, job, attempt); the sequence keeps retries
+        # due at the same moment in the order they failed.
+        retries = []
+        sequence = count()
+        tasks = Queue()
+        results = Queue()
+        threads = []
+        for i in xrange(self.concurrency):
+            thread = threading.Thread(
+                target=self._work,
+                args=(tasks, results),
+                name='pushhub-delivery-%d' % i,
+            )
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        def schedule(lane, limit, job, attempt):
+            if lane not in waiting:
+                waiting[lane] = deque()
+                active[lane] = 0
+                limits[lane] = limit
+            if not waiting[lane] and active[lane] < limits[lane]:
+                ready.append(lane)
+            waiting[lane].append((job, attempt))
+
+        def saturated(lane):
+            return active[lane] >= limits[lane]
+
+        buffered = 0
+        # Buffered jobs waiting in saturated lanes, e.g. behind an ordered
+        # lane held for a retry. They can't be sent yet, so they don't
+        # stop more jobs being taken for other callbacks.
+        parked = 0
+        in_flight = 0
+        drained = False
+        try:
+            while True:
+                now = time.time()
+                while retries and retries[0][0] <= now:
+                    due, seq, lane, job, attempt = heapq.heappop(retries)
+                    if limits.get(lane) == 1:
+                        # An ordered lane was held for this retry; it goes
+                        # ahead of the jobs queued behind it.
+                        active[lane] -= 1
+                        parked -= len(waiting[lane])
+                        waiting[lane].appendleft((job, attempt))
+                        ready.append(lane)
+                    else:
+                        schedule(lane, self.lane_for(job)[1], job, attempt)
+                        if saturated(lane):
+                            parked += 1
+                    buffered += 1
+
+                stopping = self._stopping.is_set()
+                if not stopping:
+                    self.claim_ordered(now)
+                # Keep a few more jobs on hand than can be in flight, so
+                # a free thread always has something to pick up.
+                while (not stopping and not drained and
+                       buffered - parked < self.concurrency * 2 and
+                       buffered < self.max_buffered):
+                    job = self._dequeue(block=not (
+                        buffered or in_flight or retries))
+                    if job is None:
+                        drained = True
+                        break
+                    lane, limit = self.lane_for(job)
+                    schedule(lane, limit, job, 1)
+                    if saturated(lane):
+                        parked += 1
+                    buffered += 1
+
+                while ready and in_flight < self.concurrency:
+                    lane = ready.popleft()
+                    job, attempt = waiting[lane].popleft()
+                    tasks.put((lane, job, attempt))
+                    active[lane] += 1
+                    buffered -= 1
+                    in_flight += 1
+                    if waiting[lane]:
+                        if saturated(lane):
+                            parked += len(waiting[lane])
+                        else:
+                            ready.append(lane)
+
+                if not in_flight:
+                    if stopping or (burst and drained and not retries):
+                        break
+                    if retries:
+                        time.sleep(max(0, min(retries[0][0] - time.time(),
+                                              self.poll)))
+                    drained = False
+                    continue
+
+                try:
+                    outcome = results.get(timeout=self.poll)
+                except Empty:
+                    drained = False
+                    continue
+                lane, job, attempt, seconds, error = outcome
+                in_flight -= 1
+                self.latencies.append(seconds)
+
+                retry = (error is not None and attempt < self.attempts and
+                         is_transient(error[1]))
+                if retry and limits[lane] == 1:
+                    # Hold the ordered lane until the retry has been sent.
+                    pass
+                else:
+                    active[lane] -= 1
+                    if waiting[lane] and active[lane] == limits[lane] - 1:
+                        parked -= len(waiting[lane])
+                        ready.append(lane)
+                    elif not waiting[lane] and not active[lane]:
+                        # Forget idle lanes; there's one per ordered URL.
+                        del waiting[lane], active[lane], limits[lane]
+
+                if error is None:
+                    self.stats.incr('delivered')
+                    self._finished(job)
+                elif retry:
+                    self.stats.incr('retried')
+                    delay = min(self.backoff * 2 ** (attempt - 1),
+                                self.max_backoff)
+                    logger.info('Retrying %s in %.1fs: %s'
+                                % (job.id, delay, error[1]))
+                    heapq.heappush(retries, (time.time() + delay,
+                                             next(sequence), lane, job,
+                                             attempt + 1))
+                else:
+                    self.stats.incr('failed')
+                    self._failed(job, error)
+
+                # Jobs finishing keeps the queue worth checking again.
+                drained = False
+
+                if time.time() >= next_report:
+                    logger.info(self.format_report(self.report()))
+                    next_report = time.time() + report_interval
+        finally:
+            for thread in threads:
+                tasks.put(None)
+            # Hand back anything not yet delivered so it isn't lost,
+            # keeping the order it was taken in.
+            pending = [job for due, seq, lane, job, attempt in retries]
+            for lane in waiting:
+                pending.extend(job for job, attempt in waiting[lane])
+            pending.sort(key=lambda job: job.enqueued_at)
+            for job in reversed(pending):
+                self._requeue(job)
+            self.release_ordered()
+
+        return self.report()
+
+    def _work(self, tasks, results):
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            lane, job, attempt = task
+            start = time.time()
+            try:
+                job.perform()
+            except Exception:
+                results.put((lane, job, attempt, time.time() - start,
+                             sys.exc_info()))
+            else:
+                results.put((lane, job, attempt, time.time() - start, None))
+
+    def lane_for(self, job):
+        """
+        Returns the lane a job waits in and how many of the lane's jobs
+        may be in flight at once.
+
+        Jobs queued with ``ordered`` in their meta are delivered one at a
+        time per callback URL, so they arrive in the order queued.
+        Other jobs share a lane per callback host.
+        """
+        callback_url = ''
+        if job.args and isinstance(job.args[0], basestring):
+            callback_url = job.args[0]
+        if job.meta.get('ordered'):
+            return callback_url, 1
+        return urlparse(callback_url).netloc, self.per_host
+
+    def claim_ordered(self, now=None):
+        """
+        Takes or renews the lock on the ordered queue, checking a few
+        times per ``lock_timeout``. Returns whether this worker holds it.
+        """
+        if now is None:
+            now = time.time()
+        if now < self._next_claim:
+            return self.owns_ordered
+        self._next_claim = now + self.lock_timeout / 3.0
+        if self.owns_ordered:
+            try:
+                self.ordered_lock.reacquire()
+            except LockError:
+                # It expired and may have been taken by another worker;
+                # ordered jobs already buffered here are still sent.
+                logger.warning('Lost the lock on the ordered queue')
+                self.owns_ordered = False
+        else:
+            self.owns_ordered = bool(self.ordered_lock.acquire(
+                blocking=False))
+            if self.owns_ordered:
+                logger.info('Taking jobs from the ordered queue')
+        return self.owns_ordered
+
+    def release_ordered(self):
+        """Lets another worker take over the ordered queue."""
+        if not self.owns_ordered:
+            return
+        self.owns_ordered = False
+        self._next_claim = 0
+        try:
+            self.ordered_lock.release()
+        except LockError:
+            pass
+
+    def _queues(self):
+        if not self.owns_ordered:
+            return [self.queue]
+        # Take turns at the front, so neither queue starves the other.
+        self._turn ^= 1
+        if self._turn:
+            return [self.ordered_queue, self.queue]
+        return [self.queue, self.ordered_queue]
+
+    def _dequeue(self, block):
+        try:
+            result = JobQueue.dequeue_any(self._queues(),
+                                          self.poll if block else None,
+                                          connection=self.queue.connection)
+        except DequeueTimeout:
+            return None
+        return result[0] if result else None
+
+    def _finished(self, job):
+        # Nobody reads the results of deliveries, so drop the job.
+        job.delete()
+
+    def _failed(self, job, exc_info):
+        logger.warning('Delivery %s failed: %s' % (job.id, exc_info[1]))
+        failed_queue = get_failed_queue(connection=self.queue.connection)
+        failed_queue.quarantine(
+            job, exc_info=''.join(traceback.format_exception(*exc_info)))
+
+    def _requeue(self, job):
+        queue = self.ordered_queue if job.meta.get('ordered') else self.queue
+        queue.push_job_id(job.id, at_front=True)
+
+    def report(self):
+        """
+        Returns delivery counts, the rate of deliveries per second and
+        latency percentiles in milliseconds.
+        """
+        stats = self.stats.snapshot()
+        elapsed = time.time() - self.started if self.started else 0.0
+        latencies = sorted(self.latencies)
+        stats.update(
+            seconds=elapsed,
+            rate=stats['delivered'] / elapsed if elapsed else 0.0,
+            p50=percentile(latencies, 0.5) * 1000,
+            p90=percentile(latencies, 0.9) * 1000,
+            p99=percentile(latencies, 0.99) * 1000,
+        )
+        return stats
+
+    @staticmethod
+    def format_report(report):
+        return ("Delivered %(delivered)d (%(rate).1f/sec), "
+                "retried %(retried)d, failed %(failed)d; latency "
+                "p50 %(p50).0fms p90 %(p90).0fms p99 %(p99).0fms" % report)
+
+
+def worker_from_settings(settings, connection):
+    """Creates a DeliveryWorker using the ``pushhub.delivery_*`` settings."""
+    return DeliveryWorker(
+        connection,
+        queue_name=settings.get('pushhub.redis_queue', 'default'),
+        concurrency=int(settings.get('pushhub.delivery_concurrency', 20)),
+        per_host=int(settings.get('pushhub.delivery_per_host', 4)),
+        attempts=int(settings.get('pushhub.delivery_attempts', 5)),
+        backoff=float(settings.get('pushhub.delivery_backoff', 1.0)),
+        max_buffered=int(settings.get('pushhub.delivery_max_buffered',
+                                      10000)),
+        lock_timeout=int(settings.get('pushhub.delivery_lock_timeout', 60)),
+    )
@@ -48,7 +48,8 @@ requires = [
     'requests',
     'feedparser',
     'WebHelpers',
-    'rq',
+    # The delivery worker uses rq's FailedQueue, removed in rq 1.0
+    'rq<1.0',
     ]
 
 setup(name='PushHubCore',
@@ -81,5 +82,8 @@ setup(name='PushHubCore',
       fetch_all_topics = pushhub.scripts:fetch_all_topics
       show_subscribers = pushhub.scripts:show_subscribers
       show_topics = pushhub.scripts:show_topics
+      delivery_worker = pushhub.scripts:run_delivery_worker
+      reap_leases = pushhub.scripts:reap_leases
+      migrate_containers = pushhub.scripts:migrate_containers
       """,
       )